@@ -80,6 +80,7 @@ class OF_conn(openflow_conn.OpenflowConn):
 
         self.logger = logging.getLogger('vim.OF.ODL')
         self.logger.setLevel( getattr(logging, params.get("of_debug", "ERROR")) )
+        self.init_session(params)
 
     def get_of_switches(self):
         """
@@ -88,8 +89,9 @@ class OF_conn(openflow_conn.OpenflowConn):
                  Raise an OpenflowconnConnectionException exception if fails with text_error
         """
         try:
-            of_response = requests.get(self.url+"/restconf/operational/opendaylight-inventory:nodes",
-                                       headers=self.headers)
+            of_response = self.http_request("GET", "get_of_switches",
+                                            self.url+"/restconf/operational/opendaylight-inventory:nodes",
+                                            headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("get_of_switches " + error_text)
@@ -155,8 +157,9 @@ class OF_conn(openflow_conn.OpenflowConn):
                  Raise a OpenflowconnConnectionException expection in case of failure
         """
         try:
-            of_response = requests.get(self.url+"/restconf/operational/opendaylight-inventory:nodes",
-                                       headers=self.headers)
+            of_response = self.http_request("GET", "obtain_port_correspondence",
+                                            self.url+"/restconf/operational/opendaylight-inventory:nodes",
+                                            headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("obtain_port_correspondence " + error_text)
@@ -251,53 +254,49 @@ class OF_conn(openflow_conn.OpenflowConn):
                     Raise a OpenflowconnConnectionException expection in case of failure
 
         """
+        return dict(self.iter_of_rules(translate_of_ports))
 
-        try:
-            # get rules
-            if len(self.ofi2pp) == 0:
-                self.obtain_port_correspondence()
-
-            of_response = requests.get(self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
-                                          "/table/0", headers=self.headers)
-            error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
-
-            # The configured page does not exist if there are no rules installed. In that case we return an empty dict
-            if of_response.status_code == 404:
-                return {}
+    def _get_of_rules_response(self):
+        # get rules
+        if len(self.ofi2pp) == 0:
+            self.obtain_port_correspondence()
 
-            elif of_response.status_code != 200:
-                self.logger.warning("get_of_rules " + error_text)
-                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
-
-            self.logger.debug("get_of_rules " + error_text)
-
-            info = of_response.json()
+        of_response = self.http_request("GET", "get_of_rules",
+                                        self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
+                                        "/table/0", headers=self.headers, stream=True)
 
-            if type(info) != dict:
-                self.logger.error("get_of_rules. Unexpected response not a dict: %s", str(info))
-                raise openflow_conn.OpenflowconnUnexpectedResponse("Unexpected openflow response, not a dict. "
-                                                                   "Wrong version?")
+        # The configured page does not exist if there are no rules installed. In that case we return None
+        if of_response.status_code == 404:
+            of_response.close()
+            return None
 
-            table = info.get('flow-node-inventory:table')
-            if type(table) is not list:
-                self.logger.error("get_of_rules. Unexpected response at 'flow-node-inventory:table', "
-                                  "not a list: %s", str(type(table)))
-                raise openflow_conn.OpenflowconnUnexpectedResponse("Unexpected response at 'flow-node-inventory:table',"
-                                                                   " not a list. Wrong version?")
+        elif of_response.status_code != 200:
+            error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
+            self.logger.warning("get_of_rules " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
 
-            flow_list = table[0].get('flow')
-            if flow_list is None:
-                return {}
+        self.logger.debug("get_of_rules Openflow response %d", of_response.status_code)
+        return of_response
 
-            if type(flow_list) is not list:
-                self.logger.error("get_of_rules. Unexpected response at 'flow-node-inventory:table'[0]:'flow', not a list: %s", str(type(flow_list)))
-                raise openflow_conn.OpenflowconnUnexpectedResponse("Unexpected response at 'flow-node-inventory:"
-                                                                   "table'[0]:'flow', not a list. Wrong version?")
+    def iter_of_rules(self, translate_of_ports=True, name_prefix=None):
+        """
+        Iterate the rules inserted at openflow controller, decoding the controller response while iterating
+        :param translate_of_ports: if True it translates ports from openflow index to physical switch name
+        :param name_prefix: if provided, only rules with a name starting with it are iterated
+        :return: generator of (rule name, rule) pairs, with the rule content described at get_of_rules
+                 Raise a OpenflowconnConnectionException expection in case of failure
+        """
+        of_response = None
+        try:
+            of_response = self._get_of_rules_response()
+            if of_response is None:
+                return
 
             # TODO translate ports according to translate_of_ports parameter
 
-            rules = dict()
-            for flow in flow_list:
+            for flow in openflow_conn.iter_json(of_response, "flow-node-inventory:table.item.flow.item"):
+                if name_prefix and not ('id' in flow and flow['id'].startswith(name_prefix)):
+                    continue
                 if not ('id' in flow and 'match' in flow and 'instructions' in flow and
                                 'instruction' in flow['instructions'] and
                                 'apply-actions' in flow['instructions']['instruction'][0] and
@@ -372,7 +371,7 @@ class OF_conn(openflow_conn.OpenflowConn):
                 actions = [x for x in actions if x != None]
 
                 rule['actions'] = list(actions)
-                rules[flow['id']] = dict(rule)
+                yield flow['id'], dict(rule)
 
                 #flow['id']
                 #flow['priority']
@@ -402,7 +401,6 @@ class OF_conn(openflow_conn.OpenflowConn):
                 #actions = [x for x in actions if x != None]
                 #                                                       -> output-action -> output-node-connector
                 #                                                       -> pop-vlan-action
-            return rules
         except requests.exceptions.RequestException as e:
             error_text = type(e).__name__ + ": " + str(e)
             self.logger.error("get_of_rules " + error_text)
@@ -412,6 +410,37 @@ class OF_conn(openflow_conn.OpenflowConn):
             error_text = type(e).__name__ + ": " + str(e)
             self.logger.error("get_of_rules " + error_text)
             raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        finally:
+            if of_response is not None:
+                of_response.close()
+
+    def get_of_rule_names(self, name_prefix=None):
+        """
+        Obtain the names of the rules inserted at openflow controller, without translating their content
+        :param name_prefix: if provided, only rules with a name starting with it are returned
+        :return: set of rule names
+                 Raise a OpenflowconnConnectionException expection in case of failure
+        """
+        of_response = None
+        try:
+            of_response = self._get_of_rules_response()
+            if of_response is None:
+                return set()
+            return set(name for name in openflow_conn.iter_json(of_response,
+                                                                "flow-node-inventory:table.item.flow.item.id")
+                       if not name_prefix or name.startswith(name_prefix))
+        except requests.exceptions.RequestException as e:
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("get_of_rule_names " + error_text)
+            raise openflow_conn.OpenflowconnConnectionException(error_text)
+        except ValueError as e:
+            # ValueError in the case that JSON can not be decoded
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("get_of_rule_names " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        finally:
+            if of_response is not None:
+                of_response.close()
 
     def del_flow(self, flow_name):
         """
@@ -421,8 +450,9 @@ class OF_conn(openflow_conn.OpenflowConn):
         """
 
         try:
-            of_response = requests.delete(self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
-                                          "/table/0/flow/"+flow_name, headers=self.headers)
+            of_response = self.http_request("DELETE", "del_flow",
+                                            self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
+                                            "/table/0/flow/"+flow_name, headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("del_flow " + error_text)
@@ -435,6 +465,75 @@ class OF_conn(openflow_conn.OpenflowConn):
             self.logger.error("del_flow " + error_text)
             raise openflow_conn.OpenflowconnConnectionException(error_text)
 
+    def _build_flow(self, data):
+        """
+        Build the opendaylight flow dictionary from the generic data
+        :param data: dictionary with the content described at new_flow
+        :return: opendaylight flow. Raise a OpenflowconnUnexpectedResponse expection if data cannot be translated
+        """
+        if len(self.pp2ofi) == 0:
+            self.obtain_port_correspondence()
+
+        # We have to build the data for the opendaylight call from the generic data
+        flow = dict()
+        flow['id'] = data['name']
+        flow['flow-name'] = data['name']
+        flow['idle-timeout'] = 0
+        flow['hard-timeout'] = 0
+        flow['table_id'] = 0
+        flow['priority'] = data.get('priority')
+        flow['match'] = dict()
+        if not data['ingress_port'] in self.pp2ofi:
+            error_text = 'Error. Port '+data['ingress_port']+' is not present in the switch'
+            self.logger.warning("new_flow " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        flow['match']['in-port'] = self.pp2ofi[data['ingress_port']]
+        if 'dst_mac' in data:
+            flow['match']['ethernet-match'] = dict()
+            flow['match']['ethernet-match']['ethernet-destination'] = dict()
+            flow['match']['ethernet-match']['ethernet-destination']['address'] = data['dst_mac']
+        if data.get('vlan_id'):
+            flow['match']['vlan-match'] = dict()
+            flow['match']['vlan-match']['vlan-id'] = dict()
+            flow['match']['vlan-match']['vlan-id']['vlan-id-present'] = True
+            flow['match']['vlan-match']['vlan-id']['vlan-id'] = int(data['vlan_id'])
+        flow['instructions'] = dict()
+        flow['instructions']['instruction'] = list()
+        flow['instructions']['instruction'].append(dict())
+        flow['instructions']['instruction'][0]['order'] = 1
+        flow['instructions']['instruction'][0]['apply-actions'] = dict()
+        flow['instructions']['instruction'][0]['apply-actions']['action'] = list()
+        actions = flow['instructions']['instruction'][0]['apply-actions']['action']
+
+        order = 0
+        for action in data['actions']:
+            new_action = { 'order': order }
+            if  action[0] == "vlan":
+                if action[1] == None:
+                    # strip vlan
+                    new_action['strip-vlan-action'] = dict()
+                else:
+                    new_action['set-field'] = dict()
+                    new_action['set-field']['vlan-match'] = dict()
+                    new_action['set-field']['vlan-match']['vlan-id'] = dict()
+                    new_action['set-field']['vlan-match']['vlan-id']['vlan-id-present'] = True
+                    new_action['set-field']['vlan-match']['vlan-id']['vlan-id'] = int(action[1])
+            elif action[0] == 'out':
+                new_action['output-action'] = dict()
+                if not action[1] in self.pp2ofi:
+                    error_msj = 'Port '+action[1]+' is not present in the switch'
+                    raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
+
+                new_action['output-action']['output-node-connector'] = self.pp2ofi[ action[1] ]
+            else:
+                error_msj = "Unknown item '%s' in action list" % action[0]
+                self.logger.error("new_flow " + error_msj)
+                raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
+
+            actions.append(new_action)
+            order += 1
+        return flow
+
     def new_flow(self, data):
         """
         Insert a new static rule
@@ -451,76 +550,13 @@ class OF_conn(openflow_conn.OpenflowConn):
         """
 
         try:
-
-            if len(self.pp2ofi) == 0:
-                self.obtain_port_correspondence()
-
-            # We have to build the data for the opendaylight call from the generic data
-            sdata = dict()
-            sdata['flow-node-inventory:flow'] = list()
-            sdata['flow-node-inventory:flow'].append(dict())
-            flow = sdata['flow-node-inventory:flow'][0]
-            flow['id'] = data['name']
-            flow['flow-name'] = data['name']
-            flow['idle-timeout'] = 0
-            flow['hard-timeout'] = 0
-            flow['table_id'] = 0
-            flow['priority'] = data.get('priority')
-            flow['match'] = dict()
-            if not data['ingress_port'] in self.pp2ofi:
-                error_text = 'Error. Port '+data['ingress_port']+' is not present in the switch'
-                self.logger.warning("new_flow " + error_text)
-                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
-            flow['match']['in-port'] = self.pp2ofi[data['ingress_port']]
-            if 'dst_mac' in data:
-                flow['match']['ethernet-match'] = dict()
-                flow['match']['ethernet-match']['ethernet-destination'] = dict()
-                flow['match']['ethernet-match']['ethernet-destination']['address'] = data['dst_mac']
-            if data.get('vlan_id'):
-                flow['match']['vlan-match'] = dict()
-                flow['match']['vlan-match']['vlan-id'] = dict()
-                flow['match']['vlan-match']['vlan-id']['vlan-id-present'] = True
-                flow['match']['vlan-match']['vlan-id']['vlan-id'] = int(data['vlan_id'])
-            flow['instructions'] = dict()
-            flow['instructions']['instruction'] = list()
-            flow['instructions']['instruction'].append(dict())
-            flow['instructions']['instruction'][0]['order'] = 1
-            flow['instructions']['instruction'][0]['apply-actions'] = dict()
-            flow['instructions']['instruction'][0]['apply-actions']['action'] = list()
-            actions = flow['instructions']['instruction'][0]['apply-actions']['action']
-
-            order = 0
-            for action in data['actions']:
-                new_action = { 'order': order }
-                if  action[0] == "vlan":
-                    if action[1] == None:
-                        # strip vlan
-                        new_action['strip-vlan-action'] = dict()
-                    else:
-                        new_action['set-field'] = dict()
-                        new_action['set-field']['vlan-match'] = dict()
-                        new_action['set-field']['vlan-match']['vlan-id'] = dict()
-                        new_action['set-field']['vlan-match']['vlan-id']['vlan-id-present'] = True
-                        new_action['set-field']['vlan-match']['vlan-id']['vlan-id'] = int(action[1])
-                elif action[0] == 'out':
-                    new_action['output-action'] = dict()
-                    if not action[1] in self.pp2ofi:
-                        error_msj = 'Port '+action[1]+' is not present in the switch'
-                        raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
-
-                    new_action['output-action']['output-node-connector'] = self.pp2ofi[ action[1] ]
-                else:
-                    error_msj = "Unknown item '%s' in action list" % action[0]
-                    self.logger.error("new_flow " + error_msj)
-                    raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
-
-                actions.append(new_action)
-                order += 1
+            sdata = {'flow-node-inventory:flow': [self._build_flow(data)]}
 
             # print json.dumps(sdata)
-            of_response = requests.put(self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
-                          "/table/0/flow/" + data['name'],
-                                headers=self.headers, data=json.dumps(sdata) )
+            of_response = self.http_request("PUT", "new_flow",
+                                            self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
+                                            "/table/0/flow/" + data['name'], headers=self.headers,
+                                            data=json.dumps(sdata))
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("new_flow " + error_text)
@@ -534,14 +570,44 @@ class OF_conn(openflow_conn.OpenflowConn):
             self.logger.error("new_flow " + error_text)
             raise openflow_conn.OpenflowconnConnectionException(error_text)
 
+    def new_flows(self, flows):
+        """
+        Insert several static rules with a single POST of all of them to the flow table. The POST is atomic and fails
+        if any of the flows already exists, in that case they are inserted one by one reusing the http connection
+        :param flows: list of dictionaries with the content described at new_flow
+        :return: Raise a OpenflowconnConnectionException expection in case of failure
+        """
+        if not flows:
+            return None
+        try:
+            sdata = {'flow-node-inventory:flow': [self._build_flow(data) for data in flows]}
+            of_response = self.http_request("POST", "new_flows",
+                                            self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
+                                            "/table/0", headers=self.headers, data=json.dumps(sdata))
+            error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
+            if of_response.status_code in (200, 201, 204):
+                self.logger.debug("new_flows OK %d flows", len(flows))
+                return None
+            if of_response.status_code not in (404, 405, 409):  # Conflict when some of the flows is already present
+                self.logger.warning("new_flows " + error_text)
+                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+            self.logger.debug("new_flows batch not applied, inserting one by one. " + error_text)
+        except requests.exceptions.RequestException as e:
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("new_flows " + error_text)
+            raise openflow_conn.OpenflowconnConnectionException(error_text)
+
+        return openflow_conn.OpenflowConn.new_flows(self, flows)
+
     def clear_all_flows(self):
         """
         Delete all existing rules
         :return: Raise a OpenflowconnConnectionException expection in case of failure
         """
         try:
-            of_response = requests.delete(self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
-                                      "/table/0", headers=self.headers)
+            of_response = self.http_request("DELETE", "clear_all_flows",
+                                            self.url+"/restconf/config/opendaylight-inventory:nodes/node/" + self.id +
+                                            "/table/0", headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200 and of_response.status_code != 404: #HTTP_Not_Found
                 self.logger.warning("clear_all_flows " + error_text)
@@ -32,6 +32,7 @@ __author__="Pablo Montes"
 from definitionsClass import definitionsClass
 from auxiliary_functions import get_ssh_connection
 import libvirt
+import lvirt_connection
 from xml.etree import ElementTree
 import paramiko 
 import re
@@ -75,11 +76,12 @@ class RADclass():
         self.ports_list = list()            #List containing all network ports in the node. This is used to avoid having defined multiple times the same port in the system
     
     
-    def obtain_RAD(self, user, password, machine):
+    def obtain_RAD(self, user, password, machine, keyfile=None):
         """This function obtains the RAD information from the remote server.
         It uses both a ssh and a libvirt connection. 
         It is desirable in future versions get rid of the ssh connection, but currently 
         libvirt does not provide all the needed information. 
+        The libvirt connection is the persistent one that the host_thread of this host uses later
         Returns (True, Warning) in case of success and (False, <error>) in case of error"""
         warning_text=""
         try:
@@ -92,7 +94,7 @@ class RADclass():
             
             self.connection_IP = machine
             #print "libvirt open pre"
-            virsh_conn=libvirt.open("qemu+ssh://"+user+'@'+machine+"/system")
+            virsh_conn = lvirt_connection.get_connection(libvirt, lvirt_connection.get_uri(user, machine, keyfile)).get()
             #virsh_conn=libvirt.openAuth("qemu+ssh://"+user+'@'+machine+"/system", 
             #        [[libvirt.VIR_CRED_AUTHNAME, libvirt.VIR_CRED_PASSPHRASE, libvirt.VIR_CRED_USERNAME], getCredentials, password],
             #        0)
@@ -31,6 +31,7 @@ __date__ ="$4-Jan-2016 12:07:15$"
 
 import threading
 import time
+import heapq
 import Queue
 import paramiko
 import random
@@ -39,13 +40,69 @@ import logging
 
 #TODO: insert a logging system
 
+# Print the isc-dhcp-server leases file appended since offset when the file is the same (inode) and has not shrunk,
+# otherwise the whole file. First line is "isc <inode> <offset of the printed content>". Uses the lxd dnsmasq leases
+# file if there is not isc leases file
+LEASES_COMMAND = """f='{file}'
+if [ -e "$f" ]; then
+  inode=$(stat -c %i "$f"); size=$(stat -c %s "$f")
+  if [ "$inode" = "{inode}" ] && [ "$size" -ge {offset} ]; then echo "isc $inode {offset}"; tail -c +{next} "$f"
+  else echo "isc $inode 0"; cat "$f"; fi
+elif [ -e '{dnsmasq_file}' ]; then echo dnsmasq; cat '{dnsmasq_file}'; fi"""
+
+
+def parse_isc_leases(text, leases):
+    """
+    Parse the content of an isc-dhcp-server leases file, as get_dhcp_lease.sh does: the last active lease of each
+    mac address is taken
+    :param text: leases file content, or the part appended to it
+    :param leases: dictionary of ip addresses by lowercase mac address, updated with the parsed leases
+    :return: number of bytes parsed; a lease or line not complete at the end of the text is not parsed
+    """
+    parsed = 0
+    position = 0
+    lease = None
+    for line in text.splitlines(True):
+        if not line.endswith("\n"):
+            break
+        position += len(line)
+        words = line.split()
+        if lease is None:
+            if len(words) > 2 and words[0] == "lease" and words[2] == "{":
+                lease = words[1]
+                active = False
+                mac = None
+            else:
+                parsed = position
+        elif words[:3] == ["binding", "state", "active;"]:
+            active = True
+        elif words[:2] == ["hardware", "ethernet"] and len(words) > 2:
+            mac = words[2].rstrip(";").lower()
+        elif words and words[0] == "}":
+            if active and mac:
+                leases[mac] = lease
+            lease = None
+            parsed = position
+    return parsed
+
+
+def parse_dnsmasq_leases(text):
+    """Parse a dnsmasq leases file. Return a dictionary of ip addresses by lowercase mac address"""
+    leases = {}
+    for line in text.splitlines():
+        words = line.split()
+        if len(words) > 2:
+            leases[words[1].lower()] = words[2]
+    return leases
+
+
 class dhcp_thread(threading.Thread):
     def __init__(self, dhcp_params, db, db_lock, test, dhcp_nets, logger_name=None, debug=None):
         '''Init a thread.
         Arguments: thread_info must be a dictionary with:
             'dhcp_params' dhcp server parameters with the following keys:
                 mandatory : user, host, port, key, ifaces(interface name list of the one managed by the dhcp)
-                optional:  password, key, port(22)
+                optional:  password, key, port(22), bulk_leases(True), leases_file
             'db' 'db_lock': database class and lock for accessing it
             'test': in test mode no acces to a server is done, and ip is invented
         '''
@@ -56,6 +113,12 @@ class dhcp_thread(threading.Thread):
         self.test = test
         self.dhcp_nets = dhcp_nets
         self.ssh_conn = None
+        # read in a single command the leases file, instead of running get_dhcp_lease.sh for each mac address
+        self.bulk_leases = dhcp_params.get("bulk_leases", True)
+        self.leases_file = dhcp_params.get("leases_file", "/var/lib/dhcp/dhcpd.leases")
+        self.leases = {}            # ip addresses by lowercase mac address, of the leases file read
+        self.leases_inode = None    # leases file read, to detect when it is rewritten
+        self.leases_offset = 0      # bytes of the leases file already parsed
         if logger_name:
             self.logger_name = logger_name
         else:
@@ -70,9 +133,10 @@ class dhcp_thread(threading.Thread):
             #next_reading: time for the next trying to check ACTIVE status or IP
             #created: time when it was added 
             #active: time when the VM becomes into ACTIVE status
+        self.mac_heap = []  # heap of (next_reading, mac_address). Entries of removed macs or with a next_reading
+                            # different from the one at mac_status are outdated and skipped
             
         
-        self.queueLock = threading.Lock()
         self.taskQueue = Queue.Queue(2000)
         
     def ssh_connect(self):
@@ -103,12 +167,27 @@ class dhcp_thread(threading.Thread):
         for port in c:
             if port["net_id"] in self.dhcp_nets:
                 self.mac_status[ port["mac"] ] = {"ip": port["ip_address"], "next_reading": now, "created": now, "retries":0}
+        self.mac_heap = [(now, mac_address) for mac_address in self.mac_status]
+        heapq.heapify(self.mac_heap)
+
+    def schedule(self, mac_address, next_reading):
+        """Set the time of the next reading of a mac address, pushing it to the deadline heap"""
+        self.mac_status[mac_address]["next_reading"] = next_reading
+        heapq.heappush(self.mac_heap, (next_reading, mac_address))
+
+    def get_next_deadline(self):
+        """Return the time of the earliest next_reading, discarding the outdated entries of the heap"""
+        while self.mac_heap:
+            next_reading, mac_address = self.mac_heap[0]
+            status = self.mac_status.get(mac_address)
+            if status and status["next_reading"] == next_reading:
+                return next_reading
+            heapq.heappop(self.mac_heap)
+        return None
     
     def insert_task(self, task, *aditional):
         try:
-            self.queueLock.acquire()
-            task = self.taskQueue.put( (task,) + aditional, timeout=5) 
-            self.queueLock.release()
+            self.taskQueue.put( (task,) + aditional, timeout=5)
             return 1, None
         except Queue.Full:
             return -1, "timeout inserting a task over dhcp_thread"
@@ -120,25 +199,21 @@ class dhcp_thread(threading.Thread):
             self.load_mac_from_db()
             while True:
                 try:
-                    self.queueLock.acquire()
-                    if not self.taskQueue.empty():
-                        task = self.taskQueue.get()
-                    else:
+                    # wait for a task until next dhcp reading
+                    try:
+                        task = self.taskQueue.get(timeout=max(0, next_iteration - time.time()))
+                    except Queue.Empty:
                         task = None
-                    self.queueLock.release()
 
                     if task is None:
-                        now=time.time()
-                        if now >= next_iteration:
-                            next_iteration = self.get_ip_from_dhcp()
-                        else:
-                            time.sleep(1)
+                        next_iteration = self.get_ip_from_dhcp()
                         continue
 
                     if task[0] == 'add':
                         self.logger.debug("processing task add mac " + str(task[1]))
                         now=time.time()
                         self.mac_status[task[1] ] = {"ip": None, "next_reading": now, "created": now, "retries":0}
+                        self.schedule(task[1], now)
                         next_iteration = now
                     elif task[0] == 'del':
                         self.logger.debug("processing task del mac " + str(task[1]))
@@ -161,27 +236,83 @@ class dhcp_thread(threading.Thread):
             self.logger.error("terminate Exception: " + str(e))
         self.logger.debug("exit from dhcp_thread")
 
+    def get_dhcp_leases(self):
+        """
+        Obtain the active leases of the dhcp server with a single command. Only the part of the leases file appended
+        since the previous call is transferred and parsed, unless the file has been rewritten
+        :return: dictionary of ip addresses by lowercase mac address, or None if it cannot be obtained
+        """
+        command = LEASES_COMMAND.format(file=self.leases_file, inode=self.leases_inode or "-",
+                                        offset=self.leases_offset, next=self.leases_offset + 1,
+                                        dnsmasq_file="/var/lib/lxd-bridge/dnsmasq.lxdbr0.leases")
+        if self.dhcp_params["host"] == "localhost":
+            try:
+                output = subprocess.check_output(('bash', '-c', command))
+            except Exception as e:
+                self.logger.error("get_dhcp_leases subprocess Exception " + str(e))
+                return None
+        else:
+            try:
+                if not self.ssh_conn:
+                    self.ssh_connect()
+                (_, stdout, _) = self.ssh_conn.exec_command(command)
+                output = stdout.read()
+            except Exception as e:
+                self.logger.error("get_dhcp_leases: Exception: " + str(e))
+                self.ssh_conn = None
+                return None
+
+        header, _, text = output.partition("\n")
+        header = header.split()
+        if not header:
+            self.logger.error("get_dhcp_leases: leases file not found")
+            return None
+        if header[0] == "dnsmasq":
+            self.leases = parse_dnsmasq_leases(text)
+            self.leases_inode = None
+            self.leases_offset = 0
+        else:
+            offset = int(header[2])
+            if offset == 0:
+                self.leases = {}
+            self.leases_inode = header[1]
+            self.leases_offset = offset + parse_isc_leases(text, self.leases)
+        return self.leases
+
     def get_ip_from_dhcp(self):
         
         now = time.time()
-        next_iteration= now + 40000 # >10 hores
+        due_macs = []   # mac addresses whose next_reading has passed
+        due_macs_set = set()    # same content as due_macs, for membership checks
         
         #print self.name, "Iteration" 
-        for mac_address in self.mac_status:
-            if now < self.mac_status[mac_address]["next_reading"]:
-                if self.mac_status[mac_address]["next_reading"] < next_iteration:
-                    next_iteration = self.mac_status[mac_address]["next_reading"]
-                continue
-            
+        while self.mac_heap and self.mac_heap[0][0] <= now:
+            next_reading, mac_address = heapq.heappop(self.mac_heap)
+            status = self.mac_status.get(mac_address)
+            if not status or status["next_reading"] != next_reading or mac_address in due_macs_set:
+                continue    # deleted or rescheduled
+            due_macs.append(mac_address)
+            due_macs_set.add(mac_address)
+
+        #check from db at once which of the not active yet are already active
+        inactive_macs = [mac_address for mac_address in due_macs if self.mac_status[mac_address].get("active") == None]
+        active_macs = set()
+        if inactive_macs:
+            self.db_lock.acquire()
+            r,c = self.db.get_table(SELECT=("p.mac",), FROM="ports as p join instances as i on p.instance_id=i.uuid",
+                                    WHERE={"p.mac": inactive_macs, "i.status": "ACTIVE"})
+            self.db_lock.release()
+            if r<0:
+                self.logger.error("Error getting data from database: " + c)
+            else:
+                active_macs = set(port["mac"].lower() for port in c)
+
+        macs_to_read = []   # mac addresses whose lease must be read now
+        for mac_address in due_macs:
             if self.mac_status[mac_address].get("active") == None:
-                #check from db if already active
-                self.db_lock.acquire()
-                r,c = self.db.get_table(FROM="ports as p join instances as i on p.instance_id=i.uuid",
-                                        WHERE={"p.mac": mac_address, "i.status": "ACTIVE"})
-                self.db_lock.release()
-                if r>0:
+                if mac_address.lower() in active_macs:
                     self.mac_status[mac_address]["active"] = now
-                    self.mac_status[mac_address]["next_reading"] = (int(now)/2 +1)* 2
+                    self.schedule(mac_address, (int(now)/2 +1)* 2)
                     self.logger.debug("mac %s VM ACTIVE", mac_address)
                     self.mac_status[mac_address]["retries"] = 0
                 else:
@@ -194,19 +325,25 @@ class dhcp_thread(threading.Thread):
                             self.db_lock.release()
                             self.mac_status[mac_address]["ip"] = "0.0.0.0"
                             self.logger.debug("mac %s >> set to 0.0.0.0 because of timeout", mac_address)
-                        self.mac_status[mac_address]["next_reading"] = (int(now)/60 +1)* 60
+                        self.schedule(mac_address, (int(now)/60 +1)* 60)
                     else:
-                        self.mac_status[mac_address]["next_reading"] = (int(now)/6 +1)* 6
-                if self.mac_status[mac_address]["next_reading"] < next_iteration:
-                    next_iteration = self.mac_status[mac_address]["next_reading"]
+                        self.schedule(mac_address, (int(now)/6 +1)* 6)
                 continue
-            
+            macs_to_read.append(mac_address)
+
+        # obtain all the leases at once
+        leases = None
+        if macs_to_read and self.bulk_leases and not self.test:
+            leases = self.get_dhcp_leases()
 
+        for mac_address in macs_to_read:
             if self.test:
                 if self.mac_status[mac_address]["retries"]>random.randint(10,100): #wait between 10 and 100 seconds to produce a fake IP
                     content = self.get_fake_ip()
                 else:
                     content = None
+            elif self.bulk_leases:
+                content = leases.get(mac_address.lower()) if leases else None
             elif self.dhcp_params["host"]=="localhost":
                 try:
                     command = ['get_dhcp_lease.sh',  mac_address]
@@ -240,9 +377,7 @@ class dhcp_thread(threading.Thread):
                     self.logger.error("Database update error: " + c)
                 else:
                     self.mac_status[mac_address]["retries"] = 0
-                    self.mac_status[mac_address]["next_reading"] = (int(now)/3600 +1)* 36000 # 10 hores
-                    if self.mac_status[mac_address]["next_reading"] < next_iteration:
-                        next_iteration = self.mac_status[mac_address]["next_reading"]
+                    self.schedule(mac_address, (int(now)/3600 +1)* 36000) # 10 hores
                     self.logger.debug("mac %s >> %s", mac_address, content)
                     continue
             #a fail has happen
@@ -258,14 +393,14 @@ class dhcp_thread(threading.Thread):
                     self.logger.debug("mac %s >> set to 0.0.0.0 because of timeout", mac_address)
             
             if now - self.mac_status[mac_address]["active"] > 60:
-                self.mac_status[mac_address]["next_reading"] = (int(now)/6 +1)* 6
+                self.schedule(mac_address, (int(now)/6 +1)* 6)
             elif now - self.mac_status[mac_address]["active"] > 300:
-                self.mac_status[mac_address]["next_reading"] = (int(now)/60 +1)* 60
+                self.schedule(mac_address, (int(now)/60 +1)* 60)
             else:
-                self.mac_status[mac_address]["next_reading"] = (int(now)/2 +1)* 2
-                
-            if self.mac_status[mac_address]["next_reading"] < next_iteration:
-                next_iteration = self.mac_status[mac_address]["next_reading"]
+                self.schedule(mac_address, (int(now)/2 +1)* 2)
+        next_iteration = self.get_next_deadline()
+        if next_iteration is None:
+            next_iteration = now + 40000 # >10 hores
         return next_iteration    
     
     def get_fake_ip(self):
@@ -74,6 +74,7 @@ class OF_conn(openflow_conn.OpenflowConn):
         self.version = None
         self.logger = logging.getLogger('vim.OF.FL')
         self.logger.setLevel(getattr(logging, params.get("of_debug", "ERROR")))
+        self.init_session(params)
         self._set_version(params.get("of_version"))
 
     def _set_version(self, version):
@@ -121,7 +122,8 @@ class OF_conn(openflow_conn.OpenflowConn):
                       parameter is missing or wrong
         """
         try:
-            of_response = requests.get(self.url + "/wm/core/controller/switches/json", headers=self.headers)
+            of_response = self.http_request("GET", "get_of_switches", self.url + "/wm/core/controller/switches/json",
+                                            headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("get_of_switches " + error_text)
@@ -176,93 +178,98 @@ class OF_conn(openflow_conn.OpenflowConn):
                     switch:       DPID, all
                 Raise an openflowconnUnexpectedResponse exception if fails with text_error
         """
+        return dict(self.iter_of_rules(translate_of_ports))
 
-        try:
-            # get translation, autodiscover version
-            if len(self.ofi2pp) == 0:
-                self.obtain_port_correspondence()
+    def _get_of_rules_response(self):
+        # get translation, autodiscover version
+        if len(self.ofi2pp) == 0:
+            self.obtain_port_correspondence()
 
-            of_response = requests.get(self.url + "/wm/%s/list/%s/json" % (self.ver_names["URLmodifier"], self.dpid),
-                                       headers=self.headers)
+        of_response = self.http_request("GET", "get_of_rules", self.url + "/wm/%s/list/%s/json" %
+                                        (self.ver_names["URLmodifier"], self.dpid), headers=self.headers, stream=True)
+        if of_response.status_code != 200:
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
-            if of_response.status_code != 200:
-                self.logger.warning("get_of_rules " + error_text)
-                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
-            self.logger.debug("get_of_rules " + error_text)
-            info = of_response.json()
-            if type(info) != dict:
-                self.logger.error("get_of_rules. Unexpected response not a dict %s", str(type(info)))
-                raise openflow_conn.OpenflowconnUnexpectedResponse("Unexpected response, not a dict. Wrong version?")
-            rule_dict = {}
-            for switch, switch_info in info.iteritems():
-                if switch_info == None:
-                    continue
-                if str(switch) != self.dpid:
+            self.logger.warning("get_of_rules " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        self.logger.debug("get_of_rules Openflow response %d", of_response.status_code)
+        return of_response
+
+    def iter_of_rules(self, translate_of_ports=True, name_prefix=None):
+        """
+        Iterate the rules inserted at openflow controller, decoding the controller response while iterating
+        :param translate_of_ports: if True it translates ports from openflow index to physical switch name
+        :param name_prefix: if provided, only rules with a name starting with it are iterated
+        :return: generator of (rule name, rule) pairs, with the rule content described at get_of_rules
+                Raise an openflowconnUnexpectedResponse exception if fails with text_error
+        """
+        of_response = None
+        try:
+            of_response = self._get_of_rules_response()
+            for name, details in openflow_conn.iter_json(of_response, self.dpid, key_value=True):
+                if name_prefix and not name.startswith(name_prefix):
                     continue
-                for name, details in switch_info.iteritems():
-                    rule = {}
-                    rule["switch"] = str(switch)
-                    # rule["active"] = "true"
-                    rule["priority"] = int(details["priority"])
-                    if self.version[0] == "0":
-                        if translate_of_ports:
-                            rule["ingress_port"] = self.ofi2pp[details["match"]["inputPort"]]
+                rule = {}
+                rule["switch"] = self.dpid
+                # rule["active"] = "true"
+                rule["priority"] = int(details["priority"])
+                if self.version[0] == "0":
+                    if translate_of_ports:
+                        rule["ingress_port"] = self.ofi2pp[details["match"]["inputPort"]]
+                    else:
+                        rule["ingress_port"] = str(details["match"]["inputPort"])
+                    dst_mac = details["match"]["dataLayerDestination"]
+                    if dst_mac != "00:00:00:00:00:00":
+                        rule["dst_mac"] = dst_mac
+                    vlan = details["match"]["dataLayerVirtualLan"]
+                    if vlan != -1:
+                        rule["vlan_id"] = vlan
+                    actionlist = []
+                    for action in details["actions"]:
+                        if action["type"] == "OUTPUT":
+                            if translate_of_ports:
+                                port = self.ofi2pp[action["port"]]
+                            else:
+                                port = action["port"]
+                            actionlist.append(("out", port))
+                        elif action["type"] == "STRIP_VLAN":
+                            actionlist.append(("vlan", None))
+                        elif action["type"] == "SET_VLAN_ID":
+                            actionlist.append(("vlan", action["virtualLanIdentifier"]))
                         else:
-                            rule["ingress_port"] = str(details["match"]["inputPort"])
-                        dst_mac = details["match"]["dataLayerDestination"]
+                            actionlist.append((action["type"], str(action)))
+                            self.logger.warning("get_of_rules() Unknown action in rule %s: %s", rule["name"],
+                                                str(action))
+                        rule["actions"] = actionlist
+                elif self.version[0] == "1":
+                    if translate_of_ports:
+                        rule["ingress_port"] = self.ofi2pp[details["match"]["in_port"]]
+                    else:
+                        rule["ingress_port"] = details["match"]["in_port"]
+                    if "eth_dst" in details["match"]:
+                        dst_mac = details["match"]["eth_dst"]
                         if dst_mac != "00:00:00:00:00:00":
                             rule["dst_mac"] = dst_mac
-                        vlan = details["match"]["dataLayerVirtualLan"]
-                        if vlan != -1:
-                            rule["vlan_id"] = vlan
-                        actionlist = []
-                        for action in details["actions"]:
-                            if action["type"] == "OUTPUT":
-                                if translate_of_ports:
-                                    port = self.ofi2pp[action["port"]]
-                                else:
-                                    port = action["port"]
-                                actionlist.append(("out", port))
-                            elif action["type"] == "STRIP_VLAN":
-                                actionlist.append(("vlan", None))
-                            elif action["type"] == "SET_VLAN_ID":
-                                actionlist.append(("vlan", action["virtualLanIdentifier"]))
+                    if "eth_vlan_vid" in details["match"]:
+                        vlan = int(details["match"]["eth_vlan_vid"], 16) & 0xFFF
+                        rule["vlan_id"] = str(vlan)
+                    actionlist = []
+                    for action in details["instructions"]["instruction_apply_actions"]:
+                        if action == "output":
+                            if translate_of_ports:
+                                port = self.ofi2pp[details["instructions"]["instruction_apply_actions"]["output"]]
                             else:
-                                actionlist.append((action["type"], str(action)))
-                                self.logger.warning("get_of_rules() Unknown action in rule %s: %s", rule["name"],
-                                                    str(action))
-                            rule["actions"] = actionlist
-                    elif self.version[0] == "1":
-                        if translate_of_ports:
-                            rule["ingress_port"] = self.ofi2pp[details["match"]["in_port"]]
+                                port = details["instructions"]["instruction_apply_actions"]["output"]
+                            actionlist.append(("out", port))
+                        elif action == "strip_vlan":
+                            actionlist.append(("vlan", None))
+                        elif action == "set_vlan_vid":
+                            actionlist.append(
+                                ("vlan", details["instructions"]["instruction_apply_actions"]["set_vlan_vid"]))
                         else:
-                            rule["ingress_port"] = details["match"]["in_port"]
-                        if "eth_dst" in details["match"]:
-                            dst_mac = details["match"]["eth_dst"]
-                            if dst_mac != "00:00:00:00:00:00":
-                                rule["dst_mac"] = dst_mac
-                        if "eth_vlan_vid" in details["match"]:
-                            vlan = int(details["match"]["eth_vlan_vid"], 16) & 0xFFF
-                            rule["vlan_id"] = str(vlan)
-                        actionlist = []
-                        for action in details["instructions"]["instruction_apply_actions"]:
-                            if action == "output":
-                                if translate_of_ports:
-                                    port = self.ofi2pp[details["instructions"]["instruction_apply_actions"]["output"]]
-                                else:
-                                    port = details["instructions"]["instruction_apply_actions"]["output"]
-                                actionlist.append(("out", port))
-                            elif action == "strip_vlan":
-                                actionlist.append(("vlan", None))
-                            elif action == "set_vlan_vid":
-                                actionlist.append(
-                                    ("vlan", details["instructions"]["instruction_apply_actions"]["set_vlan_vid"]))
-                            else:
-                                self.logger.error("get_of_rules Unknown action in rule %s: %s", rule["name"],
-                                                  str(action))
-                                # actionlist.append( (action, str(details["instructions"]["instruction_apply_actions"]) ))
-                    rule_dict[str(name)] = rule
-            return rule_dict
+                            self.logger.error("get_of_rules Unknown action in rule %s: %s", rule["name"],
+                                              str(action))
+                            # actionlist.append( (action, str(details["instructions"]["instruction_apply_actions"]) ))
+                yield str(name), rule
         except requests.exceptions.RequestException as e:
             error_text = type(e).__name__ + ": " + str(e)
             self.logger.error("get_of_rules " + error_text)
@@ -272,6 +279,34 @@ class OF_conn(openflow_conn.OpenflowConn):
             error_text = type(e).__name__ + ": " + str(e)
             self.logger.error("get_of_rules " + error_text)
             raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        finally:
+            if of_response is not None:
+                of_response.close()
+
+    def get_of_rule_names(self, name_prefix=None):
+        """
+        Obtain the names of the rules inserted at openflow controller, without translating their content
+        :param name_prefix: if provided, only rules with a name starting with it are returned
+        :return: set of rule names
+                Raise an openflowconnUnexpectedResponse exception if fails with text_error
+        """
+        of_response = None
+        try:
+            of_response = self._get_of_rules_response()
+            return set(str(name) for name, _ in openflow_conn.iter_json(of_response, self.dpid, key_value=True)
+                       if not name_prefix or name.startswith(name_prefix))
+        except requests.exceptions.RequestException as e:
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("get_of_rule_names " + error_text)
+            raise openflow_conn.OpenflowconnConnectionException(error_text)
+        except ValueError as e:
+            # ValueError in the case that JSON can not be decoded
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("get_of_rule_names " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        finally:
+            if of_response is not None:
+                of_response.close()
 
     def obtain_port_correspondence(self):
         """
@@ -280,7 +315,8 @@ class OF_conn(openflow_conn.OpenflowConn):
                  Raise an openflowconnUnexpectedResponse exception if fails with text_error
         """
         try:
-            of_response = requests.get(self.url + "/wm/core/controller/switches/json", headers=self.headers)
+            of_response = self.http_request("GET", "obtain_port_correspondence",
+                                            self.url + "/wm/core/controller/switches/json", headers=self.headers)
             # print vim_response.status_code
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
@@ -317,8 +353,9 @@ class OF_conn(openflow_conn.OpenflowConn):
                 if self.version[0] == "0":
                     ports = info[index]["ports"]
                 else:  # version 1.X
-                    of_response = requests.get(self.url + "/wm/core/switch/%s/port-desc/json" % self.dpid,
-                                               headers=self.headers)
+                    of_response = self.http_request("GET", "obtain_port_correspondence",
+                                                    self.url + "/wm/core/switch/%s/port-desc/json" % self.dpid,
+                                                    headers=self.headers)
                     # print vim_response.status_code
                     error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
                     if of_response.status_code != 200:
@@ -366,10 +403,11 @@ class OF_conn(openflow_conn.OpenflowConn):
             if self.version == None:
                 self.get_of_switches()
 
-            of_response = requests.delete(self.url + "/wm/%s/json" % self.ver_names["URLmodifier"],
-                                          headers=self.headers,
-                                          data='{"switch":"%s","name":"%s"}' % (self.dpid, flow_name)
-                                          )
+            of_response = self.http_request("DELETE", "del_flow",
+                                            self.url + "/wm/%s/json" % self.ver_names["URLmodifier"],
+                                            headers=self.headers,
+                                            data='{"switch":"%s","name":"%s"}' % (self.dpid, flow_name)
+                                            )
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("del_flow " + error_text)
@@ -430,8 +468,9 @@ class OF_conn(openflow_conn.OpenflowConn):
                 elif action[0] == 'out':
                     sdata['actions'] += "output=" + self.pp2ofi[action[1]]
 
-            of_response = requests.post(self.url + "/wm/%s/json" % self.ver_names["URLmodifier"],
-                                        headers=self.headers, data=json.dumps(sdata))
+            of_response = self.http_request("POST", "new_flow",
+                                            self.url + "/wm/%s/json" % self.ver_names["URLmodifier"],
+                                            headers=self.headers, data=json.dumps(sdata))
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("new_flow " + error_text)
@@ -459,7 +498,7 @@ class OF_conn(openflow_conn.OpenflowConn):
                     return None
 
             url = self.url + "/wm/%s/clear/%s/json" % (self.ver_names["URLmodifier"], self.dpid)
-            of_response = requests.get(url)
+            of_response = self.http_request("GET", "clear_all_flows", url)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code < 200 or of_response.status_code >= 300:
                 self.logger.warning("clear_all_flows " + error_text)
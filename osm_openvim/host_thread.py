@@ -33,6 +33,7 @@ import yaml
 import threading
 import time
 import Queue
+import collections
 import paramiko
 import subprocess
 # import libvirt
@@ -42,23 +43,84 @@ import os
 import logging
 from jsonschema import validate as js_v, exceptions as js_e
 from vim_schema import localinfo_schema, hostinfo_schema
+import lvirt_connection
+import ssh_connection
 
 class RunCommandException(Exception):
     pass
 
+
+# libvirt domain lifecycle events (virDomainEventType), used also when libvirt is not loaded at test mode
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_UNDEFINED = 1
+VIR_DOMAIN_EVENT_STARTED = 2
+VIR_DOMAIN_EVENT_SUSPENDED = 3
+VIR_DOMAIN_EVENT_RESUMED = 4
+VIR_DOMAIN_EVENT_STOPPED = 5
+VIR_DOMAIN_EVENT_CRASHED = 8
+VIR_DOMAIN_EVENT_STOPPED_CRASHED = 2    # detail of VIR_DOMAIN_EVENT_STOPPED
+
+
+class test_domain_events():
+    """Stand-in of a libvirt connection as domain event source, used at test mode. It keeps the callbacks registered
+    with domainEventRegisterAny, and emit() invokes them as libvirt does when a domain changes"""
+
+    class _domain():
+        def __init__(self, uuid):
+            self.uuid = uuid
+
+        def UUIDString(self):
+            return self.uuid
+
+    def __init__(self):
+        self.callbacks = {}
+        self.alive = True
+
+    def domainEventRegisterAny(self, dom, eventID, cb, opaque):
+        callback_id = len(self.callbacks)
+        self.callbacks[callback_id] = (eventID, cb, opaque)
+        return callback_id
+
+    def domainEventDeregisterAny(self, callback_id):
+        self.callbacks.pop(callback_id, None)
+
+    def isAlive(self):
+        return self.alive
+
+    def close(self):
+        self.callbacks = {}
+        return 0
+
+    def emit(self, server_id, event, detail=0):
+        """Generate a lifecycle event for the domain server_id"""
+        for eventID, cb, opaque in self.callbacks.values():
+            if eventID == VIR_DOMAIN_EVENT_ID_LIFECYCLE:
+                cb(self, self._domain(server_id), event, detail, opaque)
+
+
 class host_thread(threading.Thread):
     lvirt_module = None
 
     def __init__(self, name, host, user, db, db_lock, test, image_path, host_id, version, develop_mode,
-                 develop_bridge_iface, password=None, keyfile = None, logger_name=None, debug=None):
+                 develop_bridge_iface, password=None, keyfile = None, logger_name=None, debug=None,
+                 status_events=False, status_reconcile_period=300, workers=1, image_transfers=1,
+                 image_cache_quota=0):
         """Init a thread to communicate with compute node or ovs_controller.
         :param host_id: host identity
         :param name: name of the thread
         :param host: host ip or name to manage and user
         :param user, password, keyfile: user and credentials to connect to host
         :param db, db_lock': database class and lock to use it in exclusion
+        :param status_events: if True servers status is tracked with libvirt domain lifecycle events instead of
+            polling every 5 seconds. A full status polling is done every status_reconcile_period seconds
+        :param workers: number of threads processing actions over servers. Actions over the same server are processed
+            in order, actions over different servers run concurrently. With 1 all the tasks are done by this thread
+        :param image_transfers: maximum number of concurrent image copies to the host
+        :param image_cache_quota: GB of the host image_path used by the cache of unmodified images, that are reused by
+            checksum. Over it the least recently used images not used by any server are deleted. 0 for no limit
         """
         threading.Thread.__init__(self)
+        self._thread_data = threading.local()  # xml_level and run_command_session of each worker
         self.name = name
         self.host = host
         self.user = user
@@ -68,6 +130,9 @@ class host_thread(threading.Thread):
         self.password = password
         self.keyfile = keyfile
         self.localinfo_dirty = False
+        # for self.localinfo, including the image cache, and self.server_status, that are changed by the workers and
+        # saved or polled by this thread
+        self.localinfo_lock = threading.RLock()
         self.connectivity = True
 
         if not test and not host_thread.lvirt_module:
@@ -94,26 +159,66 @@ class host_thread(threading.Thread):
         
         self.xml_level = 0
         # self.pending ={}
+
+        self.workers_number = workers
+        self.workers = []
+        self.server_tasks = {}  # pending 'instance' tasks by server uuid, processed in order by one worker at a time
+        self.server_tasks_lock = threading.Lock()
+        self.ready_servers = Queue.Queue()  # server uuids with pending tasks and no worker processing them
+        self.image_transfer_semaphore = threading.BoundedSemaphore(image_transfers)
+        self.image_locks = {}   # lock by image checksum or remote file, to avoid concurrent copies of the same image
+        self.image_locks_lock = threading.Lock()
+        self.image_cache_quota = int(image_cache_quota * 1024 * 1024 * 1024)   # bytes
+        self.image_cache_grace = 600    # seconds that a cached image is not evicted after being used
+        self.image_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes_saved": 0}
+        self.ssh_lock = threading.Lock()
         
         self.server_status = {} #dictionary with pairs server_uuid:server_status 
         self.pending_terminate_server =[] #list  with pairs (time,server_uuid) time to send a terminate for a server being destroyed
         self.next_update_server_status = 0 #time when must be check servers status
+        self.status_events = status_events
+        self.status_reconcile_period = status_reconcile_period
+        self.lvirt_events_conn = None   # persistent connection subscribed to domain events
+        self.lvirt_events_callback = None
+        self.status_events_stats = {"events": 0, "changes": 0, "subscriptions": 0}
+        self.status_flush_stats = {"flushes": 0, "rows": 0, "last_rows": 0, "max_rows": 0}  # bulk status writes
         
         self.hostinfo = None 
         
-        self.queueLock = threading.Lock()
         self.taskQueue = Queue.Queue(2000)
-        self.ssh_conn = None
         self.run_command_session = None
         self.error = None
         self.localhost = True if host == 'localhost' else False
-        self.lvirt_conn_uri = "qemu+ssh://{user}@{host}/system?no_tty=1&no_verify=1".format(
-            user=self.user, host=self.host)
-        if keyfile:
-            self.lvirt_conn_uri += "&keyfile=" + keyfile
+        # persistent ssh connection, shared with other threads of the same host. Commands run over its channels
+        self.ssh_conn = None
+        if not self.localhost:
+            self.ssh_conn = ssh_connection.get_connection(self.host, self.user, password, keyfile,
+                                                          self.logger_name + ".ssh")
+        self.lvirt_conn_uri = lvirt_connection.get_uri(self.user, self.host, keyfile)
+        # persistent libvirt connection, shared with other users of the same uri
+        self.lvirt_conn = None
+        if not test:
+            self.lvirt_conn = lvirt_connection.get_connection(host_thread.lvirt_module, self.lvirt_conn_uri,
+                                                              self.logger_name + ".libvirt")
         self.remote_ip = None
         self.local_ip = None
 
+    @property
+    def xml_level(self):
+        return getattr(self._thread_data, "xml_level", 0)
+
+    @xml_level.setter
+    def xml_level(self, value):
+        self._thread_data.xml_level = value
+
+    @property
+    def run_command_session(self):
+        return getattr(self._thread_data, "run_command_session", None)
+
+    @run_command_session.setter
+    def run_command_session(self, value):
+        self._thread_data.run_command_session = value
+
     def run_command(self, command, keep_session=False, ignore_exit_status=False):
         """Run a command passed as a str on a localhost or at remote machine.
         :param command: text with the command to execute.
@@ -151,19 +256,26 @@ class host_thread(threading.Thread):
                         return out
             else:
                 if self.run_command_session:
-                    (i, o, e) = self.run_command_session
+                    (i, o, e, start) = self.run_command_session
                     self.run_command_session = None
                     i.channel.shutdown_write()
                 else:
-                    if not self.ssh_conn:
-                        self.ssh_connect()
+                    if not self.local_ip:
+                        with self.ssh_lock:
+                            if not self.local_ip:
+                                self.ssh_connect()
+                    start = time.time()
                     (i, o, e) = self.ssh_conn.exec_command(command, timeout=10)
                     if keep_session:
-                        self.run_command_session = (i, o, e)
+                        self.run_command_session = (i, o, e, start)
                         return i
                 returncode = o.channel.recv_exit_status()
                 output = o.read()
                 outerror = e.read()
+                # latency by command name, without sudo
+                words = command.split(None, 2)
+                name = words[1] if len(words) > 1 and words[0] == "sudo" else words[0] if words else ""
+                self.ssh_conn.record("command." + name.split("/")[-1], time.time() - start)
             if returncode != 0 and not ignore_exit_status:
                 text = "run_command='{}' Error='{}'".format(command, outerror)
                 self.logger.error(text)
@@ -178,23 +290,20 @@ class host_thread(threading.Thread):
             text = "run_command Exception '{}' '{}'".format(str(e), e.output)
         except (paramiko.ssh_exception.SSHException, Exception) as e:
             text = "run_command='{}' Exception='{}'".format(command, str(e))
-        self.ssh_conn = None
+        if self.ssh_conn:
+            # only a dead connection is reopened; other commands can be running over it
+            self.ssh_conn.check_error()
         self.run_command_session = None
         raise RunCommandException(text)
 
     def ssh_connect(self):
+        """Connect the shared ssh connection, if not connected or found dead, and obtain the ip addresses used"""
         try:
-            # Connect SSH
-            self.ssh_conn = paramiko.SSHClient()
-            self.ssh_conn.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_conn.load_system_host_keys()
-            self.ssh_conn.connect(self.host, username=self.user, password=self.password, key_filename=self.keyfile,
-                                        timeout=10) # auth_timeout=10)
-            self.remote_ip = self.ssh_conn.get_transport().sock.getpeername()[0]
-            self.local_ip = self.ssh_conn.get_transport().sock.getsockname()[0]
+            self.ssh_conn.get()
+            self.remote_ip = self.ssh_conn.remote_ip
+            self.local_ip = self.ssh_conn.local_ip
         except (paramiko.ssh_exception.SSHException, Exception) as e:
             text = 'ssh connect Exception: {}'.format(e)
-            self.ssh_conn = None
             self.error = text
             raise
 
@@ -217,6 +326,8 @@ class host_thread(threading.Thread):
                 self.localinfo_dirty = False
                 if 'server_files' not in self.localinfo:
                     self.localinfo['server_files'] = {}
+                if 'images' not in self.localinfo:
+                    self.localinfo['images'] = {}
                 self.logger.debug("localinfo loaded from host")
                 return
             except RunCommandException as e:
@@ -239,7 +350,7 @@ class host_thread(threading.Thread):
                 self.logger.error("load_localinfo Exception: " + text)
         
         # not loaded, insert a default data and force saving by activating dirty flag
-        self.localinfo = {'files':{}, 'server_files':{} } 
+        self.localinfo = {'files':{}, 'server_files':{}, 'images':{} } 
         # self.localinfo_dirty=True
         self.localinfo_dirty=False
 
@@ -279,17 +390,26 @@ class host_thread(threading.Thread):
             self.localinfo_dirty = False
             return
         
+        # dumped while locked, as the workers change it; changes done while writing it mark it dirty again
+        with self.localinfo_lock:
+            self.localinfo_dirty = False
+            try:
+                localinfo_text = yaml.safe_dump(self.localinfo, explicit_start=True, indent=4,
+                                                default_flow_style=False, tags=False, encoding='utf-8',
+                                                allow_unicode=True)
+            except yaml.YAMLError as e:
+                self.localinfo_dirty = True
+                self.logger.error("save_localinfo yaml format Exception " + str(e))
+                return
         while tries>=0:
             tries-=1
             
             try:
                 command = 'cat > {}/.openvim.yaml'.format(self.image_path)
                 in_stream = self.run_command(command, keep_session=True)
-                yaml.safe_dump(self.localinfo, in_stream, explicit_start=True, indent=4, default_flow_style=False,
-                               tags=False, encoding='utf-8', allow_unicode=True)
+                in_stream.write(localinfo_text)
                 result = self.run_command(command, keep_session=False)   # to end session
 
-                self.localinfo_dirty = False
                 break #while tries
 
             except RunCommandException as e:
@@ -306,29 +426,32 @@ class host_thread(threading.Thread):
             except Exception as e:
                 text = str(e)
                 self.logger.error("save_localinfo Exception: " + text)
+        else:
+            self.localinfo_dirty = True
 
     def load_servers_from_db(self):
         self.db_lock.acquire()
         r,c = self.db.get_table(SELECT=('uuid','status', 'image_id'), FROM='instances', WHERE={'host_id': self.host_id})
         self.db_lock.release()
 
-        self.server_status = {}
-        if r<0:
-            self.logger.error("Error getting data from database: " + c)
-            return
-        for server in c:
-            self.server_status[ server['uuid'] ] = server['status']
-            
-            #convert from old version to new one
-            if 'inc_files' in self.localinfo and server['uuid'] in self.localinfo['inc_files']:
-                server_files_dict = {'source file': self.localinfo['inc_files'][ server['uuid'] ] [0],  'file format':'raw' }
-                if server_files_dict['source file'][-5:] == 'qcow2':
-                    server_files_dict['file format'] = 'qcow2'
-                    
-                self.localinfo['server_files'][ server['uuid'] ] = { server['image_id'] : server_files_dict }
-        if 'inc_files' in self.localinfo:
-            del self.localinfo['inc_files']
-            self.localinfo_dirty = True
+        with self.localinfo_lock:
+            self.server_status = {}
+            if r<0:
+                self.logger.error("Error getting data from database: " + c)
+                return
+            for server in c:
+                self.server_status[ server['uuid'] ] = server['status']
+                
+                #convert from old version to new one
+                if 'inc_files' in self.localinfo and server['uuid'] in self.localinfo['inc_files']:
+                    server_files_dict = {'source file': self.localinfo['inc_files'][ server['uuid'] ] [0],  'file format':'raw' }
+                    if server_files_dict['source file'][-5:] == 'qcow2':
+                        server_files_dict['file format'] = 'qcow2'
+                        
+                    self.localinfo['server_files'][ server['uuid'] ] = { server['image_id'] : server_files_dict }
+            if 'inc_files' in self.localinfo:
+                del self.localinfo['inc_files']
+                self.localinfo_dirty = True
     
     def delete_unused_files(self):
         '''Compares self.localinfo['server_files'] content with real servers running self.server_status obtained from database
@@ -337,40 +460,107 @@ class host_thread(threading.Thread):
         ''' 
         if self.test:
             return
-        for uuid,images in self.localinfo['server_files'].items():
-            if uuid not in self.server_status:
-                for localfile in images.values():
-                    try:
-                        self.logger.debug("deleting file '%s' of unused server '%s'", localfile['source file'], uuid)
-                        self.delete_file(localfile['source file'])
-                    except RunCommandException as e:
-                        self.logger.error("Exception deleting file '%s': %s", localfile['source file'], str(e))
-                del self.localinfo['server_files'][uuid]
+        with self.localinfo_lock:
+            unused = {uuid: self.localinfo['server_files'].pop(uuid) for uuid in self.localinfo['server_files'].keys()
+                      if uuid not in self.server_status}
+            if unused:
                 self.localinfo_dirty = True
+        for uuid,images in unused.items():
+            for localfile in images.values():
+                try:
+                    self.logger.debug("deleting file '%s' of unused server '%s'", localfile['source file'], uuid)
+                    self.delete_file(localfile['source file'])
+                except RunCommandException as e:
+                    self.logger.error("Exception deleting file '%s': %s", localfile['source file'], str(e))
    
     def insert_task(self, task, *aditional):
         try:
-            self.queueLock.acquire()
-            task = self.taskQueue.put( (task,) + aditional, timeout=5) 
-            self.queueLock.release()
+            self.taskQueue.put( (task,) + aditional, timeout=5)
             return 1, None
         except Queue.Full:
             return -1, "timeout inserting a task over host " + self.name
 
+    def _start_workers(self):
+        if self.workers_number <= 1 or self.workers:
+            return
+        for index in range(0, self.workers_number):
+            worker = threading.Thread(target=self._run_worker, name="{}-worker-{}".format(self.name, index))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _stop_workers(self):
+        """Stop workers once they have processed the pending tasks"""
+        for _ in self.workers:
+            self.ready_servers.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _run_worker(self):
+        while True:
+            server_id = self.ready_servers.get()
+            if server_id is None:
+                return
+            while True:
+                with self.server_tasks_lock:
+                    tasks = self.server_tasks[server_id]
+                    if not tasks:
+                        del self.server_tasks[server_id]
+                        break
+                    req = tasks.popleft()
+                try:
+                    self.process_instance_task(req)
+                except Exception as e:
+                    self.logger.critical("Unexpected exception at worker: " + str(e), exc_info=True)
+
+    def dispatch_instance_task(self, req):
+        """Process an action over a server, by a worker if there are several workers, or directly otherwise"""
+        if not self.workers:
+            return self.process_instance_task(req)
+        server_id = req['uuid']
+        with self.server_tasks_lock:
+            tasks = self.server_tasks.get(server_id)
+            if tasks is not None:
+                # a worker is processing this server, that will take this task in order
+                tasks.append(req)
+                return
+            self.server_tasks[server_id] = collections.deque((req,))
+        self.ready_servers.put(server_id)
+
+    def process_instance_task(self, req):
+        self.logger.debug("processing task instance " + str(req['action']))
+        retry = 0
+        while retry < 2:
+            retry += 1
+            r = self.action_on_server(req, retry==2)
+            if r >= 0:
+                break
+
+    def get_idle_timeout(self):
+        """Seconds to wait for a new task before the next housekeeping: saving localinfo, polling servers status
+        or forcing off terminated servers"""
+        if self.localinfo_dirty:
+            return 0
+        deadline = self.next_update_server_status
+        if self.pending_terminate_server:
+            deadline = min(deadline, self.pending_terminate_server[0][0])
+        return min(max(0, deadline - time.time()), 60)
+
     def run(self):
         while True:
             self.load_localinfo()
             self.load_hostinfo()
             self.load_servers_from_db()
             self.delete_unused_files()
+            self._start_workers()
             while True:
                 try:
-                    self.queueLock.acquire()
-                    if not self.taskQueue.empty():
-                        task = self.taskQueue.get()
-                    else:
+                    # wait for a task until next housekeeping deadline
+                    try:
+                        task = self.taskQueue.get(timeout=self.get_idle_timeout())
+                    except Queue.Empty:
                         task = None
-                    self.queueLock.release()
 
                     if task is None:
                         now=time.time()
@@ -378,23 +568,17 @@ class host_thread(threading.Thread):
                             self.save_localinfo()
                         elif self.next_update_server_status < now:
                             self.update_servers_status()
-                            self.next_update_server_status = now + 5
+                            self.next_update_server_status = now + self.get_status_poll_period()
                         elif len(self.pending_terminate_server)>0 and self.pending_terminate_server[0][0]<now:
                             self.server_forceoff()
-                        else:
-                            time.sleep(1)
                         continue
 
                     if task[0] == 'instance':
-                        self.logger.debug("processing task instance " + str(task[1]['action']))
-                        retry = 0
-                        while retry < 2:
-                            retry += 1
-                            r = self.action_on_server(task[1], retry==2)
-                            if r >= 0:
-                                break
+                        self.dispatch_instance_task(task[1])
                     elif task[0] == 'image':
                         pass
+                    elif task[0] == 'domain-event':
+                        self.apply_servers_status({task[1]: task[2]}, full=False)
                     elif task[0] == 'exit':
                         self.logger.debug("processing task exit")
                         self.terminate()
@@ -447,15 +631,20 @@ class host_thread(threading.Thread):
                 'action':{'terminate':'force'},
                 'status': None
             }
-            self.action_on_server(req)
+            if self.workers:
+                self.dispatch_instance_task(req)
+            else:
+                self.action_on_server(req)
             self.pending_terminate_server.pop(0)
     
     def terminate(self):
         try:
+            self.unsubscribe_domain_events()
+            self._stop_workers()
             self.server_forceoff(True)
             if self.localinfo_dirty:
                 self.save_localinfo()
-            if not self.test:
+            if self.ssh_conn:
                 self.ssh_conn.close()
         except Exception as e:
             text = str(e)
@@ -1683,40 +1872,74 @@ class host_thread(threading.Thread):
             command += " '{}' '{}'".format(source, destination)
         self.run_command(command)
 
-    def copy_remote_file(self, remote_file, use_incremental):
+    def copy_remote_file(self, remote_file, use_incremental, checksum=None):
         ''' Copy a file from the repository to local folder and recursively 
             copy the backing files in case the remote file is incremental
             Read and/or modified self.localinfo['files'] that contain the
-            unmodified copies of images in the local path
+            unmodified copies of images in the local path, or self.localinfo['images'] for the images with checksum,
+            so that images with the same content at different paths are copied only once
+            Copies of the same remote_file are serialized, and the number of concurrent copies is limited
             params:
                 remote_file: path of remote file
                 use_incremental: None (leave the decision to this function), True, False
+                checksum: md5 of the image content as stored at images table, None if unknown
             return:
                 local_file: name of local file
                 qemu_info: dict with quemu information of local file
                 use_incremental_out: True, False; same as use_incremental, but if None a decision is taken
         '''
-        
+        image_key = checksum or remote_file
+        with self.image_locks_lock:
+            image_lock = self.image_locks.get(image_key)
+            if not image_lock:
+                image_lock = self.image_locks[image_key] = threading.Lock()
+        with image_lock:
+            return self._copy_remote_file(remote_file, use_incremental, checksum)
+
+    def _copy_remote_file(self, remote_file, use_incremental, checksum=None):
         use_incremental_out = use_incremental
         new_backing_file = None
         local_file = None
         file_from_local = True
+        remote_backing_file = None
+        cached_image = self.get_cached_image(checksum) if checksum else None
 
         #in case incremental use is not decided, take the decision depending on the image
         #avoid the use of incremental if this image is already incremental
         if remote_file[0:4] == "http":
             file_from_local = False
-        if file_from_local:
+        if cached_image:
+            # same content, so same backing file than the cached one
+            remote_backing_file = cached_image.get('remote backing file')
+        elif file_from_local:
             qemu_remote_info = self.qemu_get_info(remote_file)
+            remote_backing_file = qemu_remote_info.get('backing file')
         if use_incremental_out==None:
-            use_incremental_out = not ( file_from_local and 'backing file' in qemu_remote_info)
+            use_incremental_out = not remote_backing_file
         #copy recursivelly the backing files
-        if  file_from_local and 'backing file' in qemu_remote_info:
-            new_backing_file, _, _ = self.copy_remote_file(qemu_remote_info['backing file'], True)
-        
+        if remote_backing_file:
+            # backing files are cached only when the image is cached, so that they are kept while it is in use
+            backing_checksum = self.get_image_checksum(remote_backing_file) if checksum else None
+            new_backing_file, _, _ = self.copy_remote_file(remote_backing_file, True, backing_checksum)
+
+        #check if an image with the same content is present locally
+        if use_incremental_out and cached_image:
+            if cached_image['backing file'] == new_backing_file:
+                with self.localinfo_lock:
+                    cached_image['last used'] = time.time()
+                    self.image_cache_stats["hits"] += 1
+                    self.image_cache_stats["bytes_saved"] += cached_image['size']
+                    self.localinfo_dirty = True
+                self.logger.debug("image '%s' reused from local file '%s'", remote_file, cached_image['file'])
+                return cached_image['file'], {'file format': cached_image['file format']}, use_incremental_out
+            self.logger.warning("local file '%s' of image '%s' has a different backing file", cached_image['file'],
+                                remote_file)
+
         #check if remote file is present locally
-        if use_incremental_out and remote_file in self.localinfo['files']:
-            local_file = self.localinfo['files'][remote_file]
+        if use_incremental_out and not checksum:
+            with self.localinfo_lock:
+                local_file = self.localinfo['files'].get(remote_file)
+        if local_file:
             local_file_info =  self.get_file_info(local_file)
             if file_from_local:
                 remote_file_info = self.get_file_info(remote_file)
@@ -1727,7 +1950,8 @@ class host_thread(threading.Thread):
                 #TODO DELETE local file if this file is not used by any active virtual machine
                 try:
                     self.delete_file(local_file)
-                    del self.localinfo['files'][remote_file]
+                    with self.localinfo_lock:
+                        del self.localinfo['files'][remote_file]
                 except Exception:
                     pass
                 local_file = None
@@ -1740,16 +1964,109 @@ class host_thread(threading.Thread):
         if local_file == None: #copy the file 
             img_name= remote_file.split('/') [-1]
             img_local = self.image_path + '/' + img_name
-            local_file = self.get_notused_filename(img_local)
-            self.copy_file(remote_file, local_file, use_incremental_out)
+            with self.image_transfer_semaphore:
+                local_file = self.get_notused_filename(img_local)
+                self.copy_file(remote_file, local_file, use_incremental_out)
 
-            if use_incremental_out:
-                self.localinfo['files'][remote_file] = local_file
+            if use_incremental_out and not checksum:
+                with self.localinfo_lock:
+                    self.localinfo['files'][remote_file] = local_file
             if new_backing_file:
                 self.qemu_change_backing(local_file, new_backing_file)
             qemu_info = self.qemu_get_info(local_file)
+            if use_incremental_out and checksum:
+                self.add_cached_image(checksum, remote_file, local_file, qemu_info['file format'], new_backing_file,
+                                      remote_backing_file)
             
         return local_file, qemu_info, use_incremental_out
+
+    def get_image_checksum(self, remote_file):
+        '''Obtain from database the checksum of the image with this path, None if not found'''
+        self.db_lock.acquire()
+        result, content = self.db.get_table(FROM='images', SELECT=('checksum',), WHERE={'path': remote_file})
+        self.db_lock.release()
+        if result > 0:
+            return content[0]['checksum']
+        return None
+
+    def get_cached_image(self, checksum):
+        '''Return the entry of self.localinfo['images'] of this checksum, None if not present. Entries whose local
+        file has been deleted are removed'''
+        with self.localinfo_lock:
+            cached_image = self.localinfo['images'].get(checksum)
+        if not cached_image:
+            return None
+        if self.get_file_info(cached_image['file']) is None:
+            self.logger.warning("local file '%s' of cached image %s not found", cached_image['file'], checksum)
+            with self.localinfo_lock:
+                if self.localinfo['images'].get(checksum) is cached_image:
+                    del self.localinfo['images'][checksum]
+                    self.localinfo_dirty = True
+            return None
+        return cached_image
+
+    def add_cached_image(self, checksum, remote_file, local_file, file_format, backing_file, remote_backing_file):
+        '''Insert at self.localinfo['images'] an unmodified copy of an image, to be reused by checksum'''
+        file_info = self.get_file_info(local_file)
+        try:
+            size = int(file_info[4])
+        except (TypeError, IndexError, ValueError):
+            size = 0
+        with self.localinfo_lock:
+            self.localinfo['images'][checksum] = {'file': local_file, 'file format': file_format, 'size': size,
+                                                  'backing file': backing_file, 'remote file': remote_file,
+                                                  'remote backing file': remote_backing_file,
+                                                  'last used': time.time()}
+            self.image_cache_stats["misses"] += 1
+            self.localinfo_dirty = True
+
+    def evict_image_cache(self):
+        '''Delete the least recently used images of self.localinfo['images'] until their size is under the quota.
+        Images used by a server, backing files of other cached images and images used in the last image_cache_grace
+        seconds (they can be being deployed) are kept, even if the quota is exceeded. The images are chosen and removed
+        from localinfo while locked, and their files deleted after releasing the lock'''
+        if not self.image_cache_quota or self.test:
+            return
+        evicted = []
+        with self.localinfo_lock:
+            images = self.localinfo['images']
+            cache_size = sum(image['size'] for image in images.values())
+            used_files = set()
+            for server_files in self.localinfo['server_files'].values():
+                for file_ in server_files.values():
+                    if file_.get('backing file'):
+                        used_files.add(file_['backing file'])
+            now = time.time()
+            while cache_size > self.image_cache_quota:
+                backing_files = set(image['backing file'] for image in images.values() if image['backing file'])
+                candidates = [(image['last used'], checksum) for checksum, image in images.items()
+                              if image['file'] not in used_files and image['file'] not in backing_files and
+                              now - image['last used'] > self.image_cache_grace]
+                if not candidates:
+                    self.logger.debug("image cache size %d over quota, but all images are in use", cache_size)
+                    break
+                _, checksum = min(candidates)
+                image = images.pop(checksum)
+                evicted.append((checksum, image))
+                cache_size -= image['size']
+                self.image_cache_stats["evictions"] += 1
+                self.localinfo_dirty = True
+        for checksum, image in evicted:
+            try:
+                self.logger.debug("deleting file '%s' of cached image %s", image['file'], checksum)
+                self.delete_file(image['file'])
+            except RunCommandException as e:
+                self.logger.error("Exception deleting file '%s': %s", image['file'], str(e))
+
+    def get_image_cache_stats(self):
+        '''Return a dictionary with the image cache usage: images, size, quota, hits, misses, evictions, bytes_saved'''
+        with self.localinfo_lock:
+            stats = self.image_cache_stats.copy()
+            images = (getattr(self, "localinfo", None) or {}).get('images', {})
+            stats["images"] = len(images)
+            stats["size"] = sum(image['size'] for image in images.values())
+        stats["quota"] = self.image_cache_quota
+        return stats
             
     def launch_server(self, conn, server, rebuild=False, domain=None):
         if self.test:
@@ -1778,7 +2095,8 @@ class host_thread(threading.Thread):
             if "use_incremental" in server_metadata:
                 use_incremental = False if server_metadata["use_incremental"] == "no" else True
 
-            server_host_files = self.localinfo['server_files'].get( server['uuid'], {})
+            with self.localinfo_lock:
+                server_host_files = dict(self.localinfo['server_files'].get( server['uuid'], {}))
             if rebuild:
                 #delete previous incremental files
                 for file_ in server_host_files.values():
@@ -1807,7 +2125,7 @@ class host_thread(threading.Thread):
                     continue
                 else:
                     self.db_lock.acquire()
-                    result, content = self.db.get_table(FROM='images', SELECT=('path', 'metadata'),
+                    result, content = self.db.get_table(FROM='images', SELECT=('path', 'metadata', 'checksum'),
                                                         WHERE={'uuid': image_id})
                     self.db_lock.release()
                     if result <= 0:
@@ -1825,14 +2143,19 @@ class host_thread(threading.Thread):
                         continue
                 
             #2: copy image to host
+                checksum = None
                 if image_id:
                     remote_file = content[0]['path']
+                    checksum = content[0].get('checksum')
                 else:
                     remote_file = empty_path
                 use_incremental_image = use_incremental
                 if dev['metadata'].get("use_incremental") == "no":
                     use_incremental_image = False
-                local_file, qemu_info, use_incremental_image = self.copy_remote_file(remote_file, use_incremental_image)
+                local_file, qemu_info, use_incremental_image = self.copy_remote_file(remote_file, use_incremental_image,
+                                                                                     checksum)
+                # local unmodified image used by the server disk, kept at the cache while the server exists
+                backing_file = local_file if use_incremental_image else qemu_info.get('backing file')
                 
                 #create incremental image
                 if use_incremental_image:
@@ -1843,12 +2166,16 @@ class host_thread(threading.Thread):
                     qemu_info = {'file format': 'qcow2'}
                 
                 server_host_files[ dev['image_id'] ] = {'source file': local_file, 'file format': qemu_info['file format']}
+                if backing_file:
+                    server_host_files[ dev['image_id'] ]['backing file'] = backing_file
 
                 dev['source file'] = local_file 
                 dev['file format'] = qemu_info['file format']
 
-            self.localinfo['server_files'][ server['uuid'] ] = server_host_files
-            self.localinfo_dirty = True
+            with self.localinfo_lock:
+                self.localinfo['server_files'][ server['uuid'] ] = server_host_files
+                self.localinfo_dirty = True
+            self.evict_image_cache()
 
         #3 Create XML
             result, xml = self.create_xml_server(server_data, devices, server_metadata)  #local_file
@@ -1894,8 +2221,8 @@ class host_thread(threading.Thread):
             return
 
         try:
-            conn = host_thread.lvirt_module.open(self.lvirt_conn_uri)
-            domains=  conn.listAllDomains() 
+            conn = self.lvirt_conn.get()
+            domains = self.lvirt_conn.call("listAllDomains", conn.listAllDomains)
             domain_dict={}
             for domain in domains:
                 uuid = domain.UUIDString() ;
@@ -1912,16 +2239,27 @@ class host_thread(threading.Thread):
                 else:
                     new_status = None
                 domain_dict[uuid] = new_status
-            conn.close()
         except host_thread.lvirt_module.libvirtError as e:
+            self.lvirt_conn.check_error()
             self.logger.error("get_state() Exception " + e.get_error_message())
             return
 
-        for server_id, current_status in self.server_status.iteritems():
+        self.apply_servers_status(domain_dict, full=True)
+
+    def apply_servers_status(self, domain_dict, full=True):
+        """Update server_status and database with the libvirt status of the domains
+        :param domain_dict: dictionary of server_uuid: new_status, None if unknown
+        :param full: True if domain_dict contains all the domains of the host, so that missing servers are INACTIVE.
+            False if it contains only the servers notified by events
+        """
+        status_changes = {}
+        with self.localinfo_lock:
+            server_status = self.server_status.items()
+        for server_id, current_status in server_status:
             new_status = None
             if server_id in domain_dict:
                 new_status = domain_dict[server_id]
-            else:
+            elif full:
                 new_status = "INACTIVE"
                             
             if new_status == None or new_status == current_status:
@@ -1933,11 +2271,118 @@ class host_thread(threading.Thread):
             STATUS={'progress':100, 'status':new_status}
             if new_status == 'ERROR':
                 STATUS['last_error'] = 'machine has crashed'
-            self.db_lock.acquire()
-            r,_ = self.db.update_rows('instances', STATUS, {'uuid':server_id}, log=False)
-            self.db_lock.release()
-            if r>=0:
-                self.server_status[server_id] = new_status
+            status_changes[server_id] = STATUS
+
+        if not status_changes:
+            return
+        # write all the changes of this poll cycle in a single statement
+        self.db_lock.acquire()
+        r,_ = self.db.update_rows_bulk('instances', status_changes)
+        self.db_lock.release()
+        if r<0:
+            self.logger.error("update_servers_status cannot update %d servers at database", len(status_changes))
+            return
+        with self.localinfo_lock:
+            for server_id, STATUS in status_changes.items():
+                if server_id in self.server_status:     # can be deleted meanwhile by a worker
+                    self.server_status[server_id] = STATUS['status']
+        self.status_flush_stats["flushes"] += 1
+        self.status_flush_stats["rows"] += len(status_changes)
+        self.status_flush_stats["last_rows"] = len(status_changes)
+        if len(status_changes) > self.status_flush_stats["max_rows"]:
+            self.status_flush_stats["max_rows"] = len(status_changes)
+        self.logger.debug("update_servers_status %d servers updated in one flush", len(status_changes))
+        if not full:
+            self.status_events_stats["changes"] += len(status_changes)
+
+    def get_status_poll_period(self):
+        """Seconds until next full polling of servers status. When status_events is enabled it tries to subscribe to
+        libvirt events, using the slow reconcile period if subscribed, or the normal polling period of 5 seconds
+        otherwise"""
+        if not self.status_events:
+            return 5
+        if self.subscribe_domain_events():
+            return self.status_reconcile_period
+        return 5
+
+    def subscribe_domain_events(self):
+        """Ensure the persistent libvirt connection is subscribed to domain lifecycle events
+        :return: True if subscribed, False on error
+        """
+        if self.lvirt_events_conn:
+            try:
+                if self.lvirt_events_conn.isAlive():
+                    return True
+            except Exception:
+                pass
+            self.logger.warning("libvirt event connection lost, polling servers status until reconnected")
+            self.unsubscribe_domain_events()
+        try:
+            if self.test:
+                conn = test_domain_events()
+            else:
+                conn = self.lvirt_conn.get()
+            self.lvirt_events_callback = conn.domainEventRegisterAny(None, VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                                                     self._domain_event_callback, None)
+            self.lvirt_events_conn = conn
+            self.status_events_stats["subscriptions"] += 1
+            self.logger.debug("subscribed to libvirt domain lifecycle events")
+            return True
+        except Exception as e:
+            text = e.get_error_message() if host_thread.lvirt_module and \
+                isinstance(e, host_thread.lvirt_module.libvirtError) else str(e)
+            self.logger.error("subscribe_domain_events Exception: " + text)
+            return False
+
+    def unsubscribe_domain_events(self):
+        if not self.lvirt_events_conn:
+            return
+        try:
+            self.lvirt_events_conn.domainEventDeregisterAny(self.lvirt_events_callback)
+        except Exception as e:
+            self.logger.debug("unsubscribe_domain_events Exception: " + str(e))
+        self.lvirt_events_conn = None
+        self.lvirt_events_callback = None
+
+    def emit_test_domain_event(self, server_id, new_status):
+        """At test mode, generate the libvirt lifecycle event that a server action causes, so that the domain events
+        subscription is exercised without libvirt"""
+        if not isinstance(self.lvirt_events_conn, test_domain_events):
+            return
+        event = {"ACTIVE": (VIR_DOMAIN_EVENT_STARTED, 0),
+                 "PAUSED": (VIR_DOMAIN_EVENT_SUSPENDED, 0),
+                 "INACTIVE": (VIR_DOMAIN_EVENT_STOPPED, 0),
+                 "ERROR": (VIR_DOMAIN_EVENT_STOPPED, VIR_DOMAIN_EVENT_STOPPED_CRASHED),
+                 "deleted": (VIR_DOMAIN_EVENT_UNDEFINED, 0)}.get(new_status)
+        if event:
+            self.lvirt_events_conn.emit(server_id, event[0], event[1])
+
+    def _domain_event_callback(self, conn, dom, event, detail, opaque):
+        """Called from the libvirt event loop thread. It maps the lifecycle event to a server status and inserts a task
+        so that database is updated from this thread"""
+        self.status_events_stats["events"] += 1
+        if event == VIR_DOMAIN_EVENT_STARTED or event == VIR_DOMAIN_EVENT_RESUMED:
+            new_status = "ACTIVE"
+        elif event == VIR_DOMAIN_EVENT_SUSPENDED:
+            new_status = "PAUSED"
+        elif event == VIR_DOMAIN_EVENT_CRASHED or \
+                (event == VIR_DOMAIN_EVENT_STOPPED and detail == VIR_DOMAIN_EVENT_STOPPED_CRASHED):
+            new_status = "ERROR"
+        elif event == VIR_DOMAIN_EVENT_STOPPED or event == VIR_DOMAIN_EVENT_UNDEFINED:
+            new_status = "INACTIVE"
+        else:
+            return
+        try:
+            server_id = dom.UUIDString()
+        except Exception as e:
+            self.logger.error("domain event Exception: " + str(e))
+            return
+        self.logger.debug("domain event %d detail %d for server id='%s'", event, detail, server_id)
+        r, c = self.insert_task('domain-event', server_id, new_status)
+        if r < 0:
+            # full reconcile will fix it
+            self.logger.error("domain event for server id='%s' lost: %s", server_id, c)
+            self.next_update_server_status = 0
                         
     def action_on_server(self, req, last_retry=True):
         '''Perform an action on a req
@@ -1982,10 +2427,11 @@ class host_thread(threading.Thread):
                 time.sleep(5)
                 self.create_image(None, req)
         else:
+            action_start = time.time()
             try:
-                conn = host_thread.lvirt_module.open(self.lvirt_conn_uri)
+                conn = self.lvirt_conn.get()
                 try:
-                    dom = conn.lookupByUUIDString(server_id)
+                    dom = self.lvirt_conn.call("lookupByUUIDString", conn.lookupByUUIDString, server_id)
                 except host_thread.lvirt_module.libvirtError as e:
                     text = e.get_error_message()
                     if 'LookupByUUIDString' in text or 'Domain not found' in text or 'No existe un dominio coincidente' in text:
@@ -2037,16 +2483,16 @@ class host_thread(threading.Thread):
                                     last_error =  'action_on_server Exception2 while undefine:', e.get_error_message()
                             #Exception: 'virDomainDetachDevice() failed'
                     if new_status=='deleted':
-                        if server_id in self.server_status:
-                            del self.server_status[server_id]
-                        if req['uuid'] in self.localinfo['server_files']:
-                            for file_ in self.localinfo['server_files'][ req['uuid'] ].values():
-                                try:
-                                    self.delete_file(file_['source file'])
-                                except Exception:
-                                    pass
-                            del self.localinfo['server_files'][ req['uuid'] ]
-                            self.localinfo_dirty = True
+                        with self.localinfo_lock:
+                            self.server_status.pop(server_id, None)
+                            server_files = self.localinfo['server_files'].pop(req['uuid'], None)
+                            if server_files is not None:
+                                self.localinfo_dirty = True
+                        for file_ in (server_files or {}).values():
+                            try:
+                                self.delete_file(file_['source file'])
+                            except Exception:
+                                pass
 
                 elif 'shutoff' in req['action'] or 'shutdown' in req['action']:
                     try:
@@ -2116,11 +2562,8 @@ class host_thread(threading.Thread):
                                           server_id, e.get_error_message())
                 elif 'createImage' in req['action']:
                     self.create_image(dom, req)
-                        
-        
-                conn.close()    
             except host_thread.lvirt_module.libvirtError as e:
-                if conn is not None: conn.close()
+                self.lvirt_conn.check_error()
                 text = e.get_error_message()
                 new_status = "ERROR"
                 last_error = text
@@ -2128,9 +2571,12 @@ class host_thread(threading.Thread):
                     self.logger.debug("action_on_server id='%s' Exception removed from host", server_id)
                 else:
                     self.logger.error("action_on_server id='%s' Exception %s", server_id, text)
+            self.lvirt_conn.record("action." + ",".join(req['action'].keys()), time.time() - action_start)
         #end of if self.test
         if new_status ==  None:
             return 1
+        if self.test:
+            self.emit_test_domain_event(server_id, new_status)
 
         self.logger.debug("action_on_server id='%s' new status=%s %s",server_id, new_status, last_error)
         UPDATE = {'progress':100, 'status':new_status}
@@ -2147,16 +2593,17 @@ class host_thread(threading.Thread):
                              'description':'PANIC deleting server from host '+self.name+': '+last_error}
                         )
                 self.db_lock.release()
-                if server_id in self.server_status:
-                    del self.server_status[server_id]
+                with self.localinfo_lock:
+                    self.server_status.pop(server_id, None)
                 return -1
             else:
                 UPDATE['last_error'] = last_error
         if new_status != 'deleted' and (new_status != old_status or new_status == 'ERROR') :
             self.db_lock.acquire()
             self.db.update_rows('instances', UPDATE, {'uuid':server_id}, log=True)
-            self.server_status[server_id] = new_status
             self.db_lock.release()
+            with self.localinfo_lock:
+                self.server_status[server_id] = new_status
         if new_status == 'ERROR':
             return -1
         return 1
@@ -2166,7 +2613,7 @@ class host_thread(threading.Thread):
         ''' make an ifdown, ifup to restore default parameter of na interface
             Params:
                 mac: mac address of the interface
-                lib_conn: connection to the libvirt, if None a new connection is created
+                lib_conn: connection to the libvirt, if None the persistent connection of the host is used
             Return 0,None if ok, -1,text if fails
         ''' 
         conn=None
@@ -2177,25 +2624,23 @@ class host_thread(threading.Thread):
             return 0, None
         try:
             if not lib_conn:
-                conn = host_thread.lvirt_module.open(self.lvirt_conn_uri)
+                conn = self.lvirt_conn.get()
             else:
                 conn = lib_conn
                 
             #wait to the pending VM deletion
             #TODO.Revise  self.server_forceoff(True)
 
-            iface = conn.interfaceLookupByMACString(mac)
+            iface = self.lvirt_conn.call("interfaceLookupByMACString", conn.interfaceLookupByMACString, mac)
             if iface.isActive():
-                iface.destroy()
-            iface.create()
+                self.lvirt_conn.call("interface.destroy", iface.destroy)
+            self.lvirt_conn.call("interface.create", iface.create)
             self.logger.debug("restore_iface '%s' %s", name, mac)
         except host_thread.lvirt_module.libvirtError as e:
+            self.lvirt_conn.check_error()
             error_text = e.get_error_message()
             self.logger.error("restore_iface '%s' '%s' libvirt exception: %s", name, mac, error_text)
             ret=-1
-        finally:
-            if lib_conn is None and conn is not None:
-                conn.close()
         return ret, error_text
 
         
@@ -2214,7 +2659,10 @@ class host_thread(threading.Thread):
                 try:
                     server_id = req['uuid']
                     createImage=req['action']['createImage']
-                    file_orig = self.localinfo['server_files'][server_id] [ createImage['source']['image_id'] ] ['source file']
+                    with self.localinfo_lock:
+                        file_orig = self.localinfo['server_files'][server_id] [ createImage['source']['image_id'] ] ['source file']
+                        local_files = self.localinfo['files'].items()
+                        cached_images = self.localinfo['images'].values()
                     if 'path' in req['action']['createImage']:
                         file_dst = req['action']['createImage']['path']
                     else:
@@ -2225,10 +2673,15 @@ class host_thread(threading.Thread):
                     self.copy_file(file_orig, file_dst)
                     qemu_info = self.qemu_get_info(file_orig)
                     if 'backing file' in qemu_info:
-                        for k,v in self.localinfo['files'].items():
+                        for k,v in local_files:
                             if v==qemu_info['backing file']:
                                 self.qemu_change_backing(file_dst, k)
                                 break
+                        else:
+                            for image in cached_images:
+                                if image['file']==qemu_info['backing file']:
+                                    self.qemu_change_backing(file_dst, image['remote file'])
+                                    break
                     image_status='ACTIVE'
                     break
                 except paramiko.ssh_exception.SSHException as e:
@@ -2278,13 +2731,13 @@ class host_thread(threading.Thread):
 
             
             try:
-                conn=None
-                conn = host_thread.lvirt_module.open(self.lvirt_conn_uri)
-                dom = conn.lookupByUUIDString(port["instance_id"])
+                conn = self.lvirt_conn.get()
+                dom = self.lvirt_conn.call("lookupByUUIDString", conn.lookupByUUIDString, port["instance_id"])
                 if old_net:
                     text="\n".join(xml)
                     self.logger.debug("edit_iface detaching SRIOV interface " + text)
-                    dom.detachDeviceFlags(text, flags=host_thread.lvirt_module.VIR_DOMAIN_AFFECT_LIVE)
+                    self.lvirt_conn.call("detachDeviceFlags", dom.detachDeviceFlags, text,
+                                         flags=host_thread.lvirt_module.VIR_DOMAIN_AFFECT_LIVE)
                 if new_net:
                     xml[-1] ="  <vlan>   <tag id='" + str(port['vlan']) + "'/>   </vlan>"
                     self.xml_level = 1
@@ -2292,14 +2745,12 @@ class host_thread(threading.Thread):
                     xml.append('</interface>')                
                     text="\n".join(xml)
                     self.logger.debug("edit_iface attaching SRIOV interface " + text)
-                    dom.attachDeviceFlags(text, flags=host_thread.lvirt_module.VIR_DOMAIN_AFFECT_LIVE)
+                    self.lvirt_conn.call("attachDeviceFlags", dom.attachDeviceFlags, text,
+                                         flags=host_thread.lvirt_module.VIR_DOMAIN_AFFECT_LIVE)
                     
             except host_thread.lvirt_module.libvirtError as e:
                 text = e.get_error_message()
                 self.logger.error("edit_iface %s libvirt exception: %s", port["instance_id"], text)
-                
-            finally:
-                if conn is not None: conn.close()
 
 
 def create_server(server, db, db_lock, only_of_ports):
@@ -265,6 +265,15 @@ def http_get():
     print 
     return 'works' #TODO: put links or redirection to /openvim???
 
+
+@bottle.route(url_base + '/stats', method='GET')
+def http_get_stats():
+    '''get internal statistics of the server, as database connection pool usage'''
+    my = config_dic['http_threads'][ threading.current_thread().name ]
+    if not my.admin:
+        bottle.abort(HTTP_Unauthorized, "Needed admin privileges")
+    return format_out({'stats': my.ovim.get_stats()})
+
 #
 # Util funcions
 #
@@ -567,7 +576,8 @@ def http_post_hosts():
 
         #fill rad info
         rad = RADclass_module.RADclass()
-        (return_status, code) = rad.obtain_RAD(user, password, ip_name)
+        (return_status, code) = rad.obtain_RAD(user, password, ip_name,
+                                               host.get('keyfile', config_dic["host_ssh_keyfile"]))
         
         #return 
         if not return_status:
@@ -656,7 +666,12 @@ def http_post_hosts():
                                     db=config_dic['db'], db_lock=config_dic['db_lock'],
                                     test=host_test_mode, image_path=config_dic['host_image_path'],
                                     version=config_dic['version'], host_id=content['uuid'],
-                                    develop_mode=host_develop_mode, develop_bridge_iface=host_develop_bridge_iface)
+                                    develop_mode=host_develop_mode, develop_bridge_iface=host_develop_bridge_iface,
+                                    status_events=config_dic.get('host_status_events', False),
+                                    status_reconcile_period=config_dic.get('host_status_reconcile_period', 300),
+                                    workers=config_dic.get('host_workers', 1),
+                                    image_transfers=config_dic.get('host_image_transfers', 1),
+                                    image_cache_quota=config_dic.get('host_image_cache_quota', 0))
 
             thread.start()
             config_dic['host_threads'][content['uuid']] = thread
@@ -1333,41 +1348,52 @@ def http_post_images(tenant_id):
     if metadata_dict is not None: 
         http_content['image']['metadata'] = json.dumps(metadata_dict)
     #calculate checksum
+    checksum = image_checksum(http_content['image'].get('path',None), "http_post_images")
+    if checksum is not None:
+        http_content['image']['checksum'] = checksum
+    #insert in data base
+    result, content = my.db.new_image(http_content['image'], tenant_id)
+    if result >= 0:
+        return http_get_image_id(tenant_id, content)
+    else:
+        print "http_post_images error %d %s" % (result, content)
+        bottle.abort(-result, content)
+        return
+    
+def image_checksum(image_file, function_name):
+    '''Calculate the checksum of an image path. The compute nodes reuse their copies of the images by checksum, so it
+    must be calculated again each time the path changes. It is None for URLs, as they are not downloaded.
+    Abort with HTTP_Bad_Request if the path is a local file that does not exist'''
+    checksum = None
     try:
-        image_file = http_content['image'].get('path',None)
         parsed_url = urlparse.urlparse(image_file)
         if parsed_url.scheme == "" and parsed_url.netloc == "":
             # The path is a local file
             if os.path.exists(image_file):
-                http_content['image']['checksum'] = md5(image_file)
+                checksum = md5(image_file)
         else:
             # The path is a URL. Code should be added to download the image and calculate the checksum
-            #http_content['image']['checksum'] = md5(downloaded_image)
+            #checksum = md5(downloaded_image)
             pass
         # Finally, only if we are in test mode and checksum has not been calculated, we calculate it from the path
         host_test_mode = True if config_dic['mode']=='test' or config_dic['mode']=="OF only" else False
         if host_test_mode:
-            if 'checksum' not in http_content['image']:
-                http_content['image']['checksum'] = md5_string(image_file)
+            if checksum is None:
+                checksum = md5_string(image_file)
         else:
             # At this point, if the path is a local file and no chechsum has been obtained yet, an error is sent back.
             # If it is a URL, no error is sent. Checksum will be an empty string
-            if parsed_url.scheme == "" and parsed_url.netloc == "" and 'checksum' not in http_content['image']:
+            if parsed_url.scheme == "" and parsed_url.netloc == "" and checksum is None:
                 content = "Image file not found"
-                print "http_post_images error: %d %s" % (HTTP_Bad_Request, content)
+                print "%s error: %d %s" % (function_name, HTTP_Bad_Request, content)
                 bottle.abort(HTTP_Bad_Request, content)
+    except bottle.HTTPError:
+        raise
     except Exception as e:
         print "ERROR. Unexpected exception: %s" % (str(e))
         bottle.abort(HTTP_Internal_Server_Error, type(e).__name__ + ": " + str(e))
-    #insert in data base
-    result, content = my.db.new_image(http_content['image'], tenant_id)
-    if result >= 0:
-        return http_get_image_id(tenant_id, content)
-    else:
-        print "http_post_images error %d %s" % (result, content)
-        bottle.abort(-result, content)
-        return
-    
+    return checksum
+
 @bottle.route(url_base + '/<tenant_id>/images/<image_id>', method='DELETE')
 def http_delete_image_id(tenant_id, image_id):
     '''Deletes the image_id of a tenant. IT removes from tenants_images table.'''
@@ -1479,6 +1505,9 @@ def http_put_image_id(tenant_id, image_id):
             #allow only modifications over private images
             bottle.abort(HTTP_Unauthorized, "Needed admin rights to edit a public image")
             return
+        if 'path' in http_content['image']:
+            # the old checksum would make the compute nodes reuse their copies of the former image
+            http_content['image']['checksum'] = image_checksum(http_content['image']['path'], "http_put_image_id")
         #insert in data base
         result, content = my.db.update_rows('images', http_content['image'], {'uuid': image_id})
 
@@ -2245,6 +2274,84 @@ def http_put_openflow_id(network_id):
     data = {'result': str(result) + " nets updates"}
     return format_out(data)
 
+@bottle.route(url_base + '/networks/<network_id>/openflow/plan', method='GET')
+def http_get_openflow_plan(network_id):
+    """
+    To obtain, without using the openflow controllers, the flows that would be installed for a network and the
+    networks bound with it. network_id can be 'all'. Query string 'ofc_id' selects an openflow controller and
+    'flows=true' includes the planned flows
+    :param network_id: network id
+    :return:
+    """
+    my = config_dic['http_threads'][threading.current_thread().name]
+
+    if not my.admin:
+        bottle.abort(HTTP_Unauthorized, "Needed admin privileges")
+
+    if network_id == 'all':
+        network_id = None
+
+    try:
+        query = bottle.request.query
+        content = my.ovim.get_openflow_plan(network_id, query.get('ofc_id'),
+                                            flows=query.get('flows', 'false').lower() == 'true')
+        data = {'openflow-plan': content}
+    except ovim.ovimException as e:
+        my.logger.error(str(e), exc_info=True)
+        bottle.abort(e.http_code, str(e))
+    except Exception as e:
+        my.logger.error(str(e), exc_info=True)
+        bottle.abort(HTTP_Bad_Request, str(e))
+
+    return format_out(data)
+
+@bottle.route(url_base + '/networks/reconcile/openflow/<ofc_id>', method=['GET', 'PUT'])
+@bottle.route(url_base + '/networks/reconcile/openflow', method=['GET', 'PUT'])
+def http_reconcile_openflow_rules(ofc_id=None):
+    """
+    To compare the openflow rules at database with the ones at the controllers. With GET the differences are only
+    reported; with PUT the differing rules are inserted or deleted at the controllers
+    :return:
+    """
+    my = config_dic['http_threads'][threading.current_thread().name]
+
+    if not my.admin:
+        bottle.abort(HTTP_Unauthorized, "Needed admin privileges")
+    try:
+        content = my.ovim.reconcile_openflow_rules(ofc_id, dry_run=bottle.request.method == 'GET')
+        data = {'openflow-reconcile': content}
+    except ovim.ovimException as e:
+        my.logger.error(str(e), exc_info=True)
+        bottle.abort(e.http_code, str(e))
+    except Exception as e:
+        my.logger.error(str(e), exc_info=True)
+        bottle.abort(HTTP_Bad_Request, str(e))
+
+    return format_out(data)
+
+@bottle.route(url_base + '/networks/reconcile/vlans', method=['GET', 'PUT'])
+def http_reconcile_vlan_index():
+    """
+    To compare the vlans of the nets at database with the in memory index used for assigning vlans to new nets. With
+    GET the differences are only reported; with PUT the index is reloaded from database
+    :return:
+    """
+    my = config_dic['http_threads'][threading.current_thread().name]
+
+    if not my.admin:
+        bottle.abort(HTTP_Unauthorized, "Needed admin privileges")
+    try:
+        content = my.ovim.reconcile_vlan_index(dry_run=bottle.request.method == 'GET')
+        data = {'vlan-reconcile': content}
+    except ovim.ovimException as e:
+        my.logger.error(str(e), exc_info=True)
+        bottle.abort(e.http_code, str(e))
+    except Exception as e:
+        my.logger.error(str(e), exc_info=True)
+        bottle.abort(HTTP_Bad_Request, str(e))
+
+    return format_out(data)
+
 @bottle.route(url_base + '/networks/clear/openflow/<ofc_id>', method='DELETE')
 @bottle.route(url_base + '/networks/clear/openflow', method='DELETE')
 def http_clear_openflow_rules(ofc_id=None):
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+In memory index of the used ip addresses of the dhcp range of each OVS net, used for assigning the ip address of
+new instance ports without reading and scanning all the ports of the net at every server creation.
+The index of a net is filled from the database by vim_db the first time an address of the net is needed, and then
+updated by vim_db when instance ports are created or deleted.
+'''
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import threading
+import logging
+from netaddr import IPNetwork, IPAddress
+
+_FREE = b'\x00'
+
+
+class ip_range():
+    '''Bitmap of the addresses of a dhcp range, one byte per address indexed by the offset from the first address.
+    Keeps the lowest offset that can be free, so that consecutive allocations do not scan again the used part'''
+
+    def __init__(self, first_ip, last_ip, cidr, used_ips=()):
+        self.key = (first_ip, last_ip, cidr)
+        network = IPNetwork(str(first_ip) + '/' + str(IPNetwork(cidr).prefixlen))
+        self.first = IPAddress(first_ip).value
+        self.last = min(IPAddress(last_ip).value, network.last)
+        size = max(0, self.last - self.first + 1)
+        self.bitmap = bytearray(_FREE * size)
+        self.lowest_free = 0
+        self.used = 0
+        # first_ip is used by the dhcp server; gateway and broadcast are never assigned
+        for ip in (first_ip, network[1], network[-1]):
+            self.mark(ip)
+        for ip in used_ips:
+            self.mark(ip)
+
+    def _offset(self, ip):
+        try:
+            offset = IPAddress(ip).value - self.first
+        except Exception:
+            return None     # not an ip address, as empty values
+        if 0 <= offset < len(self.bitmap):
+            return offset
+        return None
+
+    def mark(self, ip):
+        '''Set an address as used. Return False if it is out of range or already used'''
+        offset = self._offset(ip)
+        if offset is None or self.bitmap[offset]:
+            return False
+        self.bitmap[offset] = 1
+        self.used += 1
+        return True
+
+    def release(self, ip):
+        '''Set an address as free. Return False if it is out of range or not used'''
+        offset = self._offset(ip)
+        if offset is None or not self.bitmap[offset]:
+            return False
+        self.bitmap[offset] = 0
+        self.used -= 1
+        if offset < self.lowest_free:
+            self.lowest_free = offset
+        return True
+
+    def allocate(self):
+        '''Mark and return the lowest free address, or None if the range is full'''
+        offset = self.bitmap.find(_FREE, self.lowest_free)
+        if offset < 0:
+            self.lowest_free = len(self.bitmap)
+            return None
+        self.bitmap[offset] = 1
+        self.used += 1
+        self.lowest_free = offset + 1
+        return str(IPAddress(self.first + offset))
+
+
+class ip_index():
+    '''Used ip addresses of the dhcp range of the nets kept in memory.
+    All the methods are thread safe, as the index is shared by the several vim_db connections of ovim
+    '''
+
+    def __init__(self, logger_name=None, debug=None):
+        self.nets = {}      # net uuid: ip_range
+        self.lock = threading.Lock()
+        if logger_name:
+            self.logger_name = logger_name
+        else:
+            self.logger_name = 'openvim.db.ip_index'
+        self.logger = logging.getLogger(self.logger_name)
+        if debug:
+            self.logger.setLevel(getattr(logging, debug))
+
+    def is_loaded(self, net_id, first_ip, last_ip, cidr):
+        '''Return True if the net is loaded with this dhcp range'''
+        with self.lock:
+            net = self.nets.get(net_id)
+            return net is not None and net.key == (first_ip, last_ip, cidr)
+
+    def load_net(self, net_id, first_ip, last_ip, cidr, used_ips):
+        '''Replace the content of a net with the dhcp range and the used addresses obtained from database'''
+        net = ip_range(first_ip, last_ip, cidr, used_ips)
+        with self.lock:
+            self.nets[net_id] = net
+        self.logger.debug("loaded net %s, %d used of %d addresses", net_id, net.used, len(net.bitmap))
+
+    def remove_net(self, net_id):
+        with self.lock:
+            self.nets.pop(net_id, None)
+
+    def allocate(self, net_id):
+        '''Mark as used and return the lowest free address of a loaded net. None if the net is full or not loaded'''
+        with self.lock:
+            net = self.nets.get(net_id)
+            if net is None:
+                return None
+            return net.allocate()
+
+    def release(self, net_id, ip):
+        '''Mark an address of a net as free. Addresses out of range or of not loaded nets are ignored'''
+        with self.lock:
+            net = self.nets.get(net_id)
+            if net is not None:
+                net.release(ip)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Long-lived libvirt connections to the compute nodes. A connection is opened once per libvirt uri and shared by the
+host_thread of the compute node and the RADclass host discovery. Connections use keepalive, are reopened when
+found dead, and keep the latency of the libvirt calls done through them.
+'''
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import threading
+import time
+import logging
+
+_connections = {}   # lvirt_connection by uri
+_connections_lock = threading.Lock()
+_event_loop = None  # thread running the libvirt default event loop
+_event_loop_lock = threading.Lock()
+
+
+def get_uri(user, host, keyfile=None):
+    '''Return the libvirt uri used for connecting to a compute node'''
+    uri = "qemu+ssh://{user}@{host}/system?no_tty=1&no_verify=1".format(user=user, host=host)
+    if keyfile:
+        uri += "&keyfile=" + keyfile
+    return uri
+
+
+def get_connection(lvirt_module, uri, logger_name=None):
+    '''Return the shared lvirt_connection for this uri, creating it if needed. The libvirt connection is not
+    opened until lvirt_connection.get() is called'''
+    with _connections_lock:
+        connection = _connections.get(uri)
+        if not connection:
+            connection = _connections[uri] = lvirt_connection(lvirt_module, uri, logger_name)
+        return connection
+
+
+def start_event_loop(lvirt_module):
+    '''Register and run in a daemon thread the libvirt default event loop, needed for connection keepalive and for
+    receiving domain events. It is done once per process'''
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop:
+            return
+        lvirt_module.virEventRegisterDefaultImpl()
+
+        def _run_event_loop():
+            while True:
+                lvirt_module.virEventRunDefaultImpl()
+
+        _event_loop = threading.Thread(target=_run_event_loop, name="libvirt-events")
+        _event_loop.daemon = True
+        _event_loop.start()
+
+
+class lvirt_connection():
+    def __init__(self, lvirt_module, uri, logger_name=None, keepalive_interval=5, keepalive_count=3):
+        self.lvirt_module = lvirt_module
+        self.uri = uri
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.conn = None
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(logger_name or "openvim.libvirt")
+        # latency: dictionary by call name with count, total and max seconds
+        self.stats = {"opens": 0, "reconnections": 0, "errors": 0, "latency": {}}
+
+    def get(self):
+        '''Return the libvirt connection, opening it if not opened yet or found dead.
+        Raise libvirtError if it cannot connect'''
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    if self.conn.isAlive():
+                        return self.conn
+                except self.lvirt_module.libvirtError:
+                    pass
+                self.logger.debug("libvirt connection to '%s' is not alive, reconnecting", self.uri)
+                self.stats["reconnections"] += 1
+                self._close()
+            start_event_loop(self.lvirt_module)
+            start = time.time()
+            conn = self.lvirt_module.open(self.uri)
+            self.record("open", time.time() - start)
+            try:
+                conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+            except self.lvirt_module.libvirtError as e:
+                self.logger.debug("libvirt keepalive not set for '%s': %s", self.uri, e.get_error_message())
+            self.stats["opens"] += 1
+            self.conn = conn
+            return conn
+
+    def _close(self):
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except self.lvirt_module.libvirtError:
+            pass
+        self.conn = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def check_error(self):
+        '''Called after a libvirtError. If the connection is dead it is closed, so that next get() reconnects'''
+        self.stats["errors"] += 1
+        with self.lock:
+            if self.conn is None:
+                return
+            try:
+                if self.conn.isAlive():
+                    return
+            except self.lvirt_module.libvirtError:
+                pass
+            self._close()
+
+    def record(self, name, elapsed):
+        '''Account the latency of a libvirt call'''
+        latency = self.stats["latency"].get(name)
+        if not latency:
+            latency = self.stats["latency"][name] = {"count": 0, "total": 0.0, "max": 0.0}
+        latency["count"] += 1
+        latency["total"] += elapsed
+        if elapsed > latency["max"]:
+            latency["max"] = elapsed
+
+    def call(self, name, function, *args, **kwargs):
+        '''Call a libvirt function recording its latency under name. A libvirtError is raised after checking the
+        connection'''
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        except self.lvirt_module.libvirtError:
+            self.check_error()
+            raise
+        finally:
+            self.record(name, time.time() - start)
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats["latency"] = {name: dict(latency) for name, latency in self.stats["latency"].items()}
+        stats["connected"] = self.conn is not None
+        return stats
@@ -63,6 +63,7 @@ class OF_conn(openflow_conn.OpenflowConn):
             raise ValueError("IP address and port must be provided")
         #internal variables
         self.name = "onos"
+        self.assigns_flow_names = True  # rules are named with the flowId assigned by ONOS
         self.headers = {'content-type':'application/json','accept':'application/json',}
 
         self.auth="None"
@@ -84,6 +85,7 @@ class OF_conn(openflow_conn.OpenflowConn):
 
         self.logger = logging.getLogger('vim.OF.onos')
         self.logger.setLevel( getattr(logging, params.get("of_debug", "ERROR")) )
+        self.init_session(params)
         self.ip_address = None
 
     def get_of_switches(self):
@@ -94,7 +96,7 @@ class OF_conn(openflow_conn.OpenflowConn):
         """
         try:
             self.headers['content-type'] = 'text/plain'
-            of_response = requests.get(self.url + "devices", headers=self.headers)
+            of_response = self.http_request("GET", "get_of_switches", self.url + "devices", headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("get_of_switches " + error_text)
@@ -157,7 +159,8 @@ class OF_conn(openflow_conn.OpenflowConn):
         """
         try:
             self.headers['content-type'] = 'text/plain'
-            of_response = requests.get(self.url + "devices/" + self.id + "/ports", headers=self.headers)
+            of_response = self.http_request("GET", "obtain_port_correspondence",
+                                            self.url + "devices/" + self.id + "/ports", headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 200:
                 self.logger.warning("obtain_port_correspondence " + error_text)
@@ -216,48 +219,46 @@ class OF_conn(openflow_conn.OpenflowConn):
                     switch:       DPID, all
                  Raise a openflowconnUnexpectedResponse expection in case of failure
         """
+        return dict(self.iter_of_rules(translate_of_ports))
 
-        try:
-
-            if len(self.ofi2pp) == 0:
-                self.obtain_port_correspondence()
-
-            # get rules
-            self.headers['content-type'] = 'text/plain'
-            of_response = requests.get(self.url + "flows/" + self.id, headers=self.headers)
-            error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
-
-            # The configured page does not exist if there are no rules installed. In that case we return an empty dict
-            if of_response.status_code == 404:
-                return {}
-
-            elif of_response.status_code != 200:
-                self.logger.warning("get_of_rules " + error_text)
-                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
-            self.logger.debug("get_of_rules " + error_text)
-
-            info = of_response.json()
-
-            if type(info) != dict:
-                self.logger.error("get_of_rules. Unexpected response, not a dict: %s", str(info))
-                raise openflow_conn.OpenflowconnUnexpectedResponse("Unexpected openflow response, not a dict. "
-                                                                   "Wrong version?")
+    def _get_of_rules_response(self):
+        if len(self.ofi2pp) == 0:
+            self.obtain_port_correspondence()
 
-            flow_list = info.get('flows')
+        # get rules
+        self.headers['content-type'] = 'text/plain'
+        of_response = self.http_request("GET", "get_of_rules", self.url + "flows/" + self.id, headers=self.headers,
+                                        stream=True)
 
-            if flow_list is None:
-                return {}
+        # The configured page does not exist if there are no rules installed. In that case we return None
+        if of_response.status_code == 404:
+            of_response.close()
+            return None
 
-            if type(flow_list) is not list:
-                self.logger.error(
-                    "get_of_rules. Unexpected response at 'flows', not a list: %s",
-                    str(type(flow_list)))
-                raise openflow_conn.OpenflowconnUnexpectedResponse("Unexpected response at 'flows', not a list. "
-                                                                   "Wrong version?")
+        elif of_response.status_code != 200:
+            error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
+            self.logger.warning("get_of_rules " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        self.logger.debug("get_of_rules Openflow response %d", of_response.status_code)
+        return of_response
 
-            rules = dict() # Response dictionary
+    def iter_of_rules(self, translate_of_ports=True, name_prefix=None):
+        """
+        Iterate the rules inserted at openflow controller, decoding the controller response while iterating
+        :param translate_of_ports: if True it translates ports from openflow index to physical switch name
+        :param name_prefix: if provided, only rules with a name starting with it are iterated
+        :return: generator of (rule name, rule) pairs, with the rule content described at get_of_rules
+                 Raise a openflowconnUnexpectedResponse expection in case of failure
+        """
+        of_response = None
+        try:
+            of_response = self._get_of_rules_response()
+            if of_response is None:
+                return
 
-            for flow in flow_list:
+            for flow in openflow_conn.iter_json(of_response, "flows.item"):
+                if name_prefix and not ('id' in flow and flow['id'].startswith(name_prefix)):
+                    continue
                 if not ('id' in flow and 'selector' in flow and 'treatment' in flow and \
                                     'instructions' in flow['treatment'] and 'criteria' in \
                                     flow['selector']):
@@ -306,8 +307,7 @@ class OF_conn(openflow_conn.OpenflowConn):
                         actions.append( ('vlan', instruction['vlanId']) )
 
                 rule['actions'] = actions
-                rules[flow['id']] = dict(rule)
-            return rules
+                yield flow['id'], dict(rule)
 
         except requests.exceptions.RequestException as e:
             # ValueError in the case that JSON can not be decoded
@@ -319,6 +319,38 @@ class OF_conn(openflow_conn.OpenflowConn):
             error_text = type(e).__name__ + ": " + str(e)
             self.logger.error("get_of_rules " + error_text)
             raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        finally:
+            if of_response is not None:
+                of_response.close()
+
+    def get_of_rule_names(self, name_prefix=None):
+        """
+        Obtain the names of the rules inserted at openflow controller, without translating their content
+        :param name_prefix: if provided, only rules with a name starting with it are returned
+        :return: set of rule names
+                 Raise a openflowconnUnexpectedResponse expection in case of failure
+        """
+        of_response = None
+        try:
+            of_response = self._get_of_rules_response()
+            if of_response is None:
+                return set()
+            return set(name for name in openflow_conn.iter_json(of_response, "flows.item.id")
+                       if not name_prefix or name.startswith(name_prefix))
+
+        except requests.exceptions.RequestException as e:
+            # ValueError in the case that JSON can not be decoded
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("get_of_rule_names " + error_text)
+            raise openflow_conn.OpenflowconnConnectionException(error_text)
+        except ValueError as e:
+            # ValueError in the case that JSON can not be decoded
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("get_of_rule_names " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+        finally:
+            if of_response is not None:
+                of_response.close()
 
     def del_flow(self, flow_name):
         """
@@ -329,7 +361,8 @@ class OF_conn(openflow_conn.OpenflowConn):
 
         try:
             self.headers['content-type'] = None
-            of_response = requests.delete(self.url + "flows/" + self.id + "/" + flow_name, headers=self.headers)
+            of_response = self.http_request("DELETE", "del_flow", self.url + "flows/" + self.id + "/" + flow_name,
+                                            headers=self.headers)
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
 
             if of_response.status_code != 204:
@@ -344,6 +377,76 @@ class OF_conn(openflow_conn.OpenflowConn):
             self.logger.error("del_flow " + error_text)
             raise openflow_conn.OpenflowconnConnectionException(error_text)
 
+    def _build_flow(self, data):
+        """
+        Build the dictionary with the flow rule information for ONOS from the generic data
+        :param data: dictionary with the content described at new_flow
+        :return: ONOS flow dictionary. Raise a openflowconnUnexpectedResponse expection if data cannot be translated
+        """
+        if len(self.pp2ofi) == 0:
+            self.obtain_port_correspondence()
+
+        flow = dict()
+        #flow['id'] = data['name']
+        flow['tableId'] = 0
+        flow['priority'] = data.get('priority')
+        flow['timeout'] = 0
+        flow['isPermanent'] = "true"
+        flow['appId'] = 10 # FIXME We should create an appId for OSM
+        flow['selector'] = dict()
+        flow['selector']['criteria'] = list()
+
+        # Flow rule matching criteria
+        if not data['ingress_port'] in self.pp2ofi:
+            error_text = 'Error. Port ' + data['ingress_port'] + ' is not present in the switch'
+            self.logger.warning("new_flow " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+
+        ingress_port_criteria = dict()
+        ingress_port_criteria['type'] = "IN_PORT"
+        ingress_port_criteria['port'] = self.pp2ofi[data['ingress_port']]
+        flow['selector']['criteria'].append(ingress_port_criteria)
+
+        if 'dst_mac' in data:
+            dst_mac_criteria = dict()
+            dst_mac_criteria["type"] = "ETH_DST"
+            dst_mac_criteria["mac"] = data['dst_mac']
+            flow['selector']['criteria'].append(dst_mac_criteria)
+
+        if data.get('vlan_id'):
+            vlan_criteria = dict()
+            vlan_criteria["type"] = "VLAN_VID"
+            vlan_criteria["vlanId"] = int(data['vlan_id'])
+            flow['selector']['criteria'].append(vlan_criteria)
+
+        # Flow rule treatment
+        flow['treatment'] = dict()
+        flow['treatment']['instructions'] = list()
+        flow['treatment']['deferred'] = list()
+
+        for action in data['actions']:
+            new_action = dict()
+            if  action[0] == "vlan":
+                new_action['type'] = "L2MODIFICATION"
+                if action[1] == None:
+                    new_action['subtype'] = "VLAN_POP"
+                else:
+                    new_action['subtype'] = "VLAN_ID"
+                    new_action['vlanId'] = int(action[1])
+            elif action[0] == 'out':
+                new_action['type'] = "OUTPUT"
+                if not action[1] in self.pp2ofi:
+                    error_msj = 'Port '+ action[1] + ' is not present in the switch'
+                    raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
+                new_action['port'] = self.pp2ofi[action[1]]
+            else:
+                error_msj = "Unknown item '%s' in action list" % action[0]
+                self.logger.error("new_flow " + error_msj)
+                raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
+
+            flow['treatment']['instructions'].append(new_action)
+        return flow
+
     def new_flow(self, data):
         """
         Insert a new static rule
@@ -359,74 +462,11 @@ class OF_conn(openflow_conn.OpenflowConn):
         :return: Raise a openflowconnUnexpectedResponse expection in case of failure
         """
         try:
-
-            if len(self.pp2ofi) == 0:
-                self.obtain_port_correspondence()
-
-            # Build the dictionary with the flow rule information for ONOS
-            flow = dict()
-            #flow['id'] = data['name']
-            flow['tableId'] = 0
-            flow['priority'] = data.get('priority')
-            flow['timeout'] = 0
-            flow['isPermanent'] = "true"
-            flow['appId'] = 10 # FIXME We should create an appId for OSM
-            flow['selector'] = dict()
-            flow['selector']['criteria'] = list()
-
-            # Flow rule matching criteria
-            if not data['ingress_port'] in self.pp2ofi:
-                error_text = 'Error. Port ' + data['ingress_port'] + ' is not present in the switch'
-                self.logger.warning("new_flow " + error_text)
-                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
-
-            ingress_port_criteria = dict()
-            ingress_port_criteria['type'] = "IN_PORT"
-            ingress_port_criteria['port'] = self.pp2ofi[data['ingress_port']]
-            flow['selector']['criteria'].append(ingress_port_criteria)
-
-            if 'dst_mac' in data:
-                dst_mac_criteria = dict()
-                dst_mac_criteria["type"] = "ETH_DST"
-                dst_mac_criteria["mac"] = data['dst_mac']
-                flow['selector']['criteria'].append(dst_mac_criteria)
-
-            if data.get('vlan_id'):
-                vlan_criteria = dict()
-                vlan_criteria["type"] = "VLAN_VID"
-                vlan_criteria["vlanId"] = int(data['vlan_id'])
-                flow['selector']['criteria'].append(vlan_criteria)
-
-            # Flow rule treatment
-            flow['treatment'] = dict()
-            flow['treatment']['instructions'] = list()
-            flow['treatment']['deferred'] = list()
-
-            for action in data['actions']:
-                new_action = dict()
-                if  action[0] == "vlan":
-                    new_action['type'] = "L2MODIFICATION"
-                    if action[1] == None:
-                        new_action['subtype'] = "VLAN_POP"
-                    else:
-                        new_action['subtype'] = "VLAN_ID"
-                        new_action['vlanId'] = int(action[1])
-                elif action[0] == 'out':
-                    new_action['type'] = "OUTPUT"
-                    if not action[1] in self.pp2ofi:
-                        error_msj = 'Port '+ action[1] + ' is not present in the switch'
-                        raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
-                    new_action['port'] = self.pp2ofi[action[1]]
-                else:
-                    error_msj = "Unknown item '%s' in action list" % action[0]
-                    self.logger.error("new_flow " + error_msj)
-                    raise openflow_conn.OpenflowconnUnexpectedResponse(error_msj)
-
-                flow['treatment']['instructions'].append(new_action)
+            flow = self._build_flow(data)
 
             self.headers['content-type'] = 'application/json'
             path = self.url + "flows/" + self.id
-            of_response = requests.post(path, headers=self.headers, data=json.dumps(flow) )
+            of_response = self.http_request("POST", "new_flow", path, headers=self.headers, data=json.dumps(flow) )
 
             error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
             if of_response.status_code != 201:
@@ -445,16 +485,94 @@ class OF_conn(openflow_conn.OpenflowConn):
             self.logger.error("new_flow " + error_text)
             raise openflow_conn.OpenflowconnConnectionException(error_text)
 
+    def new_flows(self, flows):
+        """
+        Insert several static rules with a single request to the ONOS flows batch API. ONOS versions without it are
+        served flow by flow
+        :param flows: list of dictionaries with the content described at new_flow. The 'name' of each one is set
+                to the flowId assigned by ONOS
+        :return: Raise a openflowconnUnexpectedResponse expection in case of failure
+        """
+        if not flows:
+            return None
+        try:
+            onos_flows = []
+            for data in flows:
+                flow = self._build_flow(data)
+                flow['deviceId'] = self.id
+                onos_flows.append(flow)
+
+            self.headers['content-type'] = 'application/json'
+            of_response = self.http_request("POST", "new_flows", self.url + "flows", headers=self.headers,
+                                            data=json.dumps({"flows": onos_flows}))
+            error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
+            if of_response.status_code in (404, 405):
+                self.logger.debug("new_flows batch not supported, inserting one by one. " + error_text)
+                return openflow_conn.OpenflowConn.new_flows(self, flows)
+            if of_response.status_code not in (200, 201):
+                self.logger.warning("new_flows " + error_text)
+                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+
+            # flowIds are returned in the same order than the request
+            created = of_response.json().get("flows", ())
+            if len(created) != len(flows):
+                error_text = "Unexpected number of created flows {} of {}. {}".format(len(created), len(flows),
+                                                                                      error_text)
+                self.logger.warning("new_flows " + error_text)
+                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+            for data, flow in zip(flows, created):
+                data['name'] = flow['flowId']
+
+            self.logger.debug("new_flows OK %d flows", len(flows))
+            return None
+
+        except requests.exceptions.RequestException as e:
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("new_flows " + error_text)
+            raise openflow_conn.OpenflowconnConnectionException(error_text)
+        except ValueError as e:
+            # response is not a valid json
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("new_flows " + error_text)
+            raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+
+    def del_flows(self, flow_names):
+        """
+        Delete several existing rules with a single request to the ONOS flows batch API. ONOS versions without it are
+        served flow by flow
+        :param flow_names: list of rule names
+        :return: Raise a openflowconnUnexpectedResponse expection in case of failure
+        """
+        if not flow_names:
+            return None
+        try:
+            sdata = {"flows": [{"deviceId": self.id, "flowId": flow_name} for flow_name in flow_names]}
+            self.headers['content-type'] = 'application/json'
+            of_response = self.http_request("DELETE", "del_flows", self.url + "flows", headers=self.headers,
+                                            data=json.dumps(sdata))
+            error_text = "Openflow response %d: %s" % (of_response.status_code, of_response.text)
+            if of_response.status_code in (404, 405):
+                self.logger.debug("del_flows batch not supported, deleting one by one. " + error_text)
+                return openflow_conn.OpenflowConn.del_flows(self, flow_names)
+            if of_response.status_code not in (200, 204):
+                self.logger.warning("del_flows " + error_text)
+                raise openflow_conn.OpenflowconnUnexpectedResponse(error_text)
+
+            self.logger.debug("del_flows OK %d flows", len(flow_names))
+            return None
+
+        except requests.exceptions.RequestException as e:
+            error_text = type(e).__name__ + ": " + str(e)
+            self.logger.error("del_flows " + error_text)
+            raise openflow_conn.OpenflowconnConnectionException(error_text)
+
     def clear_all_flows(self):
         """
         Delete all existing rules
         :return: Raise a openflowconnUnexpectedResponse expection in case of failure
         """
         try:
-            rules = self.get_of_rules(True)
-
-            for rule in rules:
-                self.del_flow(rule)
+            self.del_flows(list(self.get_of_rule_names()))
 
             self.logger.debug("clear_all_flows OK ")
             return None
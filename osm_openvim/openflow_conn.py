@@ -22,6 +22,17 @@
 ##
 import logging
 import base64
+import time
+import threading
+import collections
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+try:
+    import ijson
+except ImportError:
+    ijson = None    # optional. Without it, json responses are decoded completely before iterating them
+_ijson_warned = False   # missing ijson is logged only once
 
 """
 vimconn implement an Abstract class for the vim connector plugins
@@ -93,6 +104,65 @@ class OpenflowconnNotImplemented(OpenflowconnException):
         OpenflowconnException.__init__(self, message, http_code)
 
 
+def iter_json(response, prefix, key_value=False):
+    """
+    Iterate the elements of a json http response found at a path, decoding it incrementally when ijson is installed,
+    so that the whole response is not kept in memory
+    :param response: requests response, obtained with stream=True
+    :param prefix: path of the elements to iterate, keys separated by '.', and 'item' for each element of a list.
+            E.g. "flows.item" iterates the content of the list at "flows"
+    :param key_value: if True the element at prefix must be a dictionary, and (key, value) pairs of it are iterated
+    :return: generator of elements. Raise ValueError if the response cannot be decoded or has not the expected format;
+        with key_value, elements at prefix that are not a dictionary are skipped instead by ijson kvitems
+    """
+    if ijson:
+        response.raw.decode_content = True
+        try:
+            if not key_value:
+                for item in ijson.items(response.raw, prefix):
+                    yield item
+            elif hasattr(ijson, "kvitems"):
+                for key, value in ijson.kvitems(response.raw, prefix):
+                    yield key, value
+            else:
+                # old ijson versions, the dictionary at prefix is decoded at once
+                for item in ijson.items(response.raw, prefix):
+                    if not isinstance(item, dict):
+                        raise ValueError("Unexpected response at '{}', not a dict".format(prefix))
+                    for key, value in item.iteritems():
+                        yield key, value
+        except ijson.JSONError as e:
+            raise ValueError("Cannot decode json response: " + str(e))
+        return
+
+    global _ijson_warned
+    if not _ijson_warned:
+        _ijson_warned = True
+        logging.getLogger('openflow_conn').warning("python ijson is not installed; controller responses, as the whole "
+                                                   "flow table, are decoded in memory at once")
+    nodes = [response.json()]
+    for key in prefix.split(".") if prefix else ():
+        next_nodes = []
+        for node in nodes:
+            if key == "item":
+                if not isinstance(node, list):
+                    raise ValueError("Unexpected response at '{}', not a list".format(prefix))
+                next_nodes += node
+            elif not isinstance(node, dict):
+                raise ValueError("Unexpected response at '{}', not a dict".format(prefix))
+            elif key in node:
+                next_nodes.append(node[key])
+        nodes = next_nodes
+    for node in nodes:
+        if not key_value:
+            yield node
+            continue
+        if not isinstance(node, dict):
+            raise ValueError("Unexpected response at '{}', not a dict".format(prefix))
+        for key, value in node.iteritems():
+            yield key, value
+
+
 class OpenflowConn:
     """
     Openflow controller connector abstract implementeation.
@@ -112,6 +182,83 @@ class OpenflowConn:
         self.logger = logging.getLogger('openflow_conn')
         self.logger.setLevel(getattr(logging, params.get("of_debug", "ERROR")))
         self.ip_address = None
+        self.session = None
+        self.timeout = None
+        self.http_stats = {}    # latency by endpoint: count, errors, total and max seconds
+        self.http_stats_lock = threading.Lock()
+        self.concurrency = 1    # max concurrent requests to the controller when several flows are inserted/deleted
+        self.assigns_flow_names = False     # True if the controller names the rules instead of using the given name
+
+    def init_session(self, params):
+        """
+        Create the http session shared by all the requests to the controller, that keeps the connections alive
+        :param params: dictionary with the optional parameters:
+                of_timeout:         seconds waiting for a controller response, by default 30
+                of_connect_timeout: seconds waiting for establishing a connection, by default 5
+                of_retries:         retries of the idempotent requests (GET, PUT, DELETE) after a connection
+                                    error or a 502, 503, 504 response, by default 3
+                of_retry_backoff:   backoff factor between retries, the n-th waits backoff*2^(n-1) seconds,
+                                    by default 0.5
+                of_pool_size:       max connections kept alive with the controller, by default 4
+                of_concurrency:     max concurrent requests when several flows are inserted or deleted one by one,
+                                    by default 1
+        :return: None
+        """
+        self.concurrency = params.get("of_concurrency") or 1
+        self.timeout = (params.get("of_connect_timeout") or 5, params.get("of_timeout") or 30)
+        retries = params.get("of_retries", 3)
+        retry_kwargs = {"total": retries, "backoff_factor": params.get("of_retry_backoff", 0.5),
+                        "status_forcelist": (502, 503, 504), "raise_on_status": False}
+        idempotent_methods = frozenset(("HEAD", "GET", "PUT", "DELETE", "OPTIONS"))
+        try:
+            retry = Retry(allowed_methods=idempotent_methods, **retry_kwargs)
+        except TypeError:
+            # urllib3 older than 1.26
+            retry = Retry(method_whitelist=idempotent_methods, **retry_kwargs)
+        pool_size = params.get("of_pool_size") or 4
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def http_request(self, method, endpoint, url, **kwargs):
+        """
+        Send a request to the controller through the shared session, accounting its latency
+        :param method: http method
+        :param endpoint: name used for the latency counters of this kind of request
+        :param url: complete url
+        :param kwargs: other parameters of requests.request, as headers or data
+        :return: requests response. Raise a requests.exceptions.RequestException in case of connection error
+        """
+        if not self.session:
+            self.init_session({})
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        error = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= 500
+            return response
+        finally:
+            elapsed = time.time() - start
+            with self.http_stats_lock:
+                stats = self.http_stats.get(endpoint)
+                if not stats:
+                    stats = self.http_stats[endpoint] = {"count": 0, "errors": 0, "total": 0.0, "max": 0.0}
+                stats["count"] += 1
+                stats["total"] += elapsed
+                if error:
+                    stats["errors"] += 1
+                if elapsed > stats["max"]:
+                    stats["max"] = elapsed
+
+    def get_http_stats(self):
+        """
+        Obtain the latency counters of the requests to the controller
+        :return: dictionary by endpoint with count, errors, total and max seconds
+        """
+        with self.http_stats_lock:
+            return {endpoint: dict(stats) for endpoint, stats in self.http_stats.items()}
 
     def get_of_switches(self):
         """"
@@ -145,6 +292,26 @@ class OpenflowConn:
         """
         raise OpenflowconnNotImplemented("Should have implemented this")
 
+    def iter_of_rules(self, translate_of_ports=True, name_prefix=None):
+        """
+        Iterate the rules inserted at openflow controller. Connectors override it for decoding the controller response
+        while iterating, without building all the rules in memory
+        :param translate_of_ports: if True it translates ports from openflow index to physical switch name
+        :param name_prefix: if provided, only rules with a name starting with it (e.g. a net uuid) are iterated
+        :return: generator of (rule name, rule) pairs, with the rule content described at get_of_rules
+        """
+        for name, rule in self.get_of_rules(translate_of_ports).items():
+            if not name_prefix or name.startswith(name_prefix):
+                yield name, rule
+
+    def get_of_rule_names(self, name_prefix=None):
+        """
+        Obtain the names of the rules inserted at openflow controller, without translating their content
+        :param name_prefix: if provided, only rules with a name starting with it (e.g. a net uuid) are returned
+        :return: set of rule names
+        """
+        return set(name for name, _ in self.iter_of_rules(False, name_prefix))
+
     def del_flow(self, flow_name):
         """
         Delete all existing rules
@@ -169,6 +336,60 @@ class OpenflowConn:
         """
         raise OpenflowconnNotImplemented("Should have implemented this")
 
+    def new_flows(self, flows):
+        """
+        Insert several static rules. Connectors able to push them in a single request to the controller should
+        override it; by default new_flow is called for each one, in order
+        :param flows: list of dictionaries with the content described at new_flow. As in new_flow, the 'name' of
+                each flow can be modified by the connector when the controller assigns it
+        :return: None if ok. Raise an OpenflowconnException at the first failure; the previous flows of the list
+                 may have been inserted
+        """
+        self._run_concurrently(self.new_flow, flows)
+
+    def del_flows(self, flow_names):
+        """
+        Delete several existing rules. Connectors able to delete them in a single request to the controller should
+        override it; by default del_flow is called for each one, in order
+        :param flow_names: list of rule names
+        :return: None if ok. Raise an OpenflowconnException at the first failure; the previous flows of the list
+                 may have been deleted
+        """
+        self._run_concurrently(self.del_flow, flow_names)
+
+    def _run_concurrently(self, function, items):
+        """
+        Call function for each item, with up to self.concurrency requests in progress at the same time. Without
+        concurrency items are processed in order
+        :return: None. Raise the exception of the first failure, after the calls in progress are finished
+        """
+        if self.concurrency <= 1 or len(items) <= 1:
+            for item in items:
+                function(item)
+            return
+        pending = collections.deque(items)
+        errors = []
+
+        def _worker():
+            while not errors:
+                try:
+                    item = pending.popleft()
+                except IndexError:
+                    return
+                try:
+                    function(item)
+                except Exception as e:
+                    errors.append(e)
+
+        workers = [threading.Thread(target=_worker, name="{}-{}".format(self.name, index))
+                   for index in range(0, min(self.concurrency, len(items)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
     def clear_all_flows(self):
         """"
         Delete all existing rules
@@ -30,10 +30,12 @@ __author__="Pablo Montes, Alfonso Tierno"
 __date__ ="17-jul-2015"
 
 
-#import json
+import json
+import os
 import threading
 import time
 import Queue
+import collections
 import requests
 import logging
 import openflow_conn
@@ -89,12 +91,78 @@ def change_db2of(flow):
     flow['actions'] = actions
 
 
+def write_net_status(db, db_lock, net_id, result, content):
+    """Update database net status with the result of an update of its flows"""
+    if result < 0:
+        UPDATE = {'status': 'ERROR', 'last_error': str(content)}
+    else:
+        UPDATE = {'status': 'ACTIVE', 'last_error': None}
+    db_lock.acquire()
+    db.update_rows('nets', UPDATE, WHERE={'uuid': net_id})
+    db_lock.release()
+
+
+class net_update_handle(object):
+    """
+    Combined completion of an update of a net fanned out to several openflow threads, one per controller of the
+    switches the net spans. Each thread reports its result with done(), and the net status is written once all of them
+    have finished
+    """
+    def __init__(self, net_id, ofc_ids, db, db_lock):
+        self.net_id = net_id
+        self.pending = set(ofc_ids)
+        self.errors = {}    # error text by ofc_id
+        self.db = db
+        self.db_lock = db_lock
+        self.lock = threading.Lock()
+
+    def done(self, ofc_id, result, content):
+        """
+        Report the result of one of the openflow threads. The last one writes the combined net status
+        :param ofc_id: openflow controller of the thread
+        :param result: result of update_of_flows, negative on error
+        :param content: error text
+        :return: None
+        """
+        with self.lock:
+            if ofc_id not in self.pending:
+                return
+            self.pending.discard(ofc_id)
+            if result < 0:
+                self.errors[ofc_id] = content
+            finished = not self.pending
+        if finished:
+            result, content = self.get_result()
+            write_net_status(self.db, self.db_lock, self.net_id, result, content)
+
+    def get_result(self):
+        """
+        :return: (0, 'Success') if the net has been updated at all the switches, (-1, error text) otherwise
+        """
+        if self.errors:
+            return -1, "; ".join("ofc {}: {}".format(ofc_id, error) for ofc_id, error in sorted(self.errors.items()))
+        return 0, 'Success'
+
+
 class openflow_thread(threading.Thread):
     """
     This thread interacts with a openflow controller to create dataplane connections
     """
     def __init__(self, of_uuid, of_connector, db, db_lock, of_test, pmp_with_same_vlan=False, logger_name=None,
-                 debug=None):
+                 debug=None, snapshot_period=300, update_debounce=0.5, port_maps_path=None, port_check_period=300,
+                 flows_cache_size=64):
+        """
+        :param snapshot_period: seconds that the cached names of the controller flows are used before downloading
+            again the whole flow table of the controller
+        :param update_debounce: seconds to wait for more 'update-net' tasks after receiving one, so that all the
+            pending updates of the same net, or of nets bound together, are processed as a single one
+        :param port_maps_path: folder where the switch port correspondence (pp2ofi/ofi2pp) is stored, so that it is
+            loaded at start instead of obtained from the controller. None for not storing it
+        :param port_check_period: seconds between checks, done while idle, of the port correspondence against the
+            controller. 0 for not checking it in background
+        :param flows_cache_size: number of computed flow sets kept, by fingerprint of the nets, to be reused while the
+            nets ports do not change. 0 for not caching them
+        """
         threading.Thread.__init__(self)
         self.of_uuid = of_uuid
         self.db = db
@@ -109,14 +177,28 @@ class openflow_thread(threading.Thread):
         self.logger = logging.getLogger(self.logger_name)
         if debug:
             self.logger.setLevel(getattr(logging, debug))
-        self.queueLock = threading.Lock()
         self.taskQueue = Queue.Queue(2000)
+        self.snapshot_period = snapshot_period
+        self.of_flows_snapshot = None   # set with the names of the flows at controller, updated with each change
+        self.of_flows_snapshot_time = 0
+        self.update_debounce = update_debounce
+        self.pending_nets = collections.OrderedDict()  # 'update-net' tasks not processed yet, count by net_id
+        self.pending_handles = {}   # net_update_handle of the pending 'update-net' tasks, list by net_id
+        self.db_ofc_id = None if of_uuid == "Default" else of_uuid  # ofc_id of its flows at database
+        # flows are named <net_id><flow_name_prefix><index>. Threads of other controllers use a different prefix, as
+        # they can be adding flows of the same net at the same time
+        self.flow_name_prefix = "." if self.db_ofc_id is None else "." + self.db_ofc_id[:8] + "."
+        self.update_net_stats = {"tasks": 0, "updates": 0, "merged": 0, "last_merged": 0}
+        self.port_maps_path = port_maps_path
+        self.port_check_period = port_check_period
+        self.port_check_time = 0    # time of the last check of the port correspondence
+        self.flows_cache_size = flows_cache_size
+        self.flows_cache = collections.OrderedDict()    # flows computed by _compute_net_flows, by nets fingerprint
+        self.flows_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
         
     def insert_task(self, task, *aditional):
         try:
-            self.queueLock.acquire()
-            task = self.taskQueue.put( (task,) + aditional, timeout=5) 
-            self.queueLock.release()
+            self.taskQueue.put( (task,) + aditional, timeout=5)
             return 1, None
         except Queue.Full:
             return -1, "timeout inserting a task over openflow thread " + self.of_uuid
@@ -124,43 +206,54 @@ class openflow_thread(threading.Thread):
     def run(self):
         self.logger.debug("Start openflow thread")
         self.set_openflow_controller_status(OFC_STATUS_ACTIVE)
+        self.load_port_maps()
 
+        debounce_deadline = 0
         while True:
             try:
-                self.queueLock.acquire()
-                if not self.taskQueue.empty():
-                    task = self.taskQueue.get()
+                if self.pending_nets:
+                    try:
+                        task = self.taskQueue.get(timeout=max(0, debounce_deadline - time.time()))
+                    except Queue.Empty:
+                        self.update_pending_nets()
+                        continue
+                elif self.port_check_period and not self.test:
+                    try:
+                        task = self.taskQueue.get(
+                            timeout=max(0, self.port_check_time + self.port_check_period - time.time()))
+                    except Queue.Empty:
+                        self.check_port_maps()
+                        continue
                 else:
-                    task = None
-                self.queueLock.release()
-
-                if task is None:
-                    time.sleep(1)
-                    continue
+                    task = self.taskQueue.get()
 
                 if task[0] == 'update-net':
-                    r,c = self.update_of_flows(task[1])
-                    # update database status
-                    if r<0:
-                        UPDATE={'status':'ERROR', 'last_error': str(c)}
-                        self.logger.error("processing task 'update-net' %s: %s", str(task[1]), c)
-                        self.set_openflow_controller_status(OFC_STATUS_ERROR, "Error updating net {}".format(task[1]))
-                    else:
-                        UPDATE={'status':'ACTIVE', 'last_error': None}
-                        self.logger.debug("processing task 'update-net' %s: OK", str(task[1]))
-                        self.set_openflow_controller_status(OFC_STATUS_ACTIVE)
-                    self.db_lock.acquire()
-                    self.db.update_rows('nets', UPDATE, WHERE={'uuid': task[1]})
-                    self.db_lock.release()
+                    # delay it for merging with other updates of the same nets
+                    if not self.pending_nets:
+                        debounce_deadline = time.time() + self.update_debounce
+                    self.pending_nets[task[1]] = self.pending_nets.get(task[1], 0) + 1
+                    if len(task) > 2 and task[2]:
+                        self.pending_handles.setdefault(task[1], []).append(task[2])
+                    continue
+                if self.pending_nets:
+                    # keep the order with other tasks
+                    self.update_pending_nets()
 
-                elif task[0] == 'clear-all':
+                if task[0] == 'clear-all':
                     r,c = self.clear_all_flows()
+                    self.of_flows_snapshot = None
                     if r<0:
                         self.logger.error("processing task 'clear-all': %s", c)
                         self.set_openflow_controller_status(OFC_STATUS_ERROR, "Error deleting all flows")
                     else:
                         self.set_openflow_controller_status(OFC_STATUS_ACTIVE)
                         self.logger.debug("processing task 'clear-all': OK")
+                elif task[0] == 'reconcile':
+                    r, c = self.reconcile_of_flows(task[1])
+                    if r < 0:
+                        self.logger.error("processing task 'reconcile': %s", c)
+                    if len(task) > 2 and task[2]:
+                        task[2].put((self.of_uuid, r, c))
                 elif task[0] == 'exit':
                     self.logger.debug("exit from openflow_thread")
                     self.terminate()
@@ -174,11 +267,152 @@ class openflow_thread(threading.Thread):
             except Exception as e:
                 self.logger.critical("Unexpected exception at run: " + str(e), exc_info=True)
 
+    def _get_port_maps_file(self):
+        dpid = str(self.OF_connector.dpid).replace(":", "")
+        return os.path.join(self.port_maps_path, "of_ports_{}_{}.json".format(self.of_uuid, dpid))
+
+    def load_port_maps(self):
+        """
+        Load the stored port correspondence of the switch into the connector, if it has not been obtained yet. It will
+        be checked against the controller in background
+        :return: True if loaded, False otherwise
+        """
+        if not self.port_maps_path or self.test or self.OF_connector.pp2ofi:
+            return False
+        try:
+            with open(self._get_port_maps_file()) as f:
+                port_maps = json.load(f)
+            # stored as lists of pairs to keep the type of the keys
+            pp2ofi = {str(pp): ofi for pp, ofi in port_maps["pp2ofi"]}
+            ofi2pp = {ofi: str(pp) for ofi, pp in port_maps["ofi2pp"]}
+        except IOError as e:
+            self.logger.debug("port correspondence not loaded: %s", str(e))
+            return False
+        except (ValueError, KeyError, TypeError) as e:
+            self.logger.error("port correspondence file '%s' has a wrong format: %s", self._get_port_maps_file(),
+                              str(e))
+            return False
+        # avoid json unicode values, the connectors work with str
+        self.OF_connector.pp2ofi = {pp: str(ofi) if isinstance(ofi, unicode) else ofi for pp, ofi in pp2ofi.items()}
+        self.OF_connector.ofi2pp = {str(ofi) if isinstance(ofi, unicode) else ofi: pp for ofi, pp in ofi2pp.items()}
+        self.logger.debug("port correspondence loaded with %d ports", len(pp2ofi))
+        return True
+
+    def save_port_maps(self):
+        """
+        Store the port correspondence of the connector
+        :return: None
+        """
+        if not self.port_maps_path or self.test:
+            return
+        file_name = self._get_port_maps_file()
+        try:
+            port_maps = {"pp2ofi": self.OF_connector.pp2ofi.items(), "ofi2pp": self.OF_connector.ofi2pp.items()}
+            with open(file_name + ".tmp", "w") as f:
+                json.dump(port_maps, f)
+            os.rename(file_name + ".tmp", file_name)
+        except (IOError, OSError) as e:
+            self.logger.error("cannot store port correspondence at '%s': %s", file_name, str(e))
+
+    def check_port_maps(self):
+        """
+        Obtain the port correspondence from the controller and compare it with the used one. When the switch reports
+        changes, the connector maps are replaced and stored, and the controller flows are downloaded again next time,
+        as they are translated with these maps
+        :return: True if port correspondence has changed, False otherwise
+        """
+        self.port_check_time = time.time()
+        old_pp2ofi = self.OF_connector.pp2ofi
+        old_ofi2pp = self.OF_connector.ofi2pp
+        self.OF_connector.pp2ofi = {}
+        self.OF_connector.ofi2pp = {}
+        try:
+            self.OF_connector.obtain_port_correspondence()
+        except openflow_conn.OpenflowconnException as e:
+            self.OF_connector.pp2ofi = old_pp2ofi
+            self.OF_connector.ofi2pp = old_ofi2pp
+            self.logger.warning("cannot check port correspondence: %s", str(e))
+            return False
+        if self.OF_connector.pp2ofi == old_pp2ofi and self.OF_connector.ofi2pp == old_ofi2pp:
+            # keep the same objects, that can be in use by other threads
+            self.OF_connector.pp2ofi = old_pp2ofi
+            self.OF_connector.ofi2pp = old_ofi2pp
+            if self.port_maps_path and not os.path.exists(self._get_port_maps_file()):
+                self.save_port_maps()
+            return False
+        if old_pp2ofi:
+            added = set(self.OF_connector.pp2ofi.items()) - set(old_pp2ofi.items())
+            removed = set(old_pp2ofi.items()) - set(self.OF_connector.pp2ofi.items())
+            self.logger.info("switch port correspondence changed. New: %s. Removed: %s",
+                             ", ".join("{}={}".format(*port) for port in sorted(added)) or "none",
+                             ", ".join("{}={}".format(*port) for port in sorted(removed)) or "none")
+        self.of_flows_snapshot = None
+        self.flows_cache.clear()    # computed with the switch ports validated against the old correspondence
+        self.save_port_maps()
+        return True
+
     def terminate(self):
         pass
         # print self.name, ": exit from openflow_thread"
 
-    def update_of_flows(self, net_id):
+    def update_pending_nets(self):
+        """
+        Process the pending 'update-net' tasks. Repeated tasks for a net, or for nets bound together, that share the
+        flows computation, are merged into a single update_of_flows
+        """
+        pending_nets = self.pending_nets
+        pending_handles = self.pending_handles
+        self.pending_nets = collections.OrderedDict()
+        self.pending_handles = {}
+        updated = set()
+        for net_id in pending_nets:
+            if net_id in updated:
+                continue
+            group_nets = []
+            try:
+                r, c = self.update_of_flows(net_id, group_nets)
+            except Exception as e:
+                # every merged task must get a result, or its net status and handles would never be set
+                self.logger.critical("Unexpected exception at update_of_flows: " + str(e), exc_info=True)
+                r, c = -1, "Unexpected exception: " + str(e)
+            group = [n for n in pending_nets if n == net_id or (n in group_nets and n not in updated)]
+            updated.update(group)
+            tasks = sum(pending_nets[n] for n in group)
+            self.update_net_stats["tasks"] += tasks
+            self.update_net_stats["updates"] += 1
+            self.update_net_stats["merged"] += tasks - 1
+            self.update_net_stats["last_merged"] = tasks - 1
+            if tasks > 1:
+                self.logger.debug("processing task 'update-net' %s merged %d tasks", ",".join(group), tasks)
+            for group_net_id in group:
+                self._set_net_status(group_net_id, r, c, pending_handles.get(group_net_id))
+
+    def _set_net_status(self, net_id, result, content, handles=None):
+        """
+        Update database net status with the result of update_of_flows. When the update was fanned out to several
+        openflow threads, the result is reported to its handles instead, that write the status once all have finished
+        """
+        if result<0:
+            self.logger.error("processing task 'update-net' %s: %s", str(net_id), content)
+            self.set_openflow_controller_status(OFC_STATUS_ERROR, "Error updating net {}".format(net_id))
+        else:
+            self.logger.debug("processing task 'update-net' %s: OK", str(net_id))
+            self.set_openflow_controller_status(OFC_STATUS_ACTIVE)
+        if handles:
+            for handle in handles:
+                handle.done(self.of_uuid, result, content)
+        else:
+            write_net_status(self.db, self.db_lock, net_id, result, content)
+
+    def update_of_flows(self, net_id, updated_nets=None, planned_flows=None):
+        """
+        Compute and install at the controller the flows of a net and all the nets bound with it
+        :param net_id: net uuid
+        :param updated_nets: if a list is provided, it is filled with the uuids of the nets whose flows are updated
+        :param planned_flows: if a list is provided, the flows are only computed and appended to it, without reading
+            nor changing the controller and the database flows
+        :return: (0, 'Success') or (negative, error text)
+        """
         ports=()
         self.db_lock.acquire()
         select_= ('type','admin_state_up', 'vlan', 'provider', 'bind_net','bind_type','uuid')
@@ -196,6 +430,8 @@ class openflow_thread(threading.Thread):
         self.db_lock.release()
         if result < 0:
             return -1, "DB error getting net: " + nets
+        if updated_nets is not None:
+            updated_nets.extend(net["uuid"] for net in nets)
         #elif result==0:
             #net has been deleted
         ifaces_nb = 0
@@ -208,7 +444,7 @@ class openflow_thread(threading.Thread):
                 self.db_lock.acquire()
                 nb_ports, net_ports = self.db.get_table(
                         FROM='ports',
-                        SELECT=('switch_port','vlan','uuid','mac','type','model'),
+                        SELECT=('switch_port','vlan','uuid','mac','type','model','ofc_id'),
                         WHERE={'net_id':net_id, 'admin_state_up':'true', 'status':'ACTIVE'} )
                 self.db_lock.release()
                 if nb_ports < 0:
@@ -231,6 +467,8 @@ class openflow_thread(threading.Thread):
                 net['ports'] = net_ports
                 ifaces_nb += nb_ports
         
+            if planned_flows is not None:
+                continue
             # Get the name of flows that will be affected by this NET 
             self.db_lock.acquire()
             result, database_net_flows = self.db.get_table(FROM='of_flows', WHERE={'net_id':net_id})
@@ -241,22 +479,25 @@ class openflow_thread(threading.Thread):
                 return -1, error_msg
             database_flows += database_net_flows
         # Get the name of flows where net_id==NULL that means net deleted (At DB foreign key: On delete set null)
-        self.db_lock.acquire()
-        result, database_net_flows = self.db.get_table(FROM='of_flows', WHERE={'net_id':None})
-        self.db_lock.release()
-        if result < 0:
-            error_msg = "DB error getting flows from net 'null': {}".format(database_net_flows)
-            # print self.name, ": update_of_flows() ERROR getting flows from database", database_flows
-            return -1, error_msg
-        database_flows += database_net_flows
+        if planned_flows is None:
+            self.db_lock.acquire()
+            result, database_net_flows = self.db.get_table(FROM='of_flows', WHERE={'net_id':None})
+            self.db_lock.release()
+            if result < 0:
+                error_msg = "DB error getting flows from net 'null': {}".format(database_net_flows)
+                # print self.name, ": update_of_flows() ERROR getting flows from database", database_flows
+                return -1, error_msg
+            database_flows += database_net_flows
 
-        # Get the existing flows at openflow controller
-        try:
-            of_flows = self.OF_connector.get_of_rules()
-            # print self.name, ": update_of_flows() ERROR getting flows from controller", of_flows
-        except openflow_conn.OpenflowconnException as e:
-            # self.set_openflow_controller_status(OFC_STATUS_ERROR, "OF error {} getting flows".format(str(e)))
-            return -1, "OF error {} getting flows".format(str(e))
+        # When the nets span switches of several controllers, each openflow thread computes the flows of its switch
+        net_ofcs = set(port.get('ofc_id') for net in nets for port in net['ports'] if port['type'] != 'external')
+        multi_ofc = len(net_ofcs) > 1
+        if multi_ofc:
+            ifaces_nb = 0
+            for net in nets:
+                net['ports'] = tuple(port for port in net['ports']
+                                     if self._owns_port(port, offline=planned_flows is not None))
+                ifaces_nb += len(net['ports'])
 
         if ifaces_nb < 2:
             pass
@@ -307,43 +548,177 @@ class openflow_thread(threading.Thread):
             return -1, 'Only ptp and data networks are supported for openflow'
             
         # calculate new flows to be inserted
-        result, new_flows = self._compute_net_flows(nets)
+        if planned_flows is not None:
+            result, new_flows = self._compute_net_flows(nets, offline=True)
+            if result < 0:
+                return result, new_flows
+            planned_flows.extend(new_flows)
+            return 0, 'Success'
+        result, new_flows = self._get_net_flows(nets)
         if result < 0:
             return result, new_flows
 
-        #modify database flows format and get the used names
-        used_names=[]
+        # Get the existing flows at openflow controller
+        try:
+            of_flows = self._get_of_flows_snapshot()
+            # print self.name, ": update_of_flows() ERROR getting flows from controller", of_flows
+        except openflow_conn.OpenflowconnException as e:
+            # self.set_openflow_controller_status(OFC_STATUS_ERROR, "OF error {} getting flows".format(str(e)))
+            return -1, "OF error {} getting flows".format(str(e))
+        # names of all flows, also of other controllers, must not be reused
+        used_names = set(flow['name'] for flow in database_flows)
+        database_flows = [flow for flow in database_flows if self._owns_flow(flow, of_flows, multi_ofc)]
+
+        #modify database flows format
+        valid_database_flows = []
+        wrong_database_flows = []
         for flow in database_flows:
             try:
                 change_db2of(flow)
             except FlowBadFormat as e:
                 self.logger.error("Exception FlowBadFormat: '%s', flow: '%s'",str(e), str(flow))
+                wrong_database_flows.append(flow)
                 continue
-            used_names.append(flow['name'])
+            valid_database_flows.append(flow)
+        flows_to_add, flows_to_keep, flows_to_delete = self._diff_flows(new_flows, valid_database_flows)
+        flows_to_delete += wrong_database_flows
+        self.logger.debug("update_of_flows net '%s': %d flows to add, %d to keep, %d to delete", net_id,
+                          len(flows_to_add), len(flows_to_keep), len(flows_to_delete))
+
         name_index=0
-        # insert at database the new flows, change actions to human text
-        for flow in new_flows:
-            # 1 check if an equal flow is already present
-            index = self._check_flow_already_present(flow, database_flows)
-            if index>=0:
-                database_flows[index]["not delete"]=True
-                self.logger.debug("Skipping already present flow %s", str(flow))
-                continue
-            # 2 look for a non used name
-            flow_name=flow["net_id"]+"."+str(name_index)
-            while flow_name in used_names or flow_name in of_flows:         
-                name_index += 1   
-                flow_name=flow["net_id"]+"."+str(name_index)
-            used_names.append(flow_name)
+        # look for a non used name for the new flows
+        name_prefix = self.flow_name_prefix
+        for flow in flows_to_add:
+            flow_name=flow["net_id"]+name_prefix+str(name_index)
+            while flow_name in used_names or flow_name in of_flows:
+                name_index += 1
+                flow_name=flow["net_id"]+name_prefix+str(name_index)
+            used_names.add(flow_name)
             flow['name'] = flow_name
-            # 3 insert at openflow
+            if self.db_ofc_id:
+                flow['ofc_id'] = self.db_ofc_id
 
+        # insert at openflow, in one batch, the new flows and the needed flows at DDBB not present in controller
+        flows_to_reinsert = [flow for flow in flows_to_keep if flow["name"] not in of_flows]
+        reinsert_names = [flow["name"] for flow in flows_to_reinsert]
+        flows_to_push = flows_to_add + flows_to_reinsert
+        if flows_to_push:
             try:
-                self.OF_connector.new_flow(flow)
+                self.OF_connector.new_flows(flows_to_push)
             except openflow_conn.OpenflowconnException as e:
+                self._rename_db_flows(flows_to_reinsert, reinsert_names)
+                self.of_flows_snapshot = None   # controller content unknown, download it next time
+                # flows inserted before the failure are stored at database, so that they are not left orphan
+                try:
+                    of_flows = self._get_of_flows_snapshot()
+                except openflow_conn.OpenflowconnException:
+                    of_flows = ()
+                self._insert_db_flows([flow for flow in flows_to_add if flow["name"] in of_flows])
                 return -1, "Error creating new flow {}".format(str(e))
+            of_flows.update(flow['name'] for flow in flows_to_push)
+            self._rename_db_flows(flows_to_reinsert, reinsert_names)
+
+        # insert at database the new flows, change actions to human text
+        result, content = self._insert_db_flows(flows_to_add)
+        if result < 0:
+            return result, content
+
+        #delete not needed old flows from openflow and from DDBB
+        flows_to_delete_of = [flow['name'] for flow in flows_to_delete if flow["name"] in of_flows]
+        if flows_to_delete_of:
+            try:
+                self.OF_connector.del_flows(flows_to_delete_of)
+                of_flows.difference_update(flows_to_delete_of)
+            except openflow_conn.OpenflowconnException as e:
+                self.logger.error("cannot delete flows '%s' from OF: %s", ",".join(flows_to_delete_of), str(e))
+                self.of_flows_snapshot = None
+                # skip deletion from database of the flows that are still present at controller
+                try:
+                    of_flows = self._get_of_flows_snapshot()
+                except openflow_conn.OpenflowconnException:
+                    of_flows = set(flows_to_delete_of)
+        for flow in flows_to_delete:
+            if flow["name"] in of_flows:
+                continue
+            # delete from database
+            self.db_lock.acquire()
+            result, content = self.db.delete_row_by_key('of_flows', 'id', flow['id'])
+            self.db_lock.release()
+            if result<0:
+                self.logger.error("cannot delete flow '%s' from DB: %s", flow['name'], content )
+        
+        return 0, 'Success'
+
+    def _owns_port(self, port, offline=False):
+        """
+        Check if a port of a net that spans switches of several controllers is at the switch of this thread. External
+        ports without controller, as the one of an 'openflow:' provider binding, are looked for at the switch ports
+        :param port: port with 'type', 'switch_port' and 'ofc_id'
+        :param offline: if True, the port correspondence is not obtained from the controller when not known
+        :return: True or False
+        """
+        if port['type'] != 'external' or port.get('ofc_id') is not None:
+            return port.get('ofc_id') == self.db_ofc_id
+        if self._is_switch_port(port['switch_port'], offline):
+            return True
+        self.logger.debug("external port '%s' switch port '%s' is not at this switch", port['uuid'],
+                          port['switch_port'])
+        return False
+
+    def _is_switch_port(self, switch_port, offline=False):
+        """
+        Check if a switch port is at the switch of this thread. The port correspondence is obtained from the controller
+        if not known yet. Without controller, in test mode, all the ports are of the Default thread
+        :param switch_port: physical port name
+        :param offline: if True, the controller is not contacted, and only the known port correspondence is used. For
+            calls from other threads, as the flows plan, that must not change the connector maps
+        :return: True or False
+        """
+        if self.test:
+            return self.db_ofc_id is None
+        if not self.OF_connector.pp2ofi and not offline:
+            self.check_port_maps()
+        return str(switch_port) in self.OF_connector.pp2ofi
+
+    def _owns_flow(self, flow, of_flows, multi_ofc):
+        """
+        Check if a database flow belongs to the controller of this thread
+        :param flow: database flow
+        :param of_flows: names of the flows at the controller
+        :param multi_ofc: True if the net of the flow spans switches of several controllers, or it is not known
+        :return: True or False
+        """
+        ofc_id = flow.get('ofc_id')
+        if ofc_id is not None:
+            return ofc_id == self.db_ofc_id
+        # flow stored without controller, by the Default thread or before they were recorded. It can be of any
+        # controller, so it is owned if present at this controller or if its ingress port is at this switch
+        return flow['name'] in of_flows or (not multi_ofc and flow['net_id'] is not None) or \
+            self._is_switch_port(flow['ingress_port'])
 
-            # 4 insert at database
+    def _rename_db_flows(self, flows, names):
+        """
+        Update at database the name of the flows that the controller renamed when inserted again, as ONOS that names
+        each rule with the flowId it assigns. Otherwise the database would keep the name of a rule that does not exist
+        :param flows: database flows, with 'id', after being inserted at controller
+        :param names: names of the flows before being inserted, in the same order
+        """
+        for flow, name in zip(flows, names):
+            if flow['name'] == name:
+                continue
+            self.db_lock.acquire()
+            result, content = self.db.update_rows('of_flows', {'name': flow['name']}, WHERE={'id': flow['id']})
+            self.db_lock.release()
+            if result < 0:
+                self.logger.error("cannot rename flow '%s' to '%s' at DB: %s", name, flow['name'], content)
+
+    def _insert_db_flows(self, flows):
+        """
+        Insert at database the flows already inserted at controller, changing actions to human text
+        :param flows: list of flows
+        :return: (0, None) or (negative, error text) at the first failure
+        """
+        for flow in flows:
             try:
                 change_of2db(flow)
             except FlowBadFormat as e:
@@ -355,36 +730,21 @@ class openflow_thread(threading.Thread):
             if result < 0:
                 # print self.name, ": Error '%s' at database insertion" % content, flow
                 return -1, content
+        return 0, None
 
-        #delete not needed old flows from openflow and from DDBB, 
-        #check that the needed flows at DDBB are present in controller or insert them otherwise
-        for flow in database_flows:
-            if "not delete" in flow:
-                if flow["name"] not in of_flows:
-                    # not in controller, insert it
-                    try:
-                        self.OF_connector.new_flow(flow)
-                    except openflow_conn.OpenflowconnException as e:
-                        return -1, "Error creating new flow {}".format(str(e))
-
-                continue
-            # Delete flow
-            if flow["name"] in of_flows:
-                try:
-                    self.OF_connector.del_flow(flow['name'])
-                except openflow_conn.OpenflowconnException as e:
-                    self.logger.error("cannot delete flow '%s' from OF: %s", flow['name'], str(e))
-                    # skip deletion from database
-                    continue
-
-            # delete from database
-            self.db_lock.acquire()
-            result, content = self.db.delete_row_by_key('of_flows', 'id', flow['id'])
-            self.db_lock.release()
-            if result<0:
-                self.logger.error("cannot delete flow '%s' from DB: %s", flow['name'], content )
-        
-        return 0, 'Success'
+    def _get_of_flows_snapshot(self):
+        """
+        Obtain the names of the flows present at the controller. The whole flow table is downloaded only the first
+        time, after an error, or when older than snapshot_period; otherwise the cached snapshot, that is updated with
+        every flow inserted or deleted by this thread, is used
+        :return: set of flow names. It is the cached snapshot, so changes must be reflected on it
+        :raise: OpenflowconnException
+        """
+        now = time.time()
+        if self.of_flows_snapshot is None or now - self.of_flows_snapshot_time > self.snapshot_period:
+            self.of_flows_snapshot = self.OF_connector.get_of_rule_names()
+            self.of_flows_snapshot_time = now
+        return self.of_flows_snapshot
 
     def clear_all_flows(self):
         try:
@@ -399,27 +759,209 @@ class openflow_thread(threading.Thread):
         except openflow_conn.OpenflowconnException as e:
             return -1, self.logger.error("Error deleting all flows {}", str(e))
 
-    flow_fields = ('priority', 'vlan', 'ingress_port', 'actions', 'dst_mac', 'src_mac', 'net_id')
-
-    def _check_flow_already_present(self, new_flow, flow_list):
-        '''check if the same flow is already present in the flow list
-        The flow is repeated if all the fields, apart from name, are equal
-        Return the index of matching flow, -1 if not match'''
-        index=0
-        for flow in flow_list:
-            equal=True
-            for f in self.flow_fields:
-                if flow.get(f) != new_flow.get(f):
-                    equal=False
-                    break
-            if equal:
-                return index
-            index += 1
-        return -1
-        
-    def _compute_net_flows(self, nets):
+    def _is_own_flow_name(self, name):
+        """Check if a controller rule name follows the naming of the flows created by this thread. Rules named by the
+        controller, as ONOS does, cannot be told apart from the rules of other applications, so they are never own"""
+        if getattr(self.OF_connector, "assigns_flow_names", False):
+            return False
+        index = name[36 + len(self.flow_name_prefix):]
+        return name[36:36 + len(self.flow_name_prefix)] == self.flow_name_prefix and index.isdigit()
+
+    reconcile_fields = ('priority', 'vlan_id', 'ingress_port', 'dst_mac', 'actions')
+
+    @staticmethod
+    def rule_key(rule):
+        """
+        Hashable key of the match and actions of a flow, with values as text, so that database flows and controller
+        rules can be compared. actions must be in openflow format (list of tuples)
+        """
+        key = []
+        for f in openflow_thread.reconcile_fields:
+            value = rule.get(f)
+            if f == 'actions':
+                value = tuple((str(action[0]), None if action[1] is None else str(action[1]))
+                              for action in value or ())
+            elif f == 'dst_mac' and value:
+                value = str(value).lower()
+            elif value is not None:
+                value = str(value)
+            key.append(value)
+        return tuple(key)
+
+    def reconcile_of_flows(self, dry_run=True):
+        """
+        Compare the flows of this controller at database with the rules present at controller, and unless dry_run,
+        fix the differences: flows missing or changed at controller are inserted again, and rules named as created by
+        this thread that are not at database are deleted. Flows of deleted nets (net_id NULL), whose deletion from
+        controller failed, are deleted from controller and database. Other rules of the controller are not touched.
+        For controllers that assign the rule names, the database flows inserted again are renamed, and rules that are
+        not at database are never deleted, as it is not known if they were created by this thread
+        :param dry_run: if True, only the differences are reported
+        :return: (0, dictionary with the flow names to 'add', 'modify' and 'delete', the database flows with 'wrong'
+            format, and the 'seconds' used) or (negative, error text)
+        """
+        start = time.time()
+        try:
+            of_rules = dict(self.OF_connector.iter_of_rules())
+        except openflow_conn.OpenflowconnException as e:
+            return -1, "OF error {} getting flows".format(str(e))
+        self.db_lock.acquire()
+        result, database_flows = self.db.get_table(FROM='of_flows')
+        self.db_lock.release()
+        if result < 0:
+            return -1, "DB error getting flows: {}".format(database_flows)
+
+        database_names = set()
+        flows_to_add = []
+        flows_to_modify = []
+        wrong_flows = []
+        deleted_net_flows = []
+        for flow in database_flows:
+            database_names.add(flow['name'])
+            of_rule = of_rules.get(flow['name'])
+            if not self._owns_flow(flow, of_rules, True):
+                continue    # of other controller
+            if flow['net_id'] is None:
+                deleted_net_flows.append(flow)
+                continue
+            try:
+                change_db2of(flow)
+            except FlowBadFormat as e:
+                self.logger.error("Exception FlowBadFormat: '%s', flow: '%s'", str(e), str(flow))
+                wrong_flows.append(flow['name'])
+                continue
+            if of_rule is None:
+                flows_to_add.append(flow)
+            elif self.rule_key(of_rule) != self.rule_key(flow):
+                flows_to_modify.append(flow)
+        names_to_delete = [name for name in of_rules if name not in database_names and self._is_own_flow_name(name)]
+        names_to_delete += [flow['name'] for flow in deleted_net_flows if flow['name'] in of_rules]
+        self.logger.debug("reconcile_of_flows: %d flows to add, %d to modify, %d to delete", len(flows_to_add),
+                          len(flows_to_modify), len(names_to_delete))
+
+        if not dry_run and (flows_to_add or flows_to_modify or names_to_delete):
+            self.of_flows_snapshot = None
+            flows_to_push = flows_to_add + flows_to_modify
+            names = [flow['name'] for flow in flows_to_push]
+            try:
+                if names_to_delete or flows_to_modify:
+                    self.OF_connector.del_flows(names_to_delete + [flow['name'] for flow in flows_to_modify])
+                if flows_to_push:
+                    self.OF_connector.new_flows(flows_to_push)
+            except openflow_conn.OpenflowconnException as e:
+                self._rename_db_flows(flows_to_push, names)
+                return -1, "OF error {} fixing flows".format(str(e))
+            self._rename_db_flows(flows_to_push, names)
+        if not dry_run:
+            for flow in deleted_net_flows:
+                self.db_lock.acquire()
+                result, content = self.db.delete_row_by_key('of_flows', 'id', flow['id'])
+                self.db_lock.release()
+                if result < 0:
+                    self.logger.error("cannot delete flow '%s' from DB: %s", flow['name'], content)
+        return 0, {"dry_run": dry_run,
+                   "add": [flow['name'] for flow in flows_to_add],
+                   "modify": [flow['name'] for flow in flows_to_modify],
+                   "delete": names_to_delete,
+                   "wrong": wrong_flows,
+                   "seconds": time.time() - start}
+
+    flow_fields = ('priority', 'vlan_id', 'ingress_port', 'actions', 'dst_mac', 'src_mac', 'net_id')
+
+    @staticmethod
+    def flow_key(flow):
+        """
+        Canonical hashable key of a flow, built with the flow_fields, so that two flows are equal if all the fields,
+        apart from name, are equal. actions must be in openflow format (list of tuples). The match vlan is compared as
+        text, as computed flows have it as text and database flows as integer
+        """
+        key = []
+        for f in openflow_thread.flow_fields:
+            value = flow.get(f)
+            if f == 'actions' and value is not None:
+                value = tuple(tuple(action) for action in value)
+            elif f == 'vlan_id' and value is not None:
+                value = str(value)
+            key.append(value)
+        return tuple(key)
+
+    def _diff_flows(self, new_flows, database_flows):
+        """
+        Compare the flows needed by a net with the flows at database
+        :param new_flows: list of computed flows
+        :param database_flows: list of flows at database, in openflow format
+        :return: (flows_to_add, flows_to_keep, flows_to_delete): new flows not present at database, database flows that
+            are still needed and database flows not needed anymore
+        """
+        database_by_key = {}
+        for flow in database_flows:
+            database_by_key.setdefault(self.flow_key(flow), flow)
+        flows_to_add = []
+        kept_ids = set()
+        for flow in new_flows:
+            database_flow = database_by_key.get(self.flow_key(flow))
+            if database_flow is not None:
+                kept_ids.add(id(database_flow))
+                self.logger.debug("Skipping already present flow %s", str(flow))
+            else:
+                flows_to_add.append(flow)
+        flows_to_keep = [flow for flow in database_flows if id(flow) in kept_ids]
+        flows_to_delete = [flow for flow in database_flows if id(flow) not in kept_ids]
+        return flows_to_add, flows_to_keep, flows_to_delete
+
+    def _net_flows_fingerprint(self, nets):
+        """
+        Hashable fingerprint of all the input of _compute_net_flows: the nets with their bindings and the ordered
+        fields of their ports. Other changes of the nets or ports, as names, do not modify it
+        """
+        return (self.pmp_with_same_vlan,) + tuple(
+            (net['uuid'], net.get('bind_net'), net.get('bind_type'),
+             tuple((port['uuid'], str(port['switch_port']), port['vlan'], port['mac'], port.get('model'))
+                   for port in net['ports']))
+            for net in nets)
+
+    def _get_net_flows(self, nets):
+        """
+        Same as _compute_net_flows, but reusing the flows computed before for the same nets fingerprint. A copy of the
+        cached flows is returned, as they are modified by the caller
+        :param nets: list of nets, with their 'ports'
+        :return: (0, list of flows) or (negative, error text)
+        """
+        if not self.flows_cache_size:
+            return self._compute_net_flows(nets)
+        fingerprint = self._net_flows_fingerprint(nets)
+        flows = self.flows_cache.pop(fingerprint, None)
+        if flows is not None:
+            self.flows_cache_stats["hits"] += 1
+        else:
+            self.flows_cache_stats["misses"] += 1
+            result, flows = self._compute_net_flows(nets)
+            if result < 0:
+                return result, flows
+            while len(self.flows_cache) >= self.flows_cache_size:
+                self.flows_cache.popitem(last=False)
+                self.flows_cache_stats["evictions"] += 1
+        self.flows_cache[fingerprint] = flows  # inserted as the most recently used
+        return 0, [dict(flow, actions=list(flow['actions'])) for flow in flows]
+
+    def get_flows_cache_stats(self):
+        """Return a dictionary with the computed flows cache usage: size, hits, misses, evictions"""
+        stats = self.flows_cache_stats.copy()
+        stats["size"] = len(self.flows_cache)
+        return stats
+
+    def _compute_net_flows(self, nets, offline=False):
+        """
+        Compute the flows needed by a group of bound nets. Repeated flows are detected with the hashed flow_key, and
+        the port fields are prepared once, so that it grows with the square of the number of ports
+        :param nets: list of nets, with their 'ports'
+        :param offline: if True, unknown switch ports are not looked for at the controller
+        :return: (0, list of flows) or (negative, error text)
+        """
         new_flows=[]
+        new_flows_keys = set()  # flow_key of new_flows
         new_broadcast_flows={}
+        broadcast_outs = {}     # (vlan, port) outputs of each broadcast flow, by broadcast key
         nb_ports = 0
 
         # Check switch_port information is right
@@ -427,11 +969,20 @@ class openflow_thread(threading.Thread):
         for net in nets:
             for port in net['ports']:
                 nb_ports += 1
-                if not self.test and str(port['switch_port']) not in self.OF_connector.pp2ofi:
+                if not self.test and str(port['switch_port']) not in self.OF_connector.pp2ofi and \
+                        not (not offline and self.check_port_maps() and str(port['switch_port']) in self.OF_connector.pp2ofi):
+                    # not found, neither after looking for changes of the switch ports
                     error_text= "switch port name '%s' is not valid for the openflow controller" % str(port['switch_port'])
                     # print self.name, ": ERROR " + error_text
                     return -1, error_text
 
+        # per port tuples (uuid, vlan, switch_port, mac) with the values as used at the flows
+        net_ports = {}
+        for net in nets:
+            net_ports[net['uuid']] = [(port['uuid'], port['vlan'], str(port['switch_port']),
+                                       str(port['mac']) if port['mac'] is not None else None)
+                                      for port in net['ports']]
+
         for net_src in nets:
             net_id = net_src["uuid"]
             for net_dst in nets:
@@ -451,74 +1002,88 @@ class openflow_thread(threading.Thread):
                 else:
                     #nets not binding
                     continue
-                for src_port in net_src['ports']:
+
+                # output actions and priority to each destination port, that do not depend on the source port
+                dst_outputs = []
+                for dst_uuid, dst_vlan, dst_switch_port, dst_mac in net_ports[net_dst['uuid']]:
+                    vlan_out = vlan_net_out
+                    if vlan_out == None and dst_vlan != None:
+                        vlan_out = dst_vlan
+                    elif vlan_out != None and dst_vlan != None:
+                        #TODO this is something that we cannot do. It requires a double VLAN set
+                        #outer VLAN should be dst_port['vlan'] and inner VLAN should be vlan_out
+                        continue
+                    # allow that one port have no mac
+                    if dst_mac is None or nb_ports==2:  # point to point or nets with 2 elements
+                        dst_priority = priority-5  # less priority
+                        dst_mac = None
+                    else:
+                        dst_priority = priority
+                    dst_outputs.append((vlan_out, dst_switch_port, dst_mac, dst_priority))
+
+                for src_uuid, src_vlan, src_switch_port, _ in net_ports[net_id]:
                     vlan_in  = vlan_net_in
-                    if vlan_in == None  and src_port['vlan'] != None:
-                        vlan_in  = src_port['vlan']
-                    elif vlan_in != None  and src_port['vlan'] != None:
+                    if vlan_in == None  and src_vlan != None:
+                        vlan_in  = src_vlan
+                    elif vlan_in != None  and src_vlan != None:
                         #TODO this is something that we cannot do. It requires a double VLAN check
                         #outer VLAN should be src_port['vlan'] and inner VLAN should be vlan_in
                         continue
 
                     # BROADCAST:
-                    broadcast_key = src_port['uuid'] + "." + str(vlan_in)
+                    broadcast_key = src_uuid + "." + str(vlan_in)
                     if broadcast_key in new_broadcast_flows:
                         flow_broadcast = new_broadcast_flows[broadcast_key]
+                        flow_broadcast_outs = broadcast_outs[broadcast_key]
                     else:
                         flow_broadcast = {'priority': priority,
                             'net_id':  net_id,
                             'dst_mac': 'ff:ff:ff:ff:ff:ff',
-                            "ingress_port": str(src_port['switch_port']),
+                            "ingress_port": src_switch_port,
                             'actions': [] 
                         }
                         new_broadcast_flows[broadcast_key] = flow_broadcast
+                        flow_broadcast_outs = broadcast_outs[broadcast_key] = set()
                         if vlan_in is not None:
                             flow_broadcast['vlan_id'] = str(vlan_in)
 
-                    for dst_port in net_dst['ports']:
-                        vlan_out = vlan_net_out 
-                        if vlan_out == None and dst_port['vlan'] != None:
-                            vlan_out = dst_port['vlan']
-                        elif vlan_out != None and dst_port['vlan'] != None:
-                            #TODO this is something that we cannot do. It requires a double VLAN set
-                            #outer VLAN should be dst_port['vlan'] and inner VLAN should be vlan_out
-                            continue
+                    for vlan_out, dst_switch_port, dst_mac, dst_priority in dst_outputs:
                         #if src_port == dst_port:
                         #    continue
-                        if src_port['switch_port'] == dst_port['switch_port'] and vlan_in == vlan_out:
+                        if src_switch_port == dst_switch_port and vlan_in == vlan_out:
                             continue
                         flow = {
-                            "priority": priority,
+                            "priority": dst_priority,
                             'net_id':  net_id,
-                            "ingress_port": str(src_port['switch_port']),
+                            "ingress_port": src_switch_port,
                             'actions': []
                         }
                         if vlan_in is not None:
                             flow['vlan_id'] = str(vlan_in)
-                        # allow that one port have no mac
-                        if dst_port['mac'] is None or nb_ports==2:  # point to point or nets with 2 elements
-                            flow['priority'] = priority-5  # less priority
-                        else:
-                            flow['dst_mac'] = str(dst_port['mac'])
+                        if dst_mac is not None:
+                            flow['dst_mac'] = dst_mac
             
                         if vlan_out == None:
                             if vlan_in != None:
                                 flow['actions'].append( ('vlan',None) )
                         else:
                             flow['actions'].append( ('vlan', vlan_out ) )
-                        flow['actions'].append( ('out', str(dst_port['switch_port'])) )
+                        flow['actions'].append( ('out', dst_switch_port) )
             
-                        if self._check_flow_already_present(flow, new_flows) >= 0:
+                        key = self.flow_key(flow)
+                        if key in new_flows_keys:
                             self.logger.debug("Skipping repeated flow '%s'", str(flow))
                             continue
                         
                         new_flows.append(flow)
+                        new_flows_keys.add(key)
                     
                         # BROADCAST:
                         if nb_ports <= 2:  # point to multipoint or nets with more than 2 elements
                             continue
-                        out = (vlan_out, str(dst_port['switch_port']))
-                        if out not in flow_broadcast['actions']:
+                        out = (vlan_out, dst_switch_port)
+                        if out not in flow_broadcast_outs:
+                            flow_broadcast_outs.add(out)
                             flow_broadcast['actions'].append( out )
 
         #BROADCAST
@@ -542,11 +1107,13 @@ class openflow_thread(threading.Thread):
                 final_actions.append( ('out', action[1]) )
             flow_broadcast['actions'] = final_actions
 
-            if self._check_flow_already_present(flow_broadcast, new_flows) >= 0:
+            key = self.flow_key(flow_broadcast)
+            if key in new_flows_keys:
                 self.logger.debug("Skipping repeated flow '%s'", str(flow_broadcast))
                 continue
             
             new_flows.append(flow_broadcast)        
+            new_flows_keys.add(key)
         
         #UNIFY openflow rules with the same input port and vlan and the same output actions
         #These flows differ at the dst_mac; and they are unified by not filtering by dst_mac
@@ -28,6 +28,8 @@ Two thread will be launched, with normal and administrative permissions.
 """
 
 import threading
+import time
+import Queue
 import yaml
 import vim_db
 import logging
@@ -105,7 +107,9 @@ class ovim():
 
     def _create_database_connection(self):
         db = vim_db.vim_db((self.config["network_vlan_range_start"], self.config["network_vlan_range_end"]),
-                           self.logger_name + ".db", self.config.get('log_level_db'))
+                           self.logger_name + ".db", self.config.get('log_level_db'),
+                           pool_min=self.config.get('db_pool_min', 0), pool_max=self.config.get('db_pool_max', 0),
+                           prepared_statements=self.config.get('db_prepared_statements', False))
         if db.connect(self.config['db_host'], self.config['db_user'], self.config['db_passwd'],
                       self.config['db_name']) == -1:
             # self.logger.error("Cannot connect to database %s at %s@%s", self.config['db_name'], self.config['db_user'],
@@ -115,6 +119,39 @@ class ovim():
                                                                                 self.config['db_host']) )
         return db
 
+    def _get_thread_db_lock(self):
+        """
+        Obtain the lock to be used by a host, openflow or dhcp thread for its database accesses. With a pooled database
+        connection threads run concurrently, and only resource allocation (create_server) is serialized with the
+        global config["db_lock"]
+        :return: threading.Lock
+        """
+        if self.db.pool_max:
+            return threading.Lock()
+        return self.config["db_lock"]
+
+    def get_stats(self):
+        """
+        Obtain internal statistics of the server
+        :return: dictionary with the statistics by component
+        """
+        stats = {"database": self.db.get_pool_stats(), "database_statements": self.db.get_sql_cache_stats()}
+        stats["hosts"] = {}
+        for host_id, thread in self.config.get('host_threads', {}).items():
+            stats["hosts"][host_id] = {"name": thread.name, "status_flush": thread.status_flush_stats.copy(),
+                                       "status_events": thread.status_events_stats.copy()}
+            if thread.lvirt_conn:
+                stats["hosts"][host_id]["libvirt"] = thread.lvirt_conn.get_stats()
+            if thread.ssh_conn:
+                stats["hosts"][host_id]["ssh"] = thread.ssh_conn.get_stats()
+            stats["hosts"][host_id]["image_cache"] = thread.get_image_cache_stats()
+        stats["ofcs"] = {}
+        for ofc_id, thread in self.config.get('ofcs_thread', {}).items():
+            stats["ofcs"][ofc_id] = {"update_net": thread.update_net_stats.copy(),
+                                     "flows_cache": thread.get_flows_cache_stats(),
+                                     "http": thread.OF_connector.get_http_stats()}
+        return stats
+
     @staticmethod
     def get_version():
         return __version__
@@ -187,10 +224,34 @@ class ovim():
                                 current=r[0], target=database_version,  db_path=db_path))
         self.logger.critical("Starting ovim server version: '{} {}' database version '{}'".format(
             self.get_version(), self.get_version_date(), self.get_database_version()))
-        # create database connection for openflow threads
-        self.config["db"] = self._create_database_connection()
+        # create database connection for openflow threads. A pooled connection is shared
+        if self.db.pool_max:
+            self.config["db"] = self.db
+        else:
+            self.config["db"] = self._create_database_connection()
+            self.config["db"].ip_index = self.db.ip_index
+            self.config["db"].vlan_index = self.db.vlan_index
         self.config["db_lock"] = threading.Lock()
 
+        # in memory index of the used vlans of the nets, for get_free_net_vlan
+        r, c = self.db.load_vlan_index()
+        if r < 0:
+            raise ovimException("Cannot load vlan index from database {}".format(c))
+
+        # in memory placement index for get_numas, shared by both database connections
+        if self.config.get("placement_index", True):
+            r, index = self.db.load_numa_index(
+                reconcile_period=self.config.get("placement_index_reconcile_period", 600))
+            if r < 0:
+                raise ovimException("Cannot load placement index from database {}".format(index))
+            if self.config["db"] is not self.db:
+                self.config["db"].load_numa_index(index)
+            r, c = self.db.check_numa_index()
+            if r < 0:
+                self.logger.error("Cannot check placement index against database: %s", c)
+            elif r > 0:
+                self.logger.warning("Placement index differs from database stored procedures at %d values", r)
+
         self.of_test_mode = False if self.config['mode'] == 'normal' or self.config['mode'] == "OF only" else True
 
         # Create one thread for each host
@@ -210,13 +271,18 @@ class ovim():
             thread = ht.host_thread(name=host['name'], user=host['user'], host=host['ip_name'], db=self.config["db"],
                                     password=host['password'],
                                     keyfile=host.get('keyfile', self.config["host_ssh_keyfile"]),
-                                    db_lock=self.config["db_lock"], test=host_test_mode,
+                                    db_lock=self._get_thread_db_lock(), test=host_test_mode,
                                     image_path=self.config['host_image_path'],
                                     version=self.config['version'], host_id=host['uuid'],
                                     develop_mode=host_develop_mode,
                                     develop_bridge_iface=host_develop_bridge_iface,
                                     logger_name=self.logger_name + ".host." + host['name'],
-                                    debug=self.config.get('log_level_host'))
+                                    debug=self.config.get('log_level_host'),
+                                    status_events=self.config.get('host_status_events', False),
+                                    status_reconcile_period=self.config.get('host_status_reconcile_period', 300),
+                                    workers=self.config.get('host_workers', 1),
+                                    image_transfers=self.config.get('host_image_transfers', 1),
+                                    image_cache_quota=self.config.get('host_image_cache_quota', 0))
 
             try:
                 thread.check_connectivity()
@@ -267,7 +333,7 @@ class ovim():
         dhcp_params = self.config.get("dhcp_server")
         if dhcp_params:
             thread = dt.dhcp_thread(dhcp_params=dhcp_params, test=host_test_mode, dhcp_nets=self.config["dhcp_nets"],
-                                    db=self.config["db"], db_lock=self.config["db_lock"],
+                                    db=self.config["db"], db_lock=self._get_thread_db_lock(),
                                     logger_name=self.logger_name + ".dhcp",
                                     debug=self.config.get('log_level_of'))
             thread.start()
@@ -413,6 +479,10 @@ class ovim():
                 temp_dict['of_password'] = db_config.get('password')
 
             temp_dict['of_debug'] = self.config['log_level_of']
+            for param in ('of_timeout', 'of_connect_timeout', 'of_retries', 'of_retry_backoff', 'of_pool_size',
+                          'of_concurrency'):
+                if param in self.config:
+                    temp_dict[param] = self.config[param]
 
             if temp_dict['of_controller'] == 'opendaylight':
                 module = "ODL"
@@ -452,10 +522,15 @@ class ovim():
         ofc_net_same_vlan = False
 
         thread = oft.openflow_thread(ofc_uuid, of_conn, of_test=self.of_test_mode, db=self.config["db"],
-                                     db_lock=self.config["db_lock"],
+                                     db_lock=self._get_thread_db_lock(),
                                      pmp_with_same_vlan=ofc_net_same_vlan,
                                      logger_name=self.logger_name + ".ofc." + ofc_uuid,
-                                     debug=self.config.get('log_level_of'))
+                                     debug=self.config.get('log_level_of'),
+                                     snapshot_period=self.config.get('of_flows_snapshot_period', 300),
+                                     update_debounce=self.config.get('of_update_debounce', 0.5),
+                                     flows_cache_size=self.config.get('of_flows_cache_size', 64),
+                                     port_maps_path=self.config.get('of_port_maps_path'),
+                                     port_check_period=self.config.get('of_port_check_period', 300))
         #r, c = thread.OF_connector.obtain_port_correspondence()
         #if r < 0:
         #    raise ovimException("Cannot get openflow information %s", c)
@@ -649,30 +724,39 @@ class ovim():
                 net_region = "__DATA__"
             elif net_provider == "OVS":
                 net_region = "__OVS__"
+        free_vlan = None    # vlan taken from the vlan index, released if the net is not created
         if not net_vlan and (net_type == "data" or net_type == "ptp" or net_provider == "OVS"):
-            net_vlan = self.db.get_free_net_vlan(net_region)
+            net_vlan = free_vlan = self.db.get_free_net_vlan(net_region)
             if net_vlan < 0:
                 raise ovimException("Error getting an available vlan", HTTP_Internal_Server_Error)
-        if net_provider == 'OVS':
-            net_provider = 'OVS' + ":" + str(net_vlan)
-
-        network['provider'] = net_provider
-        network['type'] = net_type
-        network['vlan'] = net_vlan
-        network['region'] = net_region
-        dhcp_integrity = True
-        if network.get('enable_dhcp'):
-            dhcp_integrity = self._check_dhcp_data_integrity(network)
+        try:
+            if net_provider == 'OVS':
+                net_provider = 'OVS' + ":" + str(net_vlan)
+
+            network['provider'] = net_provider
+            network['type'] = net_type
+            network['vlan'] = net_vlan
+            network['region'] = net_region
+            dhcp_integrity = True
+            if network.get('enable_dhcp'):
+                dhcp_integrity = self._check_dhcp_data_integrity(network)
         
-        if network.get('links'):
-            network['links'] = yaml.safe_dump(network['links'], default_flow_style=True, width=256)
-        if network.get('dns'):
-            network['dns'] = yaml.safe_dump(network['dns'], default_flow_style=True, width=256)
-        if network.get('routes'):
-            network['routes'] = yaml.safe_dump(network['routes'], default_flow_style=True, width=256)
-
-        result, content = self.db.new_row('nets', network, True, True)
+            if network.get('links'):
+                network['links'] = yaml.safe_dump(network['links'], default_flow_style=True, width=256)
+            if network.get('dns'):
+                network['dns'] = yaml.safe_dump(network['dns'], default_flow_style=True, width=256)
+            if network.get('routes'):
+                network['routes'] = yaml.safe_dump(network['routes'], default_flow_style=True, width=256)
+
+            result, content = self.db.new_row('nets', network, True, True)
+        except Exception:
+            # any failure before the net is stored must not leave the vlan taken at the index
+            if free_vlan:
+                self.db.vlan_index.release(net_region, free_vlan)
+            raise
         if result >= 0:  # and dhcp_integrity:
+            if not free_vlan:
+                self.db.vlan_index.mark(net_region, net_vlan)
             if bridge_net:
                 bridge_net[3] = content
             if self.config.get("dhcp_server") and self.config['network_type'] == 'bridge':
@@ -684,6 +768,8 @@ class ovim():
                     self.logger.debug("dhcp_server: add new net", content, content)
             return content
         else:
+            if free_vlan:
+                self.db.vlan_index.release(net_region, free_vlan)
             raise ovimException("Error creating network: {}".format(content), -result)
 
 # TODO kei change update->edit
@@ -754,6 +840,10 @@ class ovim():
             # if result > 0 and nbports>0 and 'admin_state_up' in network
             #     and network['admin_state_up'] != network_old[0]['admin_state_up']:
             if result > 0:
+                if 'vlan' in network or 'region' in network:
+                    self.db.vlan_index.release(network_old[0]['region'], network_old[0]['vlan'])
+                    self.db.vlan_index.mark(network.get('region', network_old[0]['region']),
+                                            network.get('vlan', network_old[0]['vlan']))
 
                 try:
                     if nbports:
@@ -793,6 +883,7 @@ class ovim():
         if result == 0:
             raise ovimException("Network %s not found " % network_id, HTTP_Not_Found)
         elif result > 0:
+            self.db.vlan_index.release(net_data.get('region'), net_data.get('vlan'))
             for brnet in self.config['bridge_nets']:
                 if brnet[3] == network_id:
                     brnet[3] = None
@@ -868,6 +959,105 @@ class ovim():
 
         return result
 
+    def get_openflow_plan(self, network_id=None, ofc_id=None, flows=False):
+        """
+        Compute from the database, without using the openflow controllers nor changing anything, the flows that each
+        openflow thread would install for the ptp and data nets
+        :param network_id: Network id, if none all networks will be planned
+        :param ofc_id: if provided, only the flows of this openflow controller are planned
+        :param flows: if True the planned flows, with actions in database format, are included
+        :return: dictionary by ofc_id with the switch dpid, the number of flows in total, by priority and by net, the
+            seconds used computing them, the error of the nets that cannot be planned, and the flows if requested
+        """
+        if not network_id:
+            where_ = {}
+        else:
+            where_ = {"uuid": network_id}
+        result, nets = self.db.get_table(SELECT=("uuid", "type"), WHERE=where_, FROM='nets')
+        if result < 0:
+            raise ovimException(str(nets), -result)
+        elif network_id and result == 0:
+            raise ovimException("Network '{}' not found".format(network_id), HTTP_Not_Found)
+
+        plan = {}
+        planned = set()     # (ofc_id, net_id) already planned, as bound to a previous net
+        for net in nets:
+            if net["type"] != "ptp" and net["type"] != "data":
+                continue
+            for thread_ofc_id, thread in self._get_net_ofc_threads(net['uuid']).items():
+                if (ofc_id and thread_ofc_id != ofc_id) or (thread_ofc_id, net['uuid']) in planned:
+                    continue
+                ofc_plan = plan.get(thread_ofc_id)
+                if not ofc_plan:
+                    ofc_plan = plan[thread_ofc_id] = {"switch": thread.OF_connector.dpid, "flows": 0,
+                                                      "priorities": {}, "nets": {}, "seconds": 0.0, "errors": {}}
+                    if flows:
+                        ofc_plan["rules"] = []
+                planned_nets = []
+                planned_flows = []
+                start = time.time()
+                r, c = thread.update_of_flows(net['uuid'], planned_nets, planned_flows)
+                ofc_plan["seconds"] += time.time() - start
+                planned.update((thread_ofc_id, planned_net) for planned_net in planned_nets)
+                if r < 0:
+                    ofc_plan["errors"][net['uuid']] = c
+                    continue
+                for flow in planned_flows:
+                    ofc_plan["flows"] += 1
+                    ofc_plan["priorities"][flow["priority"]] = ofc_plan["priorities"].get(flow["priority"], 0) + 1
+                    ofc_plan["nets"][flow["net_id"]] = ofc_plan["nets"].get(flow["net_id"], 0) + 1
+                    if flows:
+                        flow["name"] = "{}.{}".format(flow["net_id"], ofc_plan["nets"][flow["net_id"]] - 1)
+                        flow["switch"] = thread.OF_connector.dpid
+                        oft.change_of2db(flow)
+                        ofc_plan["rules"].append(flow)
+        return plan
+
+    def reconcile_openflow_rules(self, ofc_id=None, dry_run=True, timeout=60):
+        """
+        Compare the openflow rules at database with the ones at the controllers, and unless dry_run, insert or delete
+        only the differing ones. It is done in parallel by the openflow threads, that fetch their controller rules
+        :param ofc_id: if provided, only this openflow controller is reconciled, otherwise all of them
+        :param dry_run: if True the differences are only reported
+        :param timeout: seconds waiting for the openflow threads
+        :return: dictionary by ofc_id with the names of the flows to 'add', 'modify' and 'delete', or the 'error'
+        """
+        if not ofc_id:
+            threads = self.config['ofcs_thread']
+        elif ofc_id in self.config['ofcs_thread']:
+            threads = {ofc_id: self.config['ofcs_thread'][ofc_id]}
+        else:
+            raise ovimException("Openflow controller not found with ofc_id={}".format(ofc_id), HTTP_Not_Found)
+
+        report = {}
+        results = Queue.Queue()
+        for thread_ofc_id, thread in threads.items():
+            r, c = thread.insert_task("reconcile", dry_run, results)
+            if r < 0:
+                report[thread_ofc_id] = {"error": c}
+        deadline = time.time() + timeout
+        while len(report) < len(threads):
+            try:
+                thread_ofc_id, r, c = results.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                break
+            report[thread_ofc_id] = c if r >= 0 else {"error": c}
+        for thread_ofc_id in threads:
+            if thread_ofc_id not in report:
+                report[thread_ofc_id] = {"error": "timeout waiting for the openflow thread"}
+        return report
+
+    def reconcile_vlan_index(self, dry_run=True):
+        """
+        Compare the vlans of the nets at database with the in memory vlan index, and unless dry_run, reload the index
+        :param dry_run: if True the differences are only reported
+        :return: dictionary with 'dry_run' and the list of 'differences'
+        """
+        result, content = self.db.reconcile_vlan_index(dry_run)
+        if result < 0:
+            raise ovimException("Error reconciling vlan index: {}".format(content), -result)
+        return {"dry_run": dry_run, "differences": content}
+
     def delete_openflow_rules(self, ofc_id=None):
         """
         To make actions over the net. The action is to delete ALL openflow rules
@@ -1013,46 +1203,80 @@ class ovim():
 
     def net_update_ofc_thread(self, net_id, ofc_id=None, switch_dpid=None):
         """
-        Insert a update net task by net id or ofc_id for each ofc thread
+        Insert a update net task by net id or ofc_id for each ofc thread. When neither ofc_id nor switch_dpid are
+        provided, the task is inserted in parallel at the threads of all the switches the net spans
         :param net_id: network id
         :param ofc_id: openflow controller id
         :param switch_dpid: switch dpid
-        :return:
+        :return: None. Net status is set once the update has finished at all the switches
         """
         if not net_id:
             raise ovimException("No net_id received", HTTP_Internal_Server_Error)
 
-        r = -1
-        c = 'No valid ofc_id or switch_dpid received'
-
-        if not ofc_id:
-            ports = self.get_ports(filter={"net_id": net_id})
-            for port in ports:
-                port_ofc_id = port.get('ofc_id', None)
-                if port_ofc_id:
-                    ofc_id = port['ofc_id']
-                    switch_dpid = port['switch_dpid']
-                    break
-        #TODO if not ofc_id: look at database table ofcs
-
-
-        # If no ofc_id found it, default ofc_id is used.
-        if not ofc_id and not switch_dpid:
-            ofc_id = "Default"
-
-        if ofc_id and ofc_id in self.config['ofcs_thread']:
-            r, c = self.config['ofcs_thread'][ofc_id].insert_task("update-net", net_id)
-        elif switch_dpid:
+        threads = self._get_net_ofc_threads(net_id, ofc_id, switch_dpid)
+        handle = oft.net_update_handle(net_id, threads.keys(), self.config["db"], self._get_thread_db_lock())
+        errors = []
+        for thread_ofc_id, thread in threads.items():
+            r, c = thread.insert_task("update-net", net_id, handle)
+            if r < 0:
+                errors.append(c)
+                handle.done(thread_ofc_id, r, c)
 
-            ofcs_dpid_list = self.config['ofcs_thread_dpid']
-            for ofc_t in ofcs_dpid_list:
-                if switch_dpid in ofc_t:
-                    r, c = ofc_t[switch_dpid].insert_task("update-net", net_id)
+        if len(errors) == len(threads):
+            message = "Cannot insert a task for updating network '{}', {}".format(net_id, "; ".join(errors))
+            self.logger.error(message)
+            raise ovimException(message, HTTP_Internal_Server_Error)
 
-        if r < 0:
-            message = "Cannot insert a task for updating network '{}', {}".format(net_id, c)
+    def _get_net_ofc_threads(self, net_id, ofc_id=None, switch_dpid=None):
+        """
+        Obtain the openflow threads that handle a net, by ofc_id or switch_dpid, or by the switches of its ports
+        :return: dictionary of openflow threads by ofc_id
+        """
+        threads = {}
+        if ofc_id or switch_dpid:
+            targets = ((ofc_id, switch_dpid),)
+        else:
+            ports = self.get_ports(columns=('ofc_id', 'switch_dpid'), filter={"net_id": net_id})
+            targets = set((port['ofc_id'], port['switch_dpid']) for port in ports if port.get('ofc_id'))
+            #TODO if not ofc_id: look at database table ofcs
+            if targets:
+                # the 'openflow:' provider binding is not a port; its switch is found at the port correspondences
+                for provider_ofc_id in self._get_net_provider_ofc_ids(net_id):
+                    targets.add((provider_ofc_id, None))
+
+            # If no ofc_id found it, default ofc_id is used.
+            if not targets:
+                targets = (("Default", None),)
+
+        for target_ofc_id, target_dpid in targets:
+            if target_ofc_id and target_ofc_id in self.config['ofcs_thread']:
+                thread = self.config['ofcs_thread'][target_ofc_id]
+                threads[thread.of_uuid] = thread
+            elif target_dpid:
+                for ofc_t in self.config['ofcs_thread_dpid']:
+                    if target_dpid in ofc_t:
+                        threads[ofc_t[target_dpid].of_uuid] = ofc_t[target_dpid]
+
+        if not threads:
+            message = "Cannot insert a task for updating network '{}', {}".format(net_id, 'No valid ofc_id or '
+                                                                                           'switch_dpid received')
             self.logger.error(message)
             raise ovimException(message, HTTP_Internal_Server_Error)
+        return threads
+
+    def _get_net_provider_ofc_ids(self, net_id):
+        """
+        Obtain the openflow threads whose switch has the switch port of the 'openflow:' provider binding of a net
+        :return: list of ofc_id of the threads
+        """
+        result, nets = self.db.get_table(FROM='nets', SELECT=('provider',), WHERE={'uuid': net_id})
+        if result <= 0 or not nets[0]['provider'] or nets[0]['provider'][:9] != "openflow:":
+            return []
+        switch_port = nets[0]['provider'][9:]
+        if switch_port[-5:] == ":vlan":
+            switch_port = switch_port[:-5]
+        return [ofc_id for ofc_id, thread in self.config['ofcs_thread'].items()
+                if switch_port in thread.OF_connector.pp2ofi]
 
     def delete_port(self, port_id):
         # Look for the previous port data
@@ -1421,7 +1645,7 @@ class ovim():
         dhcp_host = ht.host_thread(name='openvim_controller', user=ovs_controller_user, host=controller_ip,
                                    password=self.config.get('ovs_controller_password'),
                                    keyfile=self.config.get('ovs_controller_keyfile'),
-                                   db=self.config["db"], db_lock=self.config["db_lock"], test=host_test_mode,
+                                   db=self.config["db"], db_lock=self._get_thread_db_lock(), test=host_test_mode,
                                    image_path=self.config['host_image_path'], version=self.config['version'],
                                    host_id='openvim_controller', develop_mode=host_develop_mode,
                                    develop_bridge_iface=bridge_ifaces,
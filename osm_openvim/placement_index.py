@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+In memory index of the free resources of each compute node NUMA, used for selecting where to deploy a VM
+without calling the database stored procedures GetHostByMemCpu, GetNumaByMemory, GetNumaByCore/Thread and
+GetAvailablePorts at every server creation.
+The index is filled from the database by vim_db, that refreshes the affected host after every change.
+'''
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import threading
+import time
+import logging
+
+
+def allocate_numa_ports(requirements, available_ports):
+    '''Try to allocate the physical and SR-IOV interfaces of requirements['numa'] over the available ports of a numa.
+    available_ports is a list of dictionaries as returned by GetAvailablePorts stored procedure, ordered by
+    Mbps_free, availableSRIOV, pci. At success the iface dictionaries are filled with port_id, vlan, mac, switch_port
+    Return True if all the interfaces can be allocated, False otherwise
+    '''
+    #Set/reset reservations
+    for port in available_ports:
+        port['Mbps_reserved'] = 0
+        port['SRIOV_reserved'] = 0
+
+    #Try to allocate physical ports
+    for iface in requirements['numa']['port_list']:
+        for port in available_ports:
+            #If the port is not empty continue
+            if port['Mbps_free'] != port['Mbps'] or port['Mbps_reserved'] != 0:
+                continue
+            #If the port speed is not enough continue
+            if port['Mbps'] < iface['bandwidth']:
+                continue
+            #Otherwise this is a valid port
+            port['Mbps_reserved'] = port['Mbps']
+            port['SRIOV_reserved'] = 0
+            iface['port_id'] = port['port_id']
+            iface['vlan'] = None
+            iface['mac'] = port['mac']
+            iface['switch_port'] = port['switch_port']
+            break
+        else:
+            #all ports have been checked and no match has been found; this is not a valid numa
+            return False
+
+    #Try to allocate SR-IOVs
+    for iface in requirements['numa']['sriov_list']:
+        for port in available_ports:
+            #If there are not available SR-IOVs continue
+            if port['availableSRIOV'] - port['SRIOV_reserved'] <= 0:
+                continue
+            #If the port free speed is not enough continue
+            if port['Mbps_free'] - port['Mbps_reserved'] < iface['bandwidth']:
+                continue
+            #Otherwise this is a valid port
+            port['Mbps_reserved'] += iface['bandwidth']
+            port['SRIOV_reserved'] += 1
+            iface['port_id'] = port['port_id']
+            iface['vlan'] = None
+            iface['mac'] = port['mac']
+            iface['switch_port'] = port['switch_port']
+            break
+        else:
+            return False
+    return True
+
+
+class placement_index():
+    '''Free resources of hosts and numas kept in memory.
+    Numas are bucketed by free hugepage memory, so that the candidates for a memory requirement are
+    obtained from the buckets greater or equal than the requirement, already ordered from less to more capacity,
+    as GetNumaByMemory does.
+    All the methods are thread safe, as the index is shared by the several vim_db connections of ovim
+    '''
+
+    def __init__(self, reconcile_period=None, logger_name=None, debug=None):
+        '''reconcile_period: seconds between full reloads from database to fix any drift. None or 0 to disable'''
+        self.hosts = {}         # host uuid: {ram_free, cpus_free, admin_state_up, numas:[numa_id,...]}
+        self.numas = {}         # numa id: {host_id, ok, freemem, freethreads, freecores, ports:[resources_port rows]}
+        self.mem_buckets = {}   # free hugepages memory: set of numa ids
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.reconcile_period = reconcile_period
+        self.next_reconcile = None
+        if logger_name:
+            self.logger_name = logger_name
+        else:
+            self.logger_name = 'openvim.db.index'
+        self.logger = logging.getLogger(self.logger_name)
+        if debug:
+            self.logger.setLevel(getattr(logging, debug))
+
+    @staticmethod
+    def _build(rows):
+        '''Build the host and numa dictionaries from the database rows obtained by vim_db.get_placement_rows
+        Return: (hosts, numas)
+        '''
+        hosts = {}
+        numas = {}
+        for host in rows['hosts']:
+            hosts[host['uuid']] = {
+                'ram_free': int(host['RAM'] or 0),
+                'cpus_free': int(host['cpus'] or 0),
+                'admin_state_up': host['admin_state_up'] == 'true',
+                'numas': [],
+            }
+        for used in rows['used']:
+            host = hosts.get(used['host_id'])
+            if host:
+                host['ram_free'] -= int(used['used_ram'] or 0)
+                host['cpus_free'] -= int(used['used_cpus'] or 0)
+        for numa in rows['numas']:
+            host = hosts.get(numa['host_id'])
+            if not host:
+                continue
+            host['numas'].append(numa['id'])
+            numas[numa['id']] = {
+                'host_id': numa['host_id'],
+                'ok': numa['status'] == 'ok' and numa['admin_state_up'] == 'true' and host['admin_state_up'],
+                'freemem': int(numa['hugepages'] or 0),
+                'freethreads': 0,
+                'freecores': 0,
+                'ports': [],
+            }
+        for mem in rows['mem']:
+            numa = numas.get(mem['numa_id'])
+            if numa:
+                numa['freemem'] -= int(mem['consumed'] or 0)
+        free_threads_by_core = {}
+        for core in rows['cores']:
+            if core['numa_id'] not in numas or core['instance_id'] is not None or core['status'] != 'ok':
+                continue
+            numas[core['numa_id']]['freethreads'] += 1
+            key = (core['numa_id'], core['core_id'])
+            free_threads_by_core[key] = free_threads_by_core.get(key, 0) + 1
+        for key, free_threads in free_threads_by_core.items():
+            if free_threads == 2:
+                numas[key[0]]['freecores'] += 1
+        for port in rows['ports']:
+            numa = numas.get(port['numa_id'])
+            if numa:
+                numa['ports'].append(port)
+        return hosts, numas
+
+    def _bucket_add(self, numa_id):
+        numa = self.numas[numa_id]
+        if numa['ok']:
+            self.mem_buckets.setdefault(numa['freemem'], set()).add(numa_id)
+
+    def _bucket_remove(self, numa_id):
+        numa = self.numas[numa_id]
+        bucket = self.mem_buckets.get(numa['freemem'])
+        if bucket is not None:
+            bucket.discard(numa_id)
+            if not bucket:
+                del self.mem_buckets[numa['freemem']]
+
+    def _remove_host(self, host_id):
+        host = self.hosts.pop(host_id, None)
+        if not host:
+            return
+        for numa_id in host['numas']:
+            self._bucket_remove(numa_id)
+            del self.numas[numa_id]
+
+    def load(self, rows):
+        '''Replace the whole index content with the database rows of all the hosts'''
+        hosts, numas = self._build(rows)
+        with self.lock:
+            self.hosts = hosts
+            self.numas = numas
+            self.mem_buckets = {}
+            for numa_id in numas:
+                self._bucket_add(numa_id)
+            self.loaded = True
+            if self.reconcile_period:
+                self.next_reconcile = time.time() + self.reconcile_period
+        self.logger.debug("loaded %d hosts, %d numas", len(hosts), len(numas))
+
+    def update_host(self, host_id, rows):
+        '''Replace the content of a host with the database rows of this host. If host is not present at rows, it
+        is removed from the index'''
+        hosts, numas = self._build(rows)
+        with self.lock:
+            self._remove_host(host_id)
+            if host_id in hosts:
+                self.hosts[host_id] = hosts[host_id]
+                for numa_id in hosts[host_id]['numas']:
+                    self.numas[numa_id] = numas[numa_id]
+                    self._bucket_add(numa_id)
+
+    def remove_host(self, host_id):
+        with self.lock:
+            self._remove_host(host_id)
+
+    def reconcile_due(self):
+        '''Return True if the periodic reconcile time has been reached'''
+        return bool(self.next_reconcile and time.time() >= self.next_reconcile)
+
+    def compare(self, rows):
+        '''Compare the index content with the database rows of all the hosts
+        Return: list of text differences, empty if index is consistent
+        '''
+        hosts, numas = self._build(rows)
+        differences = []
+        with self.lock:
+            for host_id in set(hosts.keys()) | set(self.hosts.keys()):
+                if host_id not in self.hosts:
+                    differences.append("host {} missing at index".format(host_id))
+                elif host_id not in hosts:
+                    differences.append("host {} not present at database".format(host_id))
+                else:
+                    for k in ('ram_free', 'cpus_free', 'admin_state_up'):
+                        if hosts[host_id][k] != self.hosts[host_id][k]:
+                            differences.append("host {} {} index={} database={}".format(
+                                host_id, k, self.hosts[host_id][k], hosts[host_id][k]))
+            for numa_id in set(numas.keys()) & set(self.numas.keys()):
+                for k in ('ok', 'freemem', 'freethreads', 'freecores'):
+                    if numas[numa_id][k] != self.numas[numa_id][k]:
+                        differences.append("numa {} {} index={} database={}".format(
+                            numa_id, k, self.numas[numa_id][k], numas[numa_id][k]))
+                if self._ports_key(numas[numa_id]['ports']) != self._ports_key(self.numas[numa_id]['ports']):
+                    differences.append("numa {} ports differ".format(numa_id))
+        return differences
+
+    def summary(self, key, minimum=0):
+        '''Return a dictionary numa_id: value of 'key' for the eligible numas with a value >= minimum'''
+        with self.lock:
+            return dict((numa_id, numa[key]) for numa_id, numa in self.numas.items()
+                        if numa['ok'] and numa[key] >= minimum)
+
+    @staticmethod
+    def _ports_key(ports):
+        return sorted((p['id'], p['instance_id'], p['Mbps_used'], p['status'], p['switch_port']) for p in ports)
+
+    @staticmethod
+    def _available_ports(numa, only_of_ports):
+        '''Compute the same result as the GetAvailablePorts/GetAllAvailablePorts stored procedures'''
+        groups = {}
+        for port in numa['ports']:
+            if port['status'] != 'ok':
+                continue
+            group = groups.setdefault(port['root_id'], {'Mbps_consumed': 0, 'total': 0, 'used': 0})
+            group['Mbps_consumed'] += int(port['Mbps_used'] or 0)
+            group['total'] += 1
+            if port['instance_id'] is not None and (not only_of_ports or port['switch_port'] is not None):
+                group['used'] += 1
+        available_ports = []
+        for port in numa['ports']:
+            if port['id'] != port['root_id'] or port['status'] != 'ok' or port['instance_id'] is not None:
+                continue
+            if only_of_ports and port['switch_port'] is None:
+                continue
+            group = groups[port['id']]
+            available_ports.append({
+                'port_id': port['id'],
+                'pci': port['pci'],
+                'Mbps': port['Mbps'],
+                'Mbps_free': port['Mbps'] - group['Mbps_consumed'],
+                'availableSRIOV': group['total'] - 1 - group['used'],
+                'switch_port': port['switch_port'],
+                'mac': port['mac'],
+            })
+        available_ports.sort(key=lambda p: (p['Mbps_free'], p['availableSRIOV'], p['pci']))
+        return available_ports
+
+    def get_numas(self, requirements, prefered_host_id=None, only_of_ports=True):
+        '''Obtain a valid NUMA/HOST for deployment a VM. Same parameters and result as vim_db.get_numas'''
+        with self.lock:
+            ram = int(requirements['ram'])
+            vcpus = int(requirements['vcpus'])
+            valid_hosts = set(host_id for host_id, host in self.hosts.items()
+                              if host['admin_state_up'] and host['ram_free'] >= ram and host['cpus_free'] >= vcpus)
+            if not valid_hosts:
+                return -1, 'No room at data center. Cannot find a host with %s MB memory and %s cpus available' % \
+                    (str(requirements['ram']), str(requirements['vcpus']))
+
+            #Find valid numa nodes for memory requirements, sorting from less to more memory capacity
+            memory = int(requirements['numa']['memory'])
+            valid_for_memory = []
+            for freemem in sorted(self.mem_buckets):
+                if freemem >= memory:
+                    valid_for_memory += self.mem_buckets[freemem]
+            if not valid_for_memory:
+                return -1, 'No room at data center. Cannot find a host with %s GB Hugepages memory available' % \
+                    str(requirements['numa']['memory'])
+
+            #Find valid numa nodes for processor requirements
+            proc_req_nb = int(requirements['numa']['proc_req_nb'])
+            if requirements['numa']['proc_req_type'] == 'threads':
+                cpu_requirement_text = 'cpu-threads'
+                proc_key = 'freethreads'
+            else:
+                cpu_requirement_text = 'cpu-cores'
+                proc_key = 'freecores'
+            if not any(numa[proc_key] >= proc_req_nb and numa['ok'] for numa in self.numas.values()):
+                return -1, 'No room at data center. Cannot find a host with %s %s available' % \
+                    (str(requirements['numa']['proc_req_nb']), cpu_requirement_text)
+
+            #Find the numa nodes that comply for memory and processor requirements
+            valid_numas = []
+            for numa_id in valid_for_memory:
+                numa = self.numas[numa_id]
+                if numa['host_id'] not in valid_hosts or numa[proc_key] < proc_req_nb:
+                    continue
+                if numa['host_id'] == prefered_host_id:
+                    valid_numas.insert(0, numa_id)
+                else:
+                    valid_numas.append(numa_id)
+            if not valid_numas:
+                return -1, 'No room at data center. Cannot find a host with %s MB hugepages memory and %s %s ' \
+                           'available in the same numa' % (requirements['numa']['memory'],
+                                                           str(requirements['numa']['proc_req_nb']),
+                                                           cpu_requirement_text)
+
+            #Find valid numa nodes for interfaces requirements
+            for numa_id in valid_numas:
+                available_ports = self._available_ports(self.numas[numa_id], only_of_ports)
+                if allocate_numa_ports(requirements, available_ports):
+                    return 0, {'numa_id': numa_id, 'host_id': self.numas[numa_id]['host_id']}
+            return -1, 'No room at data center. Cannot find a host with the required hugepages, vcpus and interfaces'
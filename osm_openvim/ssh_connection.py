@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Long-lived ssh connections to the compute nodes, used for running commands. A connection is opened once per host and
+credentials and shared by the threads of the compute node. Each command runs at its own channel of the same ssh
+transport, so that several workers run commands concurrently without new handshakes. Connections use keepalive, are
+reopened when found dead, and keep counters of handshakes, commands and their latency.
+'''
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import threading
+import socket
+import time
+import logging
+import paramiko
+
+_connections = {}   # ssh_connection by (user, host, password, keyfile)
+_connections_lock = threading.Lock()
+
+
+def get_connection(host, user, password=None, keyfile=None, logger_name=None):
+    '''Return the shared ssh_connection for this host and credentials, creating it if needed. The ssh connection is
+    not opened until ssh_connection.get() is called'''
+    key = (user, host, password, keyfile)
+    with _connections_lock:
+        connection = _connections.get(key)
+        if not connection:
+            connection = _connections[key] = ssh_connection(host, user, password, keyfile, logger_name)
+        return connection
+
+
+class ssh_connection():
+    def __init__(self, host, user, password=None, keyfile=None, logger_name=None, keepalive_interval=30,
+                 max_channels=8, timeout=10):
+        '''
+        :param keepalive_interval: seconds between keepalive messages of the ssh transport
+        :param max_channels: maximum number of commands running at the same time. sshd refuses by default more than
+            10 sessions per connection (MaxSessions)
+        :param timeout: seconds waiting for connecting
+        '''
+        self.host = host
+        self.user = user
+        self.password = password
+        self.keyfile = keyfile
+        self.keepalive_interval = keepalive_interval
+        self.max_channels = max_channels
+        self.timeout = timeout
+        self.client = None
+        self.remote_ip = None
+        self.local_ip = None
+        self.lock = threading.Lock()
+        self.channels = set()   # channels of the commands not finished yet
+        self.channels_reserved = 0  # slots taken by commands whose channel is being opened
+        self.channels_condition = threading.Condition(threading.Lock())
+        self.logger = logging.getLogger(logger_name or "openvim.ssh")
+        # latency: dictionary by command name with count, total and max seconds
+        self.stats = {"handshakes": 0, "reconnections": 0, "commands": 0, "errors": 0, "waits": 0,
+                      "max_channels_used": 0, "latency": {}}
+
+    def get(self):
+        '''Return the paramiko SSHClient, connecting it if not connected yet or found dead.
+        Raise paramiko SSHException or socket.error if it cannot connect'''
+        with self.lock:
+            if self.client is not None:
+                transport = self.client.get_transport()
+                if transport and transport.is_active():
+                    return self.client
+                self.logger.debug("ssh connection to '%s' is not active, reconnecting", self.host)
+                self.stats["reconnections"] += 1
+                self._close()
+            start = time.time()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.load_system_host_keys()
+            client.connect(self.host, username=self.user, password=self.password, key_filename=self.keyfile,
+                           timeout=self.timeout)
+            self.record("connect", time.time() - start)
+            transport = client.get_transport()
+            transport.set_keepalive(self.keepalive_interval)
+            self.remote_ip = transport.sock.getpeername()[0]
+            self.local_ip = transport.sock.getsockname()[0]
+            self.stats["handshakes"] += 1
+            self.client = client
+            return client
+
+    def _close(self):
+        try:
+            if self.client is not None:
+                self.client.close()
+        except Exception:
+            pass
+        self.client = None
+        with self.channels_condition:
+            self.channels.clear()   # closed with the transport
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def check_error(self):
+        '''Called after a failed command. If the connection is dead it is closed, so that next get() reconnects'''
+        self.stats["errors"] += 1
+        with self.lock:
+            if self.client is None:
+                return
+            transport = self.client.get_transport()
+            if transport and transport.is_active():
+                return
+            self._close()
+
+    def _acquire_channel(self):
+        '''Wait until less than max_channels commands are running or being started, and reserve a slot for a new one.
+        It must be followed by _release_channel'''
+        with self.channels_condition:
+            while True:
+                for channel in list(self.channels):
+                    if channel.closed or channel.exit_status_ready():
+                        self.channels.discard(channel)
+                if len(self.channels) + self.channels_reserved < self.max_channels:
+                    self.channels_reserved += 1
+                    return
+                self.stats["waits"] += 1
+                self.channels_condition.wait(0.05)
+
+    def _release_channel(self, channel=None):
+        '''Free the slot reserved by _acquire_channel. If the channel has been opened, it takes the slot until its
+        command finishes'''
+        with self.channels_condition:
+            self.channels_reserved -= 1
+            if channel is not None:
+                self.channels.add(channel)
+                self.stats["commands"] += 1
+                running = len(self.channels) + self.channels_reserved
+                if running > self.stats["max_channels_used"]:
+                    self.stats["max_channels_used"] = running
+            self.channels_condition.notify()
+
+    def exec_command(self, command, timeout=10):
+        '''Run a command at a new channel, connecting if needed. If the channel cannot be opened because the
+        connection has died, it is reopened and the channel retried once; the command is never run twice. If the
+        server refuses the channel, as when other sessions reach the sshd MaxSessions, it is retried once after a while.
+        Return the (stdin, stdout, stderr) file like objects, as paramiko SSHClient.exec_command.
+        Raise paramiko SSHException or socket.error'''
+        self.get()  # a dead connection is reopened before counting its channels
+        self._acquire_channel()
+        channel = None
+        try:
+            for retry in (True, False):
+                client = self.get()
+                try:
+                    channel = client.get_transport().open_session()
+                    break
+                except paramiko.ChannelException:
+                    # refused by server, connection is alive
+                    if not retry:
+                        raise
+                    self.stats["waits"] += 1
+                    time.sleep(0.5)
+                except (paramiko.SSHException, EOFError, socket.error, AttributeError):
+                    self.check_error()
+                    if not retry:
+                        raise
+        finally:
+            self._release_channel(channel)
+        try:
+            channel.settimeout(timeout)
+            channel.exec_command(command)
+        except Exception:
+            channel.close()     # discarded from channels at next _acquire_channel
+            with self.channels_condition:
+                self.channels_condition.notify()
+            self.check_error()
+            raise
+        return channel.makefile('wb', -1), channel.makefile('r', -1), channel.makefile_stderr('r', -1)
+
+    def record(self, name, elapsed):
+        '''Account the latency of a command or connection'''
+        latency = self.stats["latency"].get(name)
+        if not latency:
+            latency = self.stats["latency"][name] = {"count": 0, "total": 0.0, "max": 0.0}
+        latency["count"] += 1
+        latency["total"] += elapsed
+        if elapsed > latency["max"]:
+            latency["max"] = elapsed
+
+    def get_stats(self):
+        stats = self.stats.copy()
+        stats["latency"] = {name: dict(latency) for name, latency in self.stats["latency"].items()}
+        stats["connected"] = self.client is not None
+        stats["channels"] = len(self.channels)
+        return stats
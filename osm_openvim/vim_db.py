@@ -37,7 +37,12 @@ import uuid as myUuid
 import auxiliary_functions as af
 import json
 import logging
-from netaddr import IPNetwork, IPAddress
+import threading
+import time
+import functools
+from placement_index import placement_index, allocate_numa_ports
+from ip_index import ip_index, ip_range
+from vlan_index import vlan_index
 
 HTTP_Bad_Request = 400
 HTTP_Unauthorized = 401 
@@ -49,14 +54,52 @@ HTTP_Service_Unavailable = 503
 HTTP_Internal_Server_Error = 500 
 
 
-class vim_db():
-    def __init__(self, vlan_range, logger_name= None, debug=None):
+def _pooled(func):
+    '''Decorator for vim_db methods that use the database connection. In pooled mode it checks out a connection
+    from the pool for the calling thread during the call, and checks it in at the end. Nested calls reuse the
+    connection already checked out by the thread'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self.pool_max or self._local.__dict__.get('con') is not None:
+            return func(self, *args, **kwargs)
+        try:
+            self._local.con = self._checkout()
+        except mdb.Error as e:
+            self.logger.error("%s cannot get a pooled DB connection: %s", func.__name__, str(e))
+            return -HTTP_Service_Unavailable, "DB Exception, no connection available"
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            con = self._local.con
+            self._local.con = None
+            self._local.cur = None
+            self._checkin(con)
+    return wrapper
+
+
+class vim_db(object):
+    def __init__(self, vlan_range, logger_name= None, debug=None, pool_min=0, pool_max=0, prepared_statements=False):
         '''vlan_range must be a tuple (vlan_ini, vlan_end) with available vlan values for networks
         every dataplane network contain a unique value, regardless of it is used or not 
+        pool_min, pool_max: when pool_max is greater than 0 a pool of connections is used, so that this object can be
+        used concurrently from several threads. Each thread checks out a connection at every call. pool_min
+        connections are created at connect time. By default a single connection is used
+        prepared_statements: if True get_table, new_row and update_rows use server side prepared statements
         ''' 
         #initialization
         self.net_vlan_range = vlan_range
-        self.vlan_config = {}
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self._local = threading.local()     # connection and cursor of each thread in pooled mode
+        self._pool_free = []                 # idle connections
+        self._pool_created = 0
+        self._pool_condition = threading.Condition()
+        self.pool_stats = {"in_use": 0, "max_in_use": 0, "created": 0, "checkouts": 0, "waits": 0,
+                           "wait_time": 0.0, "reconnections": 0}
+        self.prepared_statements = prepared_statements
+        self.sql_cache = {}     # SQL text of the query builder, by statement shape
+        self.sql_cache_stats = {"hits": 0, "misses": 0, "prepared": 0}
+        self.numa_index = None  # in memory placement_index used by get_numas, shared among connections
         self.debug=debug
         if logger_name:
             self.logger_name = logger_name
@@ -65,12 +108,55 @@ class vim_db():
         self.logger = logging.getLogger(self.logger_name)
         if debug:
             self.logger.setLevel( getattr(logging, debug) )
+        # used dhcp ip addresses of the OVS nets, shared among connections
+        self.ip_index = ip_index(self.logger_name + ".ip_index", debug)
+        # used vlans of the nets of each region, shared among connections
+        self.vlan_index = vlan_index(vlan_range, self.logger_name + ".vlan_index", debug)
 
 
+    @property
+    def con(self):
+        if self.pool_max:
+            con = self._local.__dict__.get('con')
+        else:
+            con = self.__dict__.get('_con')
+        if con is None:
+            raise AttributeError("vim_db instance has no attribute 'con'")
+        return con
+
+    @con.setter
+    def con(self, value):
+        if self.pool_max:
+            self._local.con = value
+        else:
+            self._con = value
+
+    @con.deleter
+    def con(self):
+        if self.pool_max:
+            self._local.con = None
+        else:
+            self._con = None
+
+    @property
+    def cur(self):
+        if self.pool_max:
+            return self._local.__dict__.get('cur')
+        return self.__dict__.get('_cur')
+
+    @cur.setter
+    def cur(self, value):
+        if self.pool_max:
+            self._local.cur = value
+        else:
+            self._cur = value
+
     def connect(self, host=None, user=None, passwd=None, database=None):
         '''Connect to the concrete data base. 
         The first time a valid host, user, passwd and database must be provided,
         Following calls can skip this parameters
+        In pooled mode the first call creates the pool_min connections; following calls from a thread with a
+        checked out connection replace it by a new one
         '''
         try:
             if host     is not None: self.host = host
@@ -78,13 +164,93 @@ class vim_db():
             if passwd   is not None: self.passwd = passwd
             if database is not None: self.database = database
 
-            self.con = mdb.connect(self.host, self.user, self.passwd, self.database)
+            if not self.pool_max:
+                self.con = mdb.connect(self.host, self.user, self.passwd, self.database)
+            elif self._local.__dict__.get('con') is not None:
+                # reconnection of the connection used by this thread
+                try:
+                    self._local.con.close()
+                except mdb.Error:
+                    pass
+                self._local.con = mdb.connect(self.host, self.user, self.passwd, self.database)
+                self.pool_stats["reconnections"] += 1
+            else:
+                with self._pool_condition:
+                    while self._pool_created < self.pool_min:
+                        self._pool_free.append(mdb.connect(self.host, self.user, self.passwd, self.database))
+                        self._pool_created += 1
+                        self.pool_stats["created"] += 1
             self.logger.debug("connected to DB %s at %s@%s", self.database,self.user, self.host)
             return 0
         except mdb.Error as e:
             self.logger.error("Cannot connect to DB %s at %s@%s Error %d: %s", self.database, self.user, self.host, e.args[0], e.args[1])
             return -1
 
+    def _checkout(self):
+        '''Obtain a connection from the pool, waiting if pool_max connections are in use. The connection is checked
+        with a ping and reconnected if needed. Raise mdb.Error if it cannot connect'''
+        con = None
+        wait_start = None
+        with self._pool_condition:
+            while not self._pool_free and self._pool_created >= self.pool_max:
+                if wait_start is None:
+                    wait_start = time.time()
+                    self.pool_stats["waits"] += 1
+                self._pool_condition.wait(5)
+            if wait_start is not None:
+                self.pool_stats["wait_time"] += time.time() - wait_start
+            if self._pool_free:
+                con = self._pool_free.pop()
+            else:
+                self._pool_created += 1
+                self.pool_stats["created"] += 1
+            self.pool_stats["checkouts"] += 1
+            self.pool_stats["in_use"] += 1
+            if self.pool_stats["in_use"] > self.pool_stats["max_in_use"]:
+                self.pool_stats["max_in_use"] = self.pool_stats["in_use"]
+        try:
+            if con is not None:
+                try:
+                    con.ping()
+                    return con
+                except mdb.Error as e:
+                    # MySQL server has gone away
+                    self.logger.debug("pooled DB connection lost, reconnecting: %s", str(e))
+                    self.pool_stats["reconnections"] += 1
+                    try:
+                        con.close()
+                    except mdb.Error:
+                        pass
+            return mdb.connect(self.host, self.user, self.passwd, self.database)
+        except mdb.Error:
+            with self._pool_condition:
+                self._pool_created -= 1
+                self.pool_stats["in_use"] -= 1
+                self._pool_condition.notify()
+            raise
+
+    def _checkin(self, con):
+        '''Return a connection to the pool'''
+        with self._pool_condition:
+            self.pool_stats["in_use"] -= 1
+            if con is None:
+                self._pool_created -= 1
+            else:
+                self._pool_free.append(con)
+            self._pool_condition.notify()
+
+    def get_pool_stats(self):
+        '''Return a dictionary with the connection pool usage: size, idle, in_use, max_in_use, created, checkouts,
+        waits, wait_time (seconds), reconnections'''
+        with self._pool_condition:
+            stats = self.pool_stats.copy()
+            stats["size"] = self._pool_created
+            stats["idle"] = len(self._pool_free)
+            stats["pool_min"] = self.pool_min
+            stats["pool_max"] = self.pool_max
+        return stats
+
+    @_pooled
     def get_db_version(self):
         ''' Obtain the database schema version.
         Return: (negative, text) if error or version 0.0 where schema_version table is missing
@@ -113,6 +279,13 @@ class vim_db():
     def disconnect(self):
         '''disconnect from the data base'''
         try:
+            if self.pool_max:
+                with self._pool_condition:
+                    for con in self._pool_free:
+                        con.close()
+                    self._pool_created -= len(self._pool_free)
+                    self._pool_free = []
+                return
             self.con.close()
             del self.con
         except mdb.Error as e:
@@ -162,63 +335,193 @@ class vim_db():
                 return -HTTP_Bad_Request, "Field %s does not exist" % e.args[1][uk+14:wc]
         return -HTTP_Internal_Server_Error, "Database internal Error %d: %s" % (e.args[0], e.args[1])
 
-    def __data2db_format(self, data):
-        '''convert data to database format. If data is None it return the 'Null' text,
-        otherwise it return the text surrounded by quotes ensuring internal quotes are escaped'''
-        if data==None:
-            return 'Null'
-        out=str(data)
-        if "'" not in out:
-            return "'" + out + "'"
-        elif '"' not in out:
-            return '"' + out + '"'
-        else:
-            return json.dumps(out)
-    
-    def __get_used_net_vlan(self, region=None):
-        #get used from database if needed
-        vlan_region = self.vlan_config[region]
-        try:
-            cmd = "SELECT vlan FROM nets WHERE vlan>='{}' and region{} ORDER BY vlan LIMIT 25".format(
-                vlan_region["lastused"], "='"+region+"'" if region else " is NULL")
-            with self.con:
-                self.cur = self.con.cursor()
-                self.logger.debug(cmd)
-                self.cur.execute(cmd)
-                vlan_tuple = self.cur.fetchall()
-                # convert a tuple of tuples in a list of numbers
-                vlan_region["usedlist"] = []
-                for k in vlan_tuple:
-                    vlan_region["usedlist"].append(k[0])
-        except (mdb.Error, AttributeError) as e:
-            return self.format_error(e, "get_free_net_vlan", cmd)
-    
-    def get_free_net_vlan(self, region=None):
-        '''obtain a vlan not used in any net'''
-        if region not in self.vlan_config:
-            self.vlan_config[region] = {
-                "usedlist": None,
-                "lastused": self.net_vlan_range[0] - 1
-            }
-        vlan_region = self.vlan_config[region]
-
-        while True:
-            self.logger.debug("get_free_net_vlan() region[{}]={}, net_vlan_range:{}-{} ".format(region, vlan_region,
-                            self.net_vlan_range[0], self.net_vlan_range[1]))
-            vlan_region["lastused"] += 1
-            if vlan_region["lastused"] ==  self.net_vlan_range[1]:
-                # start from the begining
-                vlan_region["lastused"] =  self.net_vlan_range[0]
-                vlan_region["usedlist"] = None
-            if vlan_region["usedlist"] is None or \
-                    (len(vlan_region["usedlist"])==25 and vlan_region["lastused"] >= vlan_region["usedlist"][-1]):
-                self.__get_used_net_vlan(region)
-                self.logger.debug("new net_vlan_usedlist %s", str(vlan_region["usedlist"]))
-            if vlan_region["lastused"] in vlan_region["usedlist"]:
-                continue
+    @staticmethod
+    def _sql_param(value):
+        '''convert a value to a query parameter. Text and numbers are passed as they are, other types converted to
+        text as done when the SQL statement was built by string concatenation'''
+        if value is None or isinstance(value, (basestring, float)) or \
+                (isinstance(value, (int, long)) and not isinstance(value, bool)):
+            return value
+        return str(value)
+
+    @staticmethod
+    def _sql_where_shape(where):
+        '''return the shape of a WHERE dictionary, as a sorted tuple of (key, value is None, number of values if the
+        value is a list or tuple, otherwise None) '''
+        if not where:
+            return ()
+        return tuple(sorted((str(k), v is None, len(v) if isinstance(v, (list, tuple)) else None)
+                            for k, v in where.items()))
+
+    def _sql_statement(self, shape, build):
+        '''Obtain the cached statement for this shape, building it with the build function if not present.
+        The statement is a dictionary with:
+            'text': SQL with %s placeholders, to use with cursor.execute(text, params)
+            'prepare': SQL with ? placeholders, for a server side prepared statement
+            'name': name of the prepared statement
+        '''
+        statement = self.sql_cache.get(shape)
+        if statement:
+            self.sql_cache_stats["hits"] += 1
+            return statement
+        self.sql_cache_stats["misses"] += 1
+        if len(self.sql_cache) >= 1000:
+            # avoid an unbounded growth because of arbitrary filters
+            self.sql_cache = {}
+        prepare = build()
+        statement = {"prepare": prepare, "text": prepare.replace("%", "%%").replace("?", "%s"),
+                     "name": "vim_db_stmt_{}".format(len(self.sql_cache))}
+        self.sql_cache[shape] = statement
+        return statement
+
+    def _sql_where(self, where, where_not=None, where_or=None, and_or=None):
+        '''build a WHERE clause with ? placeholders. Return the text and the list of parameters'''
+        params = []
+
+        def _conditions(w, equal, null, in_, empty_in):
+            conditions = []
+            for k, is_null, values in self._sql_where_shape(w):
+                if is_null:
+                    conditions.append(k + null)
+                elif values == 0:
+                    conditions.append(empty_in)
+                elif values is not None:
+                    conditions.append(k + in_ + "(" + ",".join(("?",) * values) + ")")
+                    params.extend(self._sql_param(v) for v in w[k])
+                else:
+                    conditions.append(k + equal)
+                    params.append(self._sql_param(w[k]))
+            return conditions
+
+        where_and = _conditions(where, "=?", " is Null", " IN ", "FALSE") + \
+            _conditions(where_not, "!=?", " is not Null", " NOT IN ", "TRUE")
+        where_and = " AND ".join(where_and) if where_and else None
+        where_or = " OR ".join(_conditions(where_or, "=?", " is Null", " IN ", "FALSE")) if where_or else None
+        if where_and is not None and where_or is not None:
+            if and_or == "AND":
+                return "WHERE " + where_and + " AND (" + where_or + ")", params
             else:
-                return vlan_region["lastused"]
-                
+                return "WHERE (" + where_and + ") OR " + where_or, params
+        elif where_and is not None:
+            return "WHERE " + where_and, params
+        elif where_or is not None:
+            return "WHERE " + where_or, params
+        return "", params
+
+    def _sql_select(self, sql_dict):
+        '''Return the statement and parameters for a get_table sql_dict'''
+        select = tuple(map(str, sql_dict['SELECT'])) if sql_dict.get('SELECT') else None
+        table = str(sql_dict['FROM'])
+        limit = sql_dict.get("LIMIT")
+        where_, params = self._sql_where(sql_dict.get('WHERE'), sql_dict.get('WHERE_NOT'), sql_dict.get('WHERE_OR'),
+                                         sql_dict.get("WHERE_AND_OR"))
+        if limit:
+            params.append(int(limit))
+        shape = ("SELECT", bool(sql_dict.get("DISTINCT")), select, table, self._sql_where_shape(sql_dict.get('WHERE')),
+                 self._sql_where_shape(sql_dict.get('WHERE_NOT')), self._sql_where_shape(sql_dict.get('WHERE_OR')),
+                 sql_dict.get("WHERE_AND_OR") == "AND", bool(limit))
+
+        def build():
+            select_ = "SELECT "
+            if sql_dict.get("DISTINCT"):
+                select_ += "DISTINCT "
+            select_ += "*" if not select else ",".join(select)
+            return " ".join((select_, "FROM " + table, where_, "LIMIT ?" if limit else ""))
+        return self._sql_statement(shape, build), params
+
+    def _sql_insert(self, table, INSERT):
+        '''Return the statement and parameters for inserting the INSERT dictionary at table'''
+        keys = tuple(sorted(map(str, INSERT.keys())))
+        params = [self._sql_param(INSERT[k]) for k in keys]
+
+        def build():
+            return "INSERT INTO " + table + " (" + ",".join(keys) + ") VALUES(" + ",".join(("?",) * len(keys)) + ")"
+        return self._sql_statement(("INSERT", table, keys), build), params
+
+    def _sql_update(self, table, UPDATE, WHERE):
+        '''Return the statement and parameters for updating the UPDATE dictionary at table rows filtered by WHERE'''
+        keys = tuple(sorted(map(str, UPDATE.keys())))
+        params = [self._sql_param(UPDATE[k]) for k in keys]
+        where_, where_params = self._sql_where(WHERE)
+        params += where_params
+
+        def build():
+            cmd = "UPDATE " + table + " SET " + ",".join(k + "=?" for k in keys)
+            if where_:
+                cmd += " " + where_
+            return cmd
+        return self._sql_statement(("UPDATE", table, keys, self._sql_where_shape(WHERE)), build), params
+
+    def _sql_execute(self, statement, params):
+        '''Execute a statement obtained from the query builder at self.cur. When prepared_statements is enabled, the
+        statement is prepared once per connection and executed with user variables as parameters'''
+        self.logger.debug("%s %s", statement["text"], str(params))
+        if not self.prepared_statements:
+            return self.cur.execute(statement["text"], params)
+        prepared = getattr(self.con, "vim_db_prepared", None)
+        if prepared is None:
+            prepared = self.con.vim_db_prepared = {}
+        if prepared.get(statement["name"]) != statement["prepare"]:
+            self.cur.execute("PREPARE " + statement["name"] + " FROM %s", (statement["prepare"],))
+            prepared[statement["name"]] = statement["prepare"]
+            self.sql_cache_stats["prepared"] += 1
+        if not params:
+            return self.cur.execute("EXECUTE " + statement["name"])
+        variables = ["@vim_db_p{}".format(i) for i in range(0, len(params))]
+        self.cur.execute("SET " + ",".join(v + "=%s" for v in variables), params)
+        return self.cur.execute("EXECUTE " + statement["name"] + " USING " + ",".join(variables))
+
+    def get_sql_cache_stats(self):
+        '''Return a dictionary with the query builder cache usage: size, hits, misses, prepared'''
+        stats = self.sql_cache_stats.copy()
+        stats["size"] = len(self.sql_cache)
+        stats["prepared_statements"] = self.prepared_statements
+        return stats
+
+    def load_vlan_index(self):
+        '''Load the vlan_index with the vlans of all the nets at database
+        Return: (number of nets with vlan, None) if ok; (negative, error_text) if error
+        '''
+        r, rows = self.get_table(SELECT=('vlan', 'region'), FROM='nets', WHERE_NOT={'vlan': None})
+        if r < 0:
+            return r, rows
+        self.vlan_index.load(rows)
+        return r, None
+
+    def reconcile_vlan_index(self, dry_run=False):
+        '''Check the vlan_index against the nets at database, logging the differences found, and unless dry_run
+        reload it
+        Return: (number of differences, list of differences) if ok; (negative, error_text) if error
+        '''
+        r, rows = self.get_table(SELECT=('vlan', 'region'), FROM='nets', WHERE_NOT={'vlan': None})
+        if r < 0:
+            return r, rows
+        differences = self.vlan_index.compare(rows)
+        for difference in differences:
+            self.logger.warning("reconcile_vlan_index %s", difference)
+        if not dry_run:
+            self.vlan_index.load(rows)
+        return len(differences), differences
+
+    def get_free_net_vlan(self, region=None):
+        '''obtain a vlan not used in any net of the region, and mark it as used at vlan_index. When the net is not
+        finally created, it must be released with vlan_index.release
+        Return: vlan if ok; negative if error or there is not any free vlan
+        '''
+        if not self.vlan_index.loaded:
+            r, c = self.load_vlan_index()
+            if r < 0:
+                self.logger.error("get_free_net_vlan cannot load vlan index: %s", c)
+                return r
+        vlan = self.vlan_index.allocate(region)
+        if vlan is None:
+            self.logger.error("get_free_net_vlan() region[{}] no free vlan at net_vlan_range:{}-{}".format(
+                region, self.net_vlan_range[0], self.net_vlan_range[1]))
+            return -HTTP_Service_Unavailable
+        self.logger.debug("get_free_net_vlan() region[{}]={}".format(region, vlan))
+        return vlan
+
+    @_pooled
     def get_table(self, **sql_dict):
         ''' Obtain rows from a table.
         Atribure sql_dir: dictionary with the following key: value
@@ -228,62 +531,25 @@ class vim_db():
             'WHERE_NOT': dict of key:values, translated to key!=value AND ... (Optional)
             'WHERE_OR': dict of key:values, translated to key=value OR ... (Optional)
             'WHERE_AND_OR: str 'AND' or 'OR'(by default) mark the priority to 'WHERE AND (WHERE_OR)' or (WHERE) OR WHERE_OR' (Optional)
+                A list or tuple value is translated to key IN (values), or key NOT IN (values) at WHERE_NOT
             'LIMIT': limit of number of rows (Optional)
             'DISTINCT': make a select distinct to remove repeated elements
         Return: a list with dictionarys at each row
         '''
-        #print sql_dict
-        select_ = "SELECT "
-        if sql_dict.get("DISTINCT"):
-            select_ += "DISTINCT "
-        select_ += ("*" if not sql_dict.get('SELECT') else ",".join(map(str,sql_dict['SELECT'])) )
-        #print 'select_', select_
-        from_  = "FROM " + str(sql_dict['FROM'])
-        #print 'from_', from_
-        
-        where_and = None
-        where_or = None
-        w = sql_dict.get('WHERE')
-        if w:
-            where_and = " AND ".join(map( lambda x: str(x) + (" is Null" if w[x] is None else "='"+str(w[x])+"'"),  w.keys()) )
-        w = sql_dict.get('WHERE_NOT')
-        if w:
-            where_and_not = " AND ".join(map( lambda x: str(x) + (" is not Null" if w[x] is None else "!='"+str(w[x])+"'"),  w.keys()) )
-            if where_and:
-                where_and += " AND " + where_and_not
-            else:
-                where_and = where_and_not
-        w = sql_dict.get('WHERE_OR')
-        if w:
-            where_or =  " OR ".join(map( lambda x: str(x) + (" is Null" if w[x] is None else "='"+str(w[x])+"'"),  w.keys()) )
-             
-        if where_and!=None and where_or!=None:
-            if sql_dict.get("WHERE_AND_OR") == "AND":
-                where_ = "WHERE " + where_and + " AND (" + where_or + ")"
-            else:
-                where_ = "WHERE (" + where_and + ") OR " + where_or
-        elif where_and!=None and where_or==None:
-            where_ = "WHERE " + where_and
-        elif where_and==None and where_or!=None:
-            where_ = "WHERE " + where_or
-        else:
-            where_ = ""
-        #print 'where_', where_
-        limit_ = "LIMIT " + str(sql_dict['LIMIT']) if sql_dict.get("LIMIT") else ""
-        #print 'limit_', limit_
-        cmd =  " ".join( (select_, from_, where_, limit_) )
+        statement, params = self._sql_select(sql_dict)
+        cmd = statement["text"]
         for retry_ in range(0,2):
             try:
                 with self.con:
                     self.cur = self.con.cursor(mdb.cursors.DictCursor)
-                    self.logger.debug(cmd)
-                    self.cur.execute(cmd)
+                    self._sql_execute(statement, params)
                     rows = self.cur.fetchall()
                     return self.cur.rowcount, rows
             except (mdb.Error, AttributeError) as e:
                 r,c = self.format_error(e, "get_table", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
         
+    @_pooled
     def new_tenant(self, tenant_dict):
         ''' Add one row into a table.
         Attribure 
@@ -348,6 +614,7 @@ class vim_db():
                     r,c = self.format_error(e, "new_tenant", cmd)
                     if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
+    @_pooled
     def new_row(self, table, INSERT, add_uuid=False, log=False):
         ''' Add one row into a table.
         Atribure 
@@ -372,15 +639,13 @@ class vim_db():
                     self.cur = self.con.cursor()
                     if add_uuid:
                         #inserting new uuid
-                        cmd = "INSERT INTO uuids (uuid, used_at) VALUES ('%s','%s')" % (uuid, table)
-                        self.logger.debug(cmd)
-                        self.cur.execute(cmd)
+                        statement, params = self._sql_insert("uuids", {"uuid": uuid, "used_at": table})
+                        cmd = statement["text"]
+                        self._sql_execute(statement, params)
                     #insertion
-                    cmd= "INSERT INTO " + table +" (" + \
-                        ",".join(map(str, INSERT.keys() ))   + ") VALUES(" + \
-                        ",".join(map(lambda x: 'Null' if x is None else "'"+str(x)+"'", INSERT.values() )) + ")"
-                    self.logger.debug(cmd)
-                    self.cur.execute(cmd)
+                    statement, params = self._sql_insert(table, INSERT)
+                    cmd = statement["text"]
+                    self._sql_execute(statement, params)
                     nb_rows = self.cur.rowcount
                     #inserting new log
                     #if nb_rows > 0 and log:                
@@ -415,15 +680,12 @@ class vim_db():
                     data[k] = data[k].replace("'","_")
     
     def _update_rows_internal(self, table, UPDATE, WHERE={}):
-        cmd= "UPDATE " + table +" SET " + \
-            ",".join(map(lambda x: str(x)+'='+ self.__data2db_format(UPDATE[x]),   UPDATE.keys() ));
-        if WHERE:
-            cmd += " WHERE " + " and ".join(map(lambda x: str(x)+ (' is Null' if WHERE[x] is None else"='"+str(WHERE[x])+"'" ),  WHERE.keys() ))
-        self.logger.debug(cmd)
-        self.cur.execute(cmd) 
+        statement, params = self._sql_update(table, UPDATE, WHERE)
+        self._sql_execute(statement, params)
         nb_rows = self.cur.rowcount
         return nb_rows, None
 
+    @_pooled
     def update_rows(self, table, UPDATE, WHERE={}, log=False):
         ''' Update one or several rows into a table.
         Atributes
@@ -441,12 +703,9 @@ class vim_db():
 
                 with self.con:
                     self.cur = self.con.cursor()
-                    cmd= "UPDATE " + table +" SET " + \
-                        ",".join(map(lambda x: str(x)+'='+ self.__data2db_format(UPDATE[x]),   UPDATE.keys() ));
-                    if WHERE:
-                        cmd += " WHERE " + " and ".join(map(lambda x: str(x)+ (' is Null' if WHERE[x] is None else"='"+str(WHERE[x])+"'" ),  WHERE.keys() ))
-                    self.logger.debug(cmd)
-                    self.cur.execute(cmd) 
+                    statement, params = self._sql_update(table, UPDATE, WHERE)
+                    cmd = statement["text"]
+                    self._sql_execute(statement, params)
                     nb_rows = self.cur.rowcount
                     #if nb_rows > 0 and log:                
                     #    #inserting new log
@@ -461,6 +720,43 @@ class vim_db():
                 r,c = self.format_error(e, "update_rows", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
             
+    @_pooled
+    def update_rows_bulk(self, table, UPDATES, key='uuid'):
+        ''' Update several rows of a table, each one with its own values, in a single statement and transaction.
+        Atributes
+            table: table to be modified
+            UPDATES: dictionary of key_value: {column: new_value}. Rows can update different columns
+            key: column used to identify the rows, 'uuid' by default
+        Return: (result, None) where result indicates the number of updated rows
+        '''
+        if not UPDATES:
+            return 0, None
+        columns = sorted(set(str(c) for row in UPDATES.values() for c in row))
+        key_values = sorted(UPDATES.keys())
+        params = []
+        set_ = []
+        for column in columns:
+            case_ = column + "=CASE " + key
+            for key_value in key_values:
+                if column in UPDATES[key_value]:
+                    case_ += " WHEN %s THEN %s"
+                    params += [key_value, self._sql_param(UPDATES[key_value][column])]
+            set_.append(case_ + " ELSE " + column + " END")
+        params += key_values
+        cmd = "UPDATE " + table + " SET " + ",".join(set_) + " WHERE " + key + " IN (" + \
+              ",".join(("%s",) * len(key_values)) + ")"
+        for retry_ in range(0,2):
+            try:
+                with self.con:
+                    self.cur = self.con.cursor()
+                    self.logger.debug("%s %s", cmd, str(params))
+                    self.cur.execute(cmd, params)
+                    return self.cur.rowcount, None
+            except (mdb.Error, AttributeError) as e:
+                r,c = self.format_error(e, "update_rows_bulk", cmd)
+                if r!=-HTTP_Request_Timeout or retry_==1: return r,c
+
+    @_pooled
     def get_host(self, host_id):
         if af.check_valid_uuid(host_id):
             where_filter="uuid='" + host_id + "'"
@@ -561,6 +857,7 @@ class vim_db():
                 r,c = self.format_error(e, "get_host", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
         
+    @_pooled
     def new_uuid(self):
         max_retries=10
         while max_retries>0:
@@ -570,6 +867,7 @@ class vim_db():
             max_retries-=1
         return uuid
 
+    @_pooled
     def check_uuid(self, uuid):
         '''check in the database if this uuid is already present'''
         try:
@@ -589,6 +887,7 @@ class vim_db():
         rows = self.cur.fetchall()
         return self.cur.rowcount, dict(rows)
     
+    @_pooled
     def edit_host(self, host_id, host_dict):
         #get next port index
         for retry_ in range(0,2):
@@ -621,11 +920,13 @@ class vim_db():
                                     return -HTTP_Bad_Request, "Interface source_name='%s' from numa_socket='%s' not found" % (source_name, str(where["numa_socket"]))
                                 interface_id = row[0]
                                 self._update_rows_internal("resources_port", interface, {"root_id": interface_id})
+                self._refresh_numa_index(host_id)
                 return self.get_host(host_id)
             except (mdb.Error, AttributeError) as e:
                 r,c = self.format_error(e, "edit_host", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
+    @_pooled
     def new_host(self, host_dict):
         #get next port index
         for retry_ in range(0,2):
@@ -740,12 +1041,14 @@ class vim_db():
                     self.logger.debug("callproc('UpdateSwitchPort', () )")
                     self.cur.callproc('UpdateSwitchPort', () )
 
+                self._refresh_numa_index(host_dict['uuid'])
                 self.logger.debug("getting host '%s'",str(host_dict['uuid']))
                 return self.get_host(host_dict['uuid'])
             except (mdb.Error, AttributeError) as e:
                 r,c = self.format_error(e, "new_host", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
+    @_pooled
     def new_flavor(self, flavor_dict, tenant_id ):
         '''Add new flavor into the database. Create uuid if not provided
         Atributes
@@ -803,6 +1106,7 @@ class vim_db():
                 r,c = self.format_error(e, "new_flavor", cmd, "update", tenant_id)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
         
+    @_pooled
     def new_image(self, image_dict, tenant_id):
         '''Add new image into the database. Create uuid if not provided
         Atributes
@@ -857,6 +1161,7 @@ class vim_db():
                 r,c = self.format_error(e, "new_image", cmd, "update", tenant_id)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
         
+    @_pooled
     def delete_image_flavor(self, item_type, item_id, tenant_id):
         '''deletes an image or flavor from database
         item_type must be a 'image' or 'flavor'
@@ -946,6 +1251,7 @@ class vim_db():
                 else: 
                     if result[0]!=-HTTP_Request_Timeout or retry_==1: return result  
             
+    @_pooled
     def delete_row(self, table, uuid):
         for retry_ in range(0,2):
             cmd=""
@@ -969,11 +1275,16 @@ class vim_db():
                         #cmd = "INSERT INTO logs (related,level,uuid,tenant_id,description) VALUES ('%s','debug','%s','%s','delete %s')" % (table, uuid, tenant_str, table[:-1])
                         #self.logger.debug(cmd)
                         #self.cur.execute(cmd)                    
+                if deleted == 1 and table == 'hosts' and self.numa_index is not None:
+                    self.numa_index.remove_host(uuid)
+                elif deleted == 1 and table == 'nets':
+                    self.ip_index.remove_net(uuid)
                 return deleted, table[:-1] + " '%s' %s" %(uuid, "deleted" if deleted==1 else "not found")
             except (mdb.Error, AttributeError) as e:
                 r,c = self.format_error(e, "delete_row", cmd, "delete", 'instances' if table=='hosts' or table=='tenants' else 'dependencies')
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
+    @_pooled
     def delete_row_by_key(self, table, key, value):
         for retry_ in range(0,2):
             cmd=""
@@ -1000,6 +1311,7 @@ class vim_db():
                 r,c = self.format_error(e, "delete_row_by_key", cmd, "delete", 'instances' if table=='hosts' or table=='tenants' else 'dependencies')
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
                 
+    @_pooled
     def delete_row_by_dict(self, **sql_dict):
         ''' Deletes rows from a table.
         Attribute sql_dir: dictionary with the following key: value
@@ -1045,6 +1357,7 @@ class vim_db():
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
     
+    @_pooled
     def get_instance(self, instance_id):
         for retry_ in range(0,2):
             cmd=""
@@ -1153,6 +1466,127 @@ class vim_db():
                 r,c = self.format_error(e, "get_instance", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
         
+    @_pooled
+    def get_placement_rows(self, host_id=None):
+        '''Obtain from database the resources used by the placement index
+        Attributes:
+            host_id: if not None only the resources of this host are retrieved
+        Return: (1, rows) where rows is a dictionary with the keys hosts, used, numas, mem, cores, ports;
+                (negative, error_text) if error
+        '''
+        if host_id:
+            host_filter = " WHERE uuid='{}'".format(host_id)
+            numa_filter = " WHERE n.host_id='{}'".format(host_id)
+        else:
+            host_filter = numa_filter = ""
+        commands = (
+            ("hosts", "SELECT uuid, RAM, cpus, admin_state_up FROM hosts" + host_filter),
+            ("used", "SELECT host_id, sum(ram) as used_ram, sum(vcpus) as used_cpus FROM instances" +
+                (" WHERE host_id='{}'".format(host_id) if host_id else "") + " GROUP BY host_id"),
+            ("numas", "SELECT id, host_id, hugepages, status, admin_state_up FROM numas as n" + numa_filter),
+            ("mem", "SELECT rm.numa_id, sum(rm.consumed) as consumed FROM resources_mem as rm "
+                    "JOIN numas as n on n.id=rm.numa_id" + numa_filter + " GROUP BY rm.numa_id"),
+            ("cores", "SELECT rc.numa_id, rc.core_id, rc.thread_id, rc.instance_id, rc.status FROM resources_core as rc "
+                      "JOIN numas as n on n.id=rc.numa_id" + numa_filter),
+            ("ports", "SELECT rp.id, rp.root_id, rp.numa_id, rp.Mbps, rp.Mbps_used, rp.pci, rp.switch_port, rp.mac, "
+                      "rp.status, rp.instance_id FROM resources_port as rp JOIN numas as n on n.id=rp.numa_id" +
+                      numa_filter),
+        )
+        for retry_ in range(0,2):
+            cmd=""
+            try:
+                with self.con:
+                    self.cur = self.con.cursor(mdb.cursors.DictCursor)
+                    rows = {}
+                    for key, cmd in commands:
+                        self.logger.debug(cmd)
+                        self.cur.execute(cmd)
+                        rows[key] = self.cur.fetchall()
+                    return 1, rows
+            except (mdb.Error, AttributeError) as e:
+                r,c = self.format_error(e, "get_placement_rows", cmd)
+                if r!=-HTTP_Request_Timeout or retry_==1: return r,c
+
+    def load_numa_index(self, index=None, reconcile_period=None):
+        '''Enable the use of an in memory placement index for get_numas.
+        Attributes:
+            index: placement_index already loaded by other connection, to be shared. If None a new one is created
+                and loaded from database
+            reconcile_period: seconds between full reloads of the index from database. None or 0 to disable
+        Return: (1, index) if ok; (negative, error_text) if error
+        '''
+        if index is None:
+            index = placement_index(reconcile_period, self.logger_name + ".index", self.debug)
+            r, rows = self.get_placement_rows()
+            if r < 0:
+                return r, rows
+            index.load(rows)
+        self.numa_index = index
+        return 1, index
+
+    def reconcile_numa_index(self):
+        '''Check the placement index against database, logging the differences found, and reload it
+        Return: (number of differences, list of differences) if ok; (negative, error_text) if error
+        '''
+        if self.numa_index is None:
+            return -HTTP_Bad_Request, "placement index is not enabled"
+        r, rows = self.get_placement_rows()
+        if r < 0:
+            return r, rows
+        differences = self.numa_index.compare(rows)
+        for difference in differences:
+            self.logger.warning("reconcile_numa_index %s", difference)
+        self.numa_index.load(rows)
+        return len(differences), differences
+
+    @_pooled
+    def check_numa_index(self):
+        '''Check the placement index against the stored procedures used by get_numas when the index is not enabled
+        Return: (number of differences, list of differences) if ok; (negative, error_text) if error
+        '''
+        if self.numa_index is None:
+            return -HTTP_Bad_Request, "placement index is not enabled"
+        # stored procedure, column, index key, minimum value returned by the stored procedure
+        checks = (('GetNumaByMemory', 'freemem', 'freemem', 0),
+                  ('GetNumaByThread', 'freethreads', 'freethreads', 1),
+                  ('GetNumaByCore', 'freecores', 'freecores', 1))
+        differences = []
+        for retry_ in range(0,2):
+            cmd=""
+            try:
+                with self.con:
+                    for procedure, column, key, minimum in checks:
+                        self.cur = self.con.cursor(mdb.cursors.DictCursor)
+                        cmd = "CALL {}(0)".format(procedure)
+                        self.logger.debug(cmd)
+                        self.cur.callproc(procedure, (0,))
+                        db_values = dict((row['numa_id'], int(row[column])) for row in self.cur.fetchall())
+                        self.cur.close()
+                        index_values = self.numa_index.summary(key, minimum)
+                        for numa_id in set(db_values.keys()) | set(index_values.keys()):
+                            if db_values.get(numa_id) != index_values.get(numa_id):
+                                differences.append("numa {} {} index={} database={}".format(
+                                    numa_id, key, index_values.get(numa_id), db_values.get(numa_id)))
+                for difference in differences:
+                    self.logger.warning("check_numa_index %s", difference)
+                return len(differences), differences
+            except (mdb.Error, AttributeError) as e:
+                r,c = self.format_error(e, "check_numa_index", cmd)
+                if r!=-HTTP_Request_Timeout or retry_==1: return r,c
+
+    def _refresh_numa_index(self, host_id):
+        '''Update the placement index with the current database content of a host'''
+        if self.numa_index is None or not host_id:
+            return
+        r, rows = self.get_placement_rows(host_id)
+        if r < 0:
+            # index cannot be trusted; force a reconcile before next usage
+            self.logger.error("Cannot refresh placement index for host '%s': %s", host_id, rows)
+            self.numa_index.next_reconcile = 1
+            return
+        self.numa_index.update_host(host_id, rows)
+
+    @_pooled
     def get_numas(self, requirements, prefered_host_id=None, only_of_ports=True):
         '''Obtain a valid NUMA/HOST for deployment a VM
         requirements: contain requirement regarding:
@@ -1169,7 +1603,13 @@ class vim_db():
             that is, with switch_port information filled; if False, all NIC ports are valid. 
         Return a valid numa and host
         '''
-         
+        if self.numa_index is not None:
+            if self.numa_index.reconcile_due():
+                r, c = self.reconcile_numa_index()
+                if r < 0:
+                    self.logger.error("get_numas cannot reconcile placement index: %s", c)
+            return self.numa_index.get_numas(requirements, prefered_host_id, only_of_ports)
+
         for retry_ in range(0,2):
             cmd=""
             try:
@@ -1279,89 +1719,7 @@ class vim_db():
                         self.cur.close()   
                         self.cur = self.con.cursor()
 
-                        #Set/reset reservations
-                        for port in available_ports:
-                            port['Mbps_reserved'] = 0
-                            port['SRIOV_reserved'] = 0
-
-                        #Try to allocate physical ports
-                        physical_ports_found = True
-                        for iface in requirements['numa']['port_list']:
-    #                         print '\t\tchecking iface: '+str(iface)
-                            portFound = False
-                            for port in available_ports:
-    #                             print '\t\t\tfor port: '+str(port)
-                                #If the port is not empty continue
-                                if port['Mbps_free'] != port['Mbps'] or port['Mbps_reserved'] != 0:
-    #                                 print '\t\t\t\t Not empty port'
-                                    continue;
-                                #If the port speed is not enough continue
-                                if port['Mbps'] < iface['bandwidth']:
-    #                                 print '\t\t\t\t Not enough speed'
-                                    continue;
-
-                                #Otherwise this is a valid port  
-                                port['Mbps_reserved'] = port['Mbps']
-                                port['SRIOV_reserved'] = 0
-                                iface['port_id'] = port['port_id']
-                                iface['vlan'] = None
-                                iface['mac'] = port['mac']
-                                iface['switch_port'] = port['switch_port']
-    #                             print '\t\t\t\t Dedicated port found '+str(port['port_id'])
-                                portFound = True
-                                break;
-
-                            #if all ports have been checked and no match has been found
-                            #this is not a valid numa
-                            if not portFound:
-    #                             print '\t\t\t\t\tAll ports have been checked and no match has been found for numa '+str(numa_id)+'\n\n'
-                                physical_ports_found = False
-                                break
-
-                        #if there is no match continue checking the following numa
-                        if not physical_ports_found:
-                            continue
-
-                        #Try to allocate SR-IOVs
-                        sriov_ports_found = True
-                        for iface in requirements['numa']['sriov_list']:
-    #                         print '\t\tchecking iface: '+str(iface)
-                            portFound = False
-                            for port in available_ports:
-    #                             print '\t\t\tfor port: '+str(port)
-                                #If there are not available SR-IOVs continue
-                                if port['availableSRIOV'] - port['SRIOV_reserved'] <= 0:
-    #                                 print '\t\t\t\t Not enough SR-IOV'
-                                    continue;
-                                #If the port free speed is not enough continue
-                                if port['Mbps_free'] - port['Mbps_reserved'] < iface['bandwidth']:
-    #                                 print '\t\t\t\t Not enough speed'
-                                    continue;
-
-                                #Otherwise this is a valid port  
-                                port['Mbps_reserved'] += iface['bandwidth']
-                                port['SRIOV_reserved'] += 1
-    #                             print '\t\t\t\t SR-IOV found '+str(port['port_id'])
-                                iface['port_id'] = port['port_id']
-                                iface['vlan'] = None
-                                iface['mac'] = port['mac']
-                                iface['switch_port'] = port['switch_port']
-                                portFound = True
-                                break;
-
-                            #if all ports have been checked and no match has been found
-                            #this is not a valid numa
-                            if not portFound:
-    #                             print '\t\t\t\t\tAll ports have been checked and no match has been found for numa '+str(numa_id)+'\n\n'
-                                sriov_ports_found = False
-                                break
-
-                        #if there is no match continue checking the following numa
-                        if not sriov_ports_found:
-                            continue
-
-
-                        if sriov_ports_found and physical_ports_found:
+                        if allocate_numa_ports(requirements, available_ports):
                             match_found = True
                             break
 
@@ -1381,9 +1739,11 @@ class vim_db():
                 r,c = self.format_error(e, "get_numas", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
+    @_pooled
     def new_instance(self, instance_dict, nets, ports_to_free):
         for retry_ in range(0,2):
             cmd=""
+            dhcp_ips = []   # (net_id, ip_address) allocated at ip_index, released if not inserted
             try:
                 with self.con:
                     self.cur = self.con.cursor()
@@ -1425,9 +1785,9 @@ class vim_db():
                             dhcp_cidr = iface["cidr"]
                             del iface["cidr"]
                             del iface["enable_dhcp"]
-                            used_dhcp_ips = self._get_dhcp_ip_used_list(iface["net_id"])
-                            iface["ip_address"] = self.get_free_ip_from_range(dhcp_first_ip, dhcp_last_ip,
-                                                                              dhcp_cidr, used_dhcp_ips)
+                            iface["ip_address"] = self._allocate_dhcp_ip(iface["net_id"], dhcp_first_ip,
+                                                                         dhcp_last_ip, dhcp_cidr)
+                            dhcp_ips.append((iface["net_id"], iface["ip_address"]))
                             if 'links' in iface:
                                 del iface['links']
                             if 'dns' in iface:
@@ -1539,8 +1899,11 @@ class vim_db():
                     #self.cur.execute(cmd)                    
 
                     #inseted ok
+                self._refresh_numa_index(instance_dict.get('host_id'))
                 return 1, uuid 
             except (mdb.Error, AttributeError) as e:
+                for net_id, ip_address in dhcp_ips:
+                    self.ip_index.release(net_id, ip_address)
                 r,c = self.format_error(e, "new_instance", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
@@ -1551,21 +1914,23 @@ class vim_db():
         :param last_ip: Last dhcp ip range
         :param cidr: net cidr
         :param ip_used_list: contain all used ips to avoid ip collisions
-        :return:
+        :return: the lowest free ip address, or None if all are used
         """
-        ip_tools = IPNetwork(cidr)
-        cidr_len = ip_tools.prefixlen
-        ips = IPNetwork(first_ip + '/' + str(cidr_len))
-
-        ip_used_list.append(str(ips[1]))  # gw ip
-        ip_used_list.append(str(ips[-1]))  # broadcast ip
-        ip_used_list.append(first_ip)
+        return ip_range(first_ip, last_ip, cidr, ip_used_list).allocate()
 
-        for vm_ip in ips:
-            if str(vm_ip) not in ip_used_list and IPAddress(first_ip) <= IPAddress(vm_ip) <= IPAddress(last_ip):
-                return vm_ip
-
-        return None
+    def _allocate_dhcp_ip(self, net_id, first_ip, last_ip, cidr):
+        """
+        Obtain a free IP of the dhcp range of a net from the ip_index, that is loaded from DB the first time the net is
+        used or when its dhcp range has changed. The IP is marked as used
+        :param net_id: net uuid
+        :param first_ip: First dhcp ip range
+        :param last_ip: Last dhcp ip range
+        :param cidr: net cidr
+        :return: the lowest free ip address, or None if all are used
+        """
+        if not self.ip_index.is_loaded(net_id, first_ip, last_ip, cidr):
+            self.ip_index.load_net(net_id, first_ip, last_ip, cidr, self._get_dhcp_ip_used_list(net_id))
+        return self.ip_index.allocate(net_id)
 
     def _get_dhcp_ip_used_list(self, net_id):
         """
@@ -1585,8 +1950,7 @@ class vim_db():
                 where_ = "WHERE " + " AND ".join(
                     map(lambda x: str(x) + (" is Null" if WHERE[x] is None else "='" + str(WHERE[x]) + "'"),
                         WHERE.keys()))
-            limit_ = "LIMIT 100"
-            cmd = " ".join((select_, where_, limit_))
+            cmd = " ".join((select_, where_))
             self.logger.debug(cmd)
             self.cur.execute(cmd)
             ports = self.cur.fetchall()
@@ -1597,6 +1961,7 @@ class vim_db():
             return ip_address_list
 
 
+    @_pooled
     def delete_instance(self, instance_id, tenant_id, net_dataplane_list, ports_to_free, net_ovs_list, logcause="requested by http"):
         for retry_ in range(0,2):
             cmd=""
@@ -1604,10 +1969,11 @@ class vim_db():
                 with self.con:
                     self.cur = self.con.cursor()
                     #get INSTANCE
-                    cmd = "SELECT uuid FROM instances WHERE uuid='%s' AND tenant_id='%s'" % (instance_id, tenant_id)
+                    cmd = "SELECT uuid, host_id FROM instances WHERE uuid='%s' AND tenant_id='%s'" % (instance_id, tenant_id)
                     self.logger.debug(cmd)
                     self.cur.execute(cmd)
                     if self.cur.rowcount == 0 : return 0, "instance %s not found in tenant %s" % (instance_id, tenant_id)
+                    host_id = self.cur.fetchone()[1]
 
                     #delete bridged ifaces, instace_devices, resources_mem; done by database: it is automatic by Database; FOREIGN KEY DELETE CASCADE
                     
@@ -1624,7 +1990,8 @@ class vim_db():
                             "type='instance:ovs'".format(instance_id)
                     self.logger.debug(cmd)
                     self.cur.execute(cmd)
-                    net_ovs_list += self.cur.fetchall()
+                    ovs_ports = self.cur.fetchall()
+                    net_ovs_list += ovs_ports
 
                     #get dataplane interfaces releases by this VM; both PF and VF with no other VF 
                     cmd="SELECT source_name, mac FROM (SELECT root_id, count(instance_id) as used FROM resources_port WHERE instance_id='%s' GROUP BY root_id ) AS A" % instance_id \
@@ -1668,12 +2035,16 @@ class vim_db():
                     #delete instance
                     cmd = "DELETE FROM instances WHERE uuid='%s' AND tenant_id='%s'" % (instance_id, tenant_id)
                     self.cur.execute(cmd)
-                    return 1, "instance %s from tenant %s DELETED" % (instance_id, tenant_id)
+                for net_id, _, ip_address, _ in ovs_ports:
+                    self.ip_index.release(net_id, ip_address)
+                self._refresh_numa_index(host_id)
+                return 1, "instance %s from tenant %s DELETED" % (instance_id, tenant_id)
 
             except (mdb.Error, AttributeError) as e:
                 r,c = self.format_error(e, "delete_instance", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
 
+    @_pooled
     def get_ports(self, WHERE):
         ''' Obtain ports using the WHERE filtering.
         Attributes:
@@ -1705,6 +2076,7 @@ class vim_db():
                 r,c = self.format_error(e, "get_ports", cmd)
                 if r!=-HTTP_Request_Timeout or retry_==1: return r,c
         
+    @_pooled
     def check_target_net(self, net_id, tenant_id, port_type):
         '''check if valid attachement of a port into a target net
         Attributes:
@@ -115,6 +115,8 @@ config_schema = {
                 "password": {"type": "string"},
                 "key": path_schema,         # for backward compatibility, use keyfile instead
                 "keyfile": path_schema,
+                "bulk_leases": {"type": "boolean"},
+                "leases_file": path_schema,
                 "bridge_ifaces": {
                     "type": "array",
                     "items": nameshort_schema,
@@ -135,6 +137,27 @@ config_schema = {
         "ovs_controller_user": nameshort_schema,
         "ovs_controller_password": {"type": "string"},
         "ovs_controller_keyfile": path_schema,
+        "db_pool_min": integer0_schema,
+        "db_pool_max": integer0_schema,
+        "db_prepared_statements": {"type": "boolean"},
+        "of_flows_snapshot_period": integer0_schema,
+        "of_update_debounce": {"type": "number", "minimum": 0},
+        "of_flows_cache_size": integer0_schema,
+        "of_timeout": {"type": "number", "minimum": 0},
+        "of_connect_timeout": {"type": "number", "minimum": 0},
+        "of_retries": integer0_schema,
+        "of_retry_backoff": {"type": "number", "minimum": 0},
+        "of_pool_size": {"type": "integer", "minimum": 1},
+        "of_concurrency": {"type": "integer", "minimum": 1},
+        "of_port_maps_path": path_schema,
+        "of_port_check_period": integer0_schema,
+        "placement_index": {"type": "boolean"},
+        "host_status_events": {"type": "boolean"},
+        "host_status_reconcile_period": {"type": "integer", "minimum": 5},
+        "host_workers": {"type": "integer", "minimum": 1},
+        "host_image_transfers": {"type": "integer", "minimum": 1},
+        "host_image_cache_quota": {"type": "number", "minimum": 0},
+        "placement_index_reconcile_period": integer0_schema,
     },
     "patternProperties": {
         "of_*" : {"type": ["string", "integer", "boolean"]}
@@ -722,7 +745,8 @@ localinfo_schema = {
     "properties":{
         "files":{ "type": "object"},
         "inc_files":{ "type": "object"},
-        "server_files":{ "type": "object"}
+        "server_files":{ "type": "object"},
+        "images":{ "type": "object"}
     },
     "required": ["files"]
 }
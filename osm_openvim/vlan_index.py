@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+In memory index of the vlan tags used by the nets of each region, used for selecting the vlan of a new net without
+reading the nets table in chunks at every net creation.
+The index is loaded from the database by vim_db at start, and updated by ovim when nets are created, edited or deleted
+'''
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import threading
+import logging
+
+_FREE = b'\x00'
+_VLANS = 4096
+
+
+class vlan_index():
+    '''Used vlans of each region, as a 4096 bytes array indexed by vlan tag with the number of nets using it.
+    New vlans are taken after the last one taken at the region, starting again from the beginning of the range at
+    the end, so that the vlans of deleted nets are not reused at once.
+    All the methods are thread safe, as the index is shared by the several vim_db connections of ovim
+    '''
+
+    def __init__(self, vlan_range, logger_name=None, debug=None):
+        '''vlan_range: tuple (vlan_ini, vlan_end) with the vlans used for new nets; vlan_end is not included'''
+        self.vlan_range = vlan_range
+        self.regions = {}   # region: bytearray with the number of nets using each vlan
+        self.lastused = {}  # region: last vlan taken
+        self.lock = threading.Lock()
+        self.loaded = False
+        if logger_name:
+            self.logger_name = logger_name
+        else:
+            self.logger_name = 'openvim.db.vlan_index'
+        self.logger = logging.getLogger(self.logger_name)
+        if debug:
+            self.logger.setLevel(getattr(logging, debug))
+
+    @staticmethod
+    def _vlan(vlan):
+        '''Return the vlan as an integer, or None if it is not a valid vlan tag'''
+        try:
+            vlan = int(vlan)
+        except (TypeError, ValueError):
+            return None
+        if 0 < vlan < _VLANS:
+            return vlan
+        return None
+
+    @classmethod
+    def _build(cls, rows):
+        '''Build the region arrays from the database rows of nets with 'vlan' and 'region' '''
+        regions = {}
+        for net in rows:
+            vlan = cls._vlan(net['vlan'])
+            if vlan is None:
+                continue
+            used = regions.get(net['region'])
+            if used is None:
+                used = regions[net['region']] = bytearray(_VLANS)
+            if used[vlan] < 255:
+                used[vlan] += 1
+        return regions
+
+    def load(self, rows):
+        '''Replace the whole index content with the database rows of the nets. The last vlan taken is kept'''
+        regions = self._build(rows)
+        with self.lock:
+            self.regions = regions
+            self.loaded = True
+        self.logger.debug("loaded %d regions, %d used vlans", len(regions),
+                          sum(_VLANS - used.count(_FREE) for used in regions.values()))
+
+    def _used(self, region):
+        used = self.regions.get(region)
+        if used is None:
+            used = self.regions[region] = bytearray(_VLANS)
+        return used
+
+    def allocate(self, region):
+        '''Mark as used and return a free vlan of the range at the region, or None if all are used'''
+        vlan_ini, vlan_end = self.vlan_range
+        with self.lock:
+            used = self._used(region)
+            start = max(vlan_ini, self.lastused.get(region, vlan_ini - 1) + 1)
+            vlan = used.find(_FREE, start, vlan_end)
+            if vlan < 0:
+                vlan = used.find(_FREE, vlan_ini, vlan_end)
+                if vlan < 0:
+                    return None
+            used[vlan] = 1
+            self.lastused[region] = vlan
+            return vlan
+
+    def mark(self, region, vlan):
+        '''Account one more net using this vlan at the region'''
+        vlan = self._vlan(vlan)
+        if vlan is None:
+            return
+        with self.lock:
+            used = self._used(region)
+            if used[vlan] < 255:
+                used[vlan] += 1
+
+    def release(self, region, vlan):
+        '''Account one less net using this vlan at the region'''
+        vlan = self._vlan(vlan)
+        if vlan is None:
+            return
+        with self.lock:
+            used = self.regions.get(region)
+            if used is not None and used[vlan] > 0:
+                used[vlan] -= 1
+
+    def compare(self, rows):
+        '''Compare the index content with the database rows of the nets
+        Return: list of text differences, empty if index is consistent
+        '''
+        regions = self._build(rows)
+        differences = []
+        with self.lock:
+            for region in set(regions.keys()) | set(self.regions.keys()):
+                index_used = self.regions.get(region) or bytearray(_VLANS)
+                db_used = regions.get(region) or bytearray(_VLANS)
+                if index_used == db_used:
+                    continue
+                for vlan in range(1, _VLANS):
+                    if index_used[vlan] != db_used[vlan]:
+                        differences.append("region {} vlan {} nets index={} database={}".format(
+                            region, vlan, index_used[vlan], db_used[vlan]))
+        return differences
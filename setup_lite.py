@@ -32,6 +32,7 @@ _req = [
     "PyYAML",
     "requestsexceptions",
     "netaddr",
+    "ijson",
     "bottle",
     #"MySQL-python",
     #"mysqlclient",
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Benchmark of openflow_thread._compute_net_flows for dataplane nets with a growing number of ports, connected to an
+OfTestConnector that knows all their switch ports. For each size it prints the number of flows, the time per
+computation and the growth of the time against the previous size (4 when the time grows with the square of ports).
+Usage: ./benchmark_flow_computation.py [max_ports] [repetitions]
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import openflow_thread as oft
+import openflow_conn
+
+
+def build_nets(ports):
+    '''Return a data net with the given number of ports, half of them vlan tagged, and the switch ports used'''
+    net = {"uuid": "net-{}".format(ports), "bind_net": None, "bind_type": None, "ports": []}
+    for index in range(0, ports):
+        net["ports"].append({
+            "uuid": "port-{}".format(index),
+            "vlan": 100 + index if index % 2 else None,
+            "switch_port": "Te0/{}".format(index),
+            "mac": "52:54:00:{:02x}:{:02x}:{:02x}".format(index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff),
+        })
+    return [net]
+
+
+def measure(thread, ports, repetitions):
+    nets = build_nets(ports)
+    for port in nets[0]["ports"]:
+        thread.OF_connector.pp2ofi[port["switch_port"]] = port["switch_port"]
+    start = time.time()
+    for _ in range(0, repetitions):
+        result, flows = thread._compute_net_flows(nets)
+    elapsed = (time.time() - start) / repetitions
+    if result < 0:
+        raise Exception(flows)
+    return len(flows), elapsed
+
+
+if __name__ == "__main__":
+    max_ports = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    of_connector = openflow_conn.OfTestConnector({"name": "benchmark", "dpid": "00:01:02:03:04:05:06:07"})
+    thread = oft.openflow_thread("Default", of_connector, None, threading.Lock(), False,
+                                 logger_name="openvim.benchmark", port_check_period=0)
+    previous = None
+    ports = 2
+    while ports <= max_ports:
+        flows, elapsed = measure(thread, ports, repetitions)
+        growth = "{:.2f}".format(elapsed / previous) if previous else "-"
+        print "ports={:4} flows={:6} time={:10.2f}ms growth={}".format(ports, flows, 1000 * elapsed, growth)
+        previous = elapsed
+        ports *= 2
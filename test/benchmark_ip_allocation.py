@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Benchmark of the dhcp ip address allocation of OVS nets for /24, /20 and /16 ranges, with the default dhcp range
+of a net (from the 4th to the last but one address) and the lowest addresses already used by ports. For each range it
+prints the time for loading the ip_index bitmap of the net from the used addresses, the time per allocation with the
+bitmap, and the time per allocation of the former scan of the whole range against the list of used addresses.
+Usage: ./benchmark_ip_allocation.py [used_ports] [allocations]
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import time
+from netaddr import IPNetwork, IPAddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import ip_index
+
+
+def scan_free_ip(first_ip, last_ip, cidr, ip_used_list):
+    '''Former vim_db.get_free_ip_from_range'''
+    ip_tools = IPNetwork(cidr)
+    cidr_len = ip_tools.prefixlen
+    ips = IPNetwork(first_ip + '/' + str(cidr_len))
+
+    ip_used_list.append(str(ips[1]))  # gw ip
+    ip_used_list.append(str(ips[-1]))  # broadcast ip
+    ip_used_list.append(first_ip)
+
+    for vm_ip in ips:
+        if str(vm_ip) not in ip_used_list and IPAddress(first_ip) <= IPAddress(vm_ip) <= IPAddress(last_ip):
+            return vm_ip
+    return None
+
+
+def measure(prefix, used_ports, allocations):
+    cidr = "10.0.0.0/{}".format(prefix)
+    ips = IPNetwork(cidr)
+    first_ip = str(ips[3])
+    last_ip = str(ips[-2])
+    used_ports = min(used_ports, len(ips) - 8 - allocations)
+    used = [str(ips[4 + index]) for index in range(0, used_ports)]
+
+    start = time.time()
+    index = ip_index.ip_index("openvim.benchmark")
+    index.load_net("net", first_ip, last_ip, cidr, used)
+    load = time.time() - start
+
+    start = time.time()
+    for _ in range(0, allocations):
+        ip = index.allocate("net")
+    bitmap = (time.time() - start) / allocations
+    if ip != str(ips[4 + used_ports + allocations - 1]):
+        raise Exception("unexpected ip {}".format(ip))
+
+    # the former scan reads the used addresses from database at every allocation
+    scan_used = list(used)
+    start = time.time()
+    for _ in range(0, allocations):
+        ip = scan_free_ip(first_ip, last_ip, cidr, list(scan_used))
+        scan_used.append(str(ip))
+    scan = (time.time() - start) / allocations
+    return len(ips), used_ports, load, bitmap, scan
+
+
+if __name__ == "__main__":
+    used_ports = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    allocations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    for prefix in (24, 20, 16):
+        addresses, used, load, bitmap, scan = measure(prefix, used_ports, allocations)
+        print "/{} addresses={:6} used={:6} load={:8.2f}ms bitmap={:8.2f}us/ip scan={:10.2f}us/ip speedup={:.0f}".format(
+            prefix, addresses, used, 1000 * load, 1000000 * bitmap, 1000000 * scan, scan / bitmap)
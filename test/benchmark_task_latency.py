@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Benchmark of the latency from the insertion of a task at a worker thread queue until the thread starts processing it.
+It compares the blocking queue loop of openflow_thread with the former loop, that polled the queue and slept one
+second when it was empty.
+Usage: ./benchmark_task_latency.py [number_of_tasks]
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import time
+import random
+import threading
+import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import openflow_thread as oft
+
+
+class bench_db():
+    '''Database stand-in, only the calls done when processing 'update-net' with update_of_flows replaced'''
+    def update_rows(self, table, UPDATE, WHERE={}, log=False):
+        return 1, None
+
+
+class bench_thread(oft.openflow_thread):
+    '''openflow_thread that records when each 'update-net' task starts to be processed'''
+    def __init__(self):
+        oft.openflow_thread.__init__(self, "Default", None, bench_db(), threading.Lock(), True,
+                                     logger_name="openvim.benchmark", update_debounce=0)
+        self.daemon = True
+        self.started = {}
+        self.done = threading.Event()
+        self.expected = 0
+
+    def update_of_flows(self, net_id, updated_nets=None, planned_flows=None):
+        self.started[net_id] = time.time()
+        if len(self.started) == self.expected:
+            self.done.set()
+        return 0, None
+
+
+class bench_polling_thread(bench_thread):
+    '''Former loop: check queue, sleep one second if empty'''
+    def run(self):
+        queue_lock = threading.Lock()
+        while True:
+            queue_lock.acquire()
+            if not self.taskQueue.empty():
+                task = self.taskQueue.get()
+            else:
+                task = None
+            queue_lock.release()
+            if task is None:
+                time.sleep(1)
+                continue
+            if task[0] == 'update-net':
+                self.update_of_flows(task[1])
+            elif task[0] == 'exit':
+                return 0
+
+
+def measure(thread_class, tasks):
+    thread = thread_class()
+    thread.expected = tasks
+    thread.start()
+    inserted = {}
+    for index in range(0, tasks):
+        time.sleep(random.uniform(0, 0.5))
+        net_id = "net-{}".format(index)
+        inserted[net_id] = time.time()
+        thread.insert_task("update-net", net_id)
+    thread.done.wait(tasks + 5)
+    thread.insert_task("exit")
+    thread.join(5)
+    latencies = sorted(thread.started[net_id] - inserted[net_id] for net_id in thread.started)
+    if not latencies:
+        raise Exception("no task was processed by {}".format(thread_class.__name__))
+    return {
+        "tasks": len(latencies),
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "max_ms": 1000 * latencies[-1],
+    }
+
+
+if __name__ == "__main__":
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for name, thread_class in (("polling (before)", bench_polling_thread), ("blocking (after)", bench_thread)):
+        result = measure(thread_class, tasks)
+        print "{:18} tasks={tasks} mean={mean_ms:.2f}ms p50={p50_ms:.2f}ms p99={p99_ms:.2f}ms max={max_ms:.2f}ms"\
+            .format(name, **result)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Unit tests of the dhcp leases parsers of dhcp_thread.
+Usage: nosetests test/test_dhcp_thread.py
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import dhcp_thread
+
+ISC_LEASES = """# The format of this file is documented in the dhcpd.leases(5) manual page.
+# This lease file was written by isc-dhcp-4.2.4
+
+lease 10.0.0.5 {
+  starts 4 2017/10/05 10:00:00;
+  ends 4 2017/10/05 22:00:00;
+  binding state active;
+  next binding state free;
+  hardware ethernet 52:54:00:AA:00:01;
+}
+lease 10.0.0.6 {
+  starts 4 2017/10/05 10:00:00;
+  binding state free;
+  hardware ethernet 52:54:00:aa:00:02;
+}
+"""
+
+
+class TestParseIscLeases(unittest.TestCase):
+
+    def test_active_leases(self):
+        leases = {}
+        parsed = dhcp_thread.parse_isc_leases(ISC_LEASES, leases)
+        self.assertEqual(parsed, len(ISC_LEASES))
+        # mac addresses in lowercase; not active leases are ignored
+        self.assertEqual(leases, {"52:54:00:aa:00:01": "10.0.0.5"})
+
+    def test_last_lease_of_a_mac(self):
+        leases = {"52:54:00:aa:00:01": "10.0.0.2"}
+        text = ISC_LEASES + "lease 10.0.0.7 {\n  binding state active;\n  hardware ethernet 52:54:00:aa:00:01;\n}\n"
+        dhcp_thread.parse_isc_leases(text, leases)
+        self.assertEqual(leases, {"52:54:00:aa:00:01": "10.0.0.7"})
+
+    def test_incomplete_lease(self):
+        leases = {}
+        partial = "lease 10.0.0.8 {\n  binding state active;\n  hardware ethernet 52:54:00:aa:00:03;\n"
+        parsed = dhcp_thread.parse_isc_leases(ISC_LEASES + partial, leases)
+        # the incomplete lease at the end is not parsed, so it is parsed again with the rest of the file
+        self.assertEqual(parsed, len(ISC_LEASES))
+        self.assertNotIn("52:54:00:aa:00:03", leases)
+        dhcp_thread.parse_isc_leases((ISC_LEASES + partial + "}\n")[parsed:], leases)
+        self.assertEqual(leases["52:54:00:aa:00:03"], "10.0.0.8")
+
+    def test_incomplete_line(self):
+        leases = {}
+        text = ISC_LEASES + "lease 10.0.0.8 {"
+        self.assertEqual(dhcp_thread.parse_isc_leases(text, leases), len(ISC_LEASES))
+        self.assertEqual(dhcp_thread.parse_isc_leases("", leases), 0)
+
+
+class TestParseDnsmasqLeases(unittest.TestCase):
+
+    def test_leases(self):
+        text = "1507200000 52:54:00:AA:00:01 10.0.0.5 vm1 *\n1507200000 52:54:00:aa:00:02 10.0.0.6 * *\n\n"
+        self.assertEqual(dhcp_thread.parse_dnsmasq_leases(text),
+                         {"52:54:00:aa:00:01": "10.0.0.5", "52:54:00:aa:00:02": "10.0.0.6"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Unit tests of ip_index: the address bitmap of a dhcp range and the per net index used by vim_db.
+Usage: nosetests test/test_ip_index.py
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import ip_index
+
+
+class TestIpRange(unittest.TestCase):
+
+    def test_first_ip_is_not_assigned(self):
+        net = ip_index.ip_range("10.0.0.3", "10.0.0.10", "10.0.0.0/24")
+        self.assertEqual(net.allocate(), "10.0.0.4")
+        self.assertEqual(net.used, 2)
+
+    def test_gateway_and_broadcast_are_not_assigned(self):
+        net = ip_index.ip_range("10.0.0.0", "10.0.0.255", "10.0.0.0/24")
+        self.assertEqual(len(net.bitmap), 256)
+        self.assertEqual(net.used, 3)   # first ip (dhcp server), gateway .1 and broadcast .255
+        self.assertEqual(net.allocate(), "10.0.0.2")
+        allocated = [net.allocate() for _ in range(0, 252)]
+        self.assertEqual(allocated[-1], "10.0.0.254")
+        self.assertIsNone(net.allocate())
+        self.assertFalse(net.mark("10.0.0.1"))
+
+    def test_last_ip_is_limited_to_the_network(self):
+        net = ip_index.ip_range("10.0.0.250", "10.0.1.20", "10.0.0.0/24")
+        self.assertEqual(len(net.bitmap), 6)    # .250 to .255
+        self.assertEqual([net.allocate() for _ in range(0, 5)], ["10.0.0.251", "10.0.0.252", "10.0.0.253",
+                                                                 "10.0.0.254", None])
+
+    def test_used_ips(self):
+        net = ip_index.ip_range("10.0.0.3", "10.0.0.10", "10.0.0.0/24",
+                                ["10.0.0.4", "10.0.0.5", "10.0.0.7", "10.1.1.1", None, ""])
+        self.assertEqual(net.used, 4)   # out of range and empty addresses are ignored
+        self.assertEqual(net.allocate(), "10.0.0.6")
+        self.assertEqual(net.allocate(), "10.0.0.8")
+
+    def test_mark(self):
+        net = ip_index.ip_range("10.0.0.3", "10.0.0.10", "10.0.0.0/24")
+        self.assertTrue(net.mark("10.0.0.4"))
+        self.assertFalse(net.mark("10.0.0.4"))
+        self.assertFalse(net.mark("10.0.0.11"))
+        self.assertFalse(net.mark("not an ip"))
+        self.assertEqual(net.used, 2)
+
+    def test_release_and_lowest_free(self):
+        net = ip_index.ip_range("10.0.0.3", "10.0.0.10", "10.0.0.0/24")
+        allocated = [net.allocate() for _ in range(0, 7)]
+        self.assertEqual(allocated, ["10.0.0.{}".format(i) for i in range(4, 11)])
+        self.assertIsNone(net.allocate())
+        self.assertEqual(net.lowest_free, len(net.bitmap))
+        self.assertTrue(net.release("10.0.0.8"))
+        self.assertTrue(net.release("10.0.0.5"))
+        self.assertFalse(net.release("10.0.0.5"))
+        self.assertFalse(net.release("10.0.0.20"))
+        self.assertEqual(net.lowest_free, 2)
+        self.assertEqual(net.used, 6)
+        # the lowest released address is assigned first, and then the next free one
+        self.assertEqual(net.allocate(), "10.0.0.5")
+        self.assertEqual(net.allocate(), "10.0.0.8")
+        self.assertIsNone(net.allocate())
+
+
+class TestIpIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ip_index.ip_index(logger_name="openvim.test.ip_index")
+
+    def test_not_loaded(self):
+        self.assertFalse(self.index.is_loaded("net1", "10.0.0.3", "10.0.0.10", "10.0.0.0/24"))
+        self.assertIsNone(self.index.allocate("net1"))
+        self.index.release("net1", "10.0.0.4")     # ignored
+
+    def test_load_allocate_release(self):
+        self.index.load_net("net1", "10.0.0.3", "10.0.0.10", "10.0.0.0/24", ["10.0.0.4"])
+        self.assertTrue(self.index.is_loaded("net1", "10.0.0.3", "10.0.0.10", "10.0.0.0/24"))
+        self.assertFalse(self.index.is_loaded("net1", "10.0.0.3", "10.0.0.20", "10.0.0.0/24"))
+        self.assertEqual(self.index.allocate("net1"), "10.0.0.5")
+        self.index.release("net1", "10.0.0.4")
+        self.assertEqual(self.index.allocate("net1"), "10.0.0.4")
+        self.assertIsNone(self.index.allocate("net2"))
+
+    def test_remove_net(self):
+        self.index.load_net("net1", "10.0.0.3", "10.0.0.10", "10.0.0.0/24", [])
+        self.index.remove_net("net1")
+        self.index.remove_net("net1")
+        self.assertFalse(self.index.is_loaded("net1", "10.0.0.3", "10.0.0.10", "10.0.0.0/24"))
+        self.assertIsNone(self.index.allocate("net1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
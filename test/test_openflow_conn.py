@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Unit tests of openflow_conn.iter_json, with ijson when installed and with the fallback that decodes the whole response.
+Usage: nosetests test/test_openflow_conn.py
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import json
+import io
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import openflow_conn
+
+RESPONSE = {"flows": [{"name": "f1", "priority": 1000}, {"name": "f2", "priority": 2000}],
+            "switches": {"00:01": {"flows": [{"name": "f3"}]}, "00:02": {"flows": []}}}
+
+
+class FakeResponse():
+    '''requests response with the content of a json text'''
+
+    def __init__(self, text):
+        self.text = text
+        self.raw = io.BytesIO(text.encode("utf-8"))
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class TestIterJson(unittest.TestCase):
+    use_ijson = False
+
+    def setUp(self):
+        self.ijson = openflow_conn.ijson
+        if not self.use_ijson:
+            openflow_conn.ijson = None
+        elif not self.ijson:
+            self.skipTest("python ijson is not installed")
+
+    def tearDown(self):
+        openflow_conn.ijson = self.ijson
+
+    def iter_json(self, content, prefix, key_value=False):
+        return list(openflow_conn.iter_json(FakeResponse(json.dumps(content)), prefix, key_value))
+
+    def test_list_items(self):
+        self.assertEqual([flow["name"] for flow in self.iter_json(RESPONSE, "flows.item")], ["f1", "f2"])
+
+    def test_nested_list_items(self):
+        flows = self.iter_json([{"flows": [{"name": "f1"}]}, {"flows": [{"name": "f2"}, {"name": "f3"}]}],
+                               "item.flows.item")
+        self.assertEqual(flows, [{"name": "f1"}, {"name": "f2"}, {"name": "f3"}])
+
+    def test_key_value(self):
+        switches = dict(self.iter_json(RESPONSE, "switches", key_value=True))
+        self.assertEqual(sorted(switches.keys()), ["00:01", "00:02"])
+        self.assertEqual(switches["00:01"], {"flows": [{"name": "f3"}]})
+
+    def test_missing_prefix(self):
+        self.assertEqual(self.iter_json(RESPONSE, "ports.item"), [])
+
+    def test_not_a_dict(self):
+        with self.assertRaises(ValueError):
+            self.iter_json(RESPONSE, "flows", key_value=True)
+
+    def test_bad_json(self):
+        response = FakeResponse('{"flows": [{"name": ')
+        with self.assertRaises(ValueError):
+            list(openflow_conn.iter_json(response, "flows.item"))
+
+
+class TestIterJsonIjson(TestIterJson):
+    use_ijson = True
+
+    def test_not_a_dict(self):
+        if not hasattr(openflow_conn.ijson, "kvitems"):
+            return TestIterJson.test_not_a_dict(self)
+        # kvitems skips the elements at prefix that are not a dictionary
+        self.assertEqual(self.iter_json(RESPONSE, "flows", key_value=True), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
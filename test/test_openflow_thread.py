@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Unit tests of the comparison of flows of openflow_thread, between computed and database flows and against the
+controller rules.
+Usage: nosetests test/test_openflow_thread.py
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import openflow_thread as oft
+import openflow_conn
+
+flow_key = oft.openflow_thread.flow_key
+
+
+def build_flow(name, vlan_id=None, ingress_port="Te0/1", actions=(("vlan", None), ("out", "Te0/2")), **kwargs):
+    flow = {"name": name, "net_id": "net1", "priority": 1000, "vlan_id": vlan_id, "ingress_port": ingress_port,
+            "actions": [tuple(action) for action in actions]}
+    flow.update(kwargs)
+    return flow
+
+
+class TestFlowKey(unittest.TestCase):
+
+    def test_name_is_ignored(self):
+        self.assertEqual(flow_key(build_flow("f1")), flow_key(build_flow("f2")))
+
+    def test_vlan_as_text_or_integer(self):
+        # computed flows have the match vlan as text, database flows as integer
+        key = flow_key(build_flow("f1", vlan_id="10"))
+        self.assertEqual(flow_key(build_flow("f1", vlan_id=10)), key)
+        self.assertNotEqual(flow_key(build_flow("f1", vlan_id=11)), key)
+        self.assertNotEqual(flow_key(build_flow("f1")), key)
+
+    def test_fields(self):
+        key = flow_key(build_flow("f1"))
+        self.assertNotEqual(flow_key(build_flow("f1", ingress_port="Te0/3")), key)
+        self.assertNotEqual(flow_key(build_flow("f1", actions=[("out", "Te0/2")])), key)
+        self.assertNotEqual(flow_key(build_flow("f1", dst_mac="52:54:00:00:00:01")), key)
+        self.assertNotEqual(flow_key(build_flow("f1", net_id="net2")), key)
+        hash(key)
+
+
+class TestRuleKey(unittest.TestCase):
+
+    def test_database_flow_and_controller_rule(self):
+        # database flows have integer values; controller rules can have them as text, and mac in uppercase
+        flow = build_flow("net1.0", vlan_id=10, dst_mac="52:54:00:aa:00:01", actions=[("vlan", 20), ("out", 3)])
+        rule = {"name": "net1.0", "priority": "1000", "vlan_id": "10", "ingress_port": "Te0/1",
+                "dst_mac": "52:54:00:AA:00:01", "actions": [("vlan", "20"), ("out", "3")]}
+        self.assertEqual(oft.openflow_thread.rule_key(rule), oft.openflow_thread.rule_key(flow))
+
+    def test_fields(self):
+        flow = build_flow("net1.0", vlan_id=10)
+        key = oft.openflow_thread.rule_key(flow)
+        self.assertEqual(key, ("1000", "10", "Te0/1", None, (("vlan", None), ("out", "Te0/2"))))
+        # src_mac and net_id are not present at controller rules, so they are not compared
+        self.assertEqual(oft.openflow_thread.rule_key(build_flow("net1.0", vlan_id=10, net_id="net2",
+                                                                 src_mac="52:54:00:aa:00:01")), key)
+        self.assertNotEqual(oft.openflow_thread.rule_key(build_flow("net1.0", vlan_id=11)), key)
+        self.assertNotEqual(oft.openflow_thread.rule_key(build_flow("net1.0", vlan_id=10, priority=2000)), key)
+        self.assertNotEqual(oft.openflow_thread.rule_key(build_flow("net1.0", vlan_id=10,
+                                                                    actions=[("vlan", 10), ("out", "Te0/2")])), key)
+
+    def test_missing_actions(self):
+        self.assertEqual(oft.openflow_thread.rule_key({}), (None, None, None, None, ()))
+
+
+class TestDiffFlows(unittest.TestCase):
+
+    def setUp(self):
+        of_connector = openflow_conn.OfTestConnector({"name": "test", "dpid": "00:01:02:03:04:05:06:07"})
+        self.thread = oft.openflow_thread("Default", of_connector, None, threading.Lock(), False,
+                                          logger_name="openvim.test.openflow_thread", port_check_period=0)
+
+    def test_diff(self):
+        database_flows = [build_flow("net1.0", vlan_id=10), build_flow("net1.1", ingress_port="Te0/3")]
+        new_flows = [build_flow("new0", vlan_id="10"), build_flow("new1", ingress_port="Te0/4")]
+        flows_to_add, flows_to_keep, flows_to_delete = self.thread._diff_flows(new_flows, database_flows)
+        self.assertEqual([flow["name"] for flow in flows_to_add], ["new1"])
+        self.assertEqual([flow["name"] for flow in flows_to_keep], ["net1.0"])
+        self.assertEqual([flow["name"] for flow in flows_to_delete], ["net1.1"])
+
+    def test_repeated_database_flows(self):
+        # only one of several equal database flows is kept, the rest are deleted
+        database_flows = [build_flow("net1.0"), build_flow("net1.1")]
+        flows_to_add, flows_to_keep, flows_to_delete = self.thread._diff_flows([build_flow("new0")], database_flows)
+        self.assertEqual(flows_to_add, [])
+        self.assertEqual([flow["name"] for flow in flows_to_keep], ["net1.0"])
+        self.assertEqual([flow["name"] for flow in flows_to_delete], ["net1.1"])
+
+    def test_empty(self):
+        self.assertEqual(self.thread._diff_flows([], []), ([], [], []))
+        flows = [build_flow("new0")]
+        self.assertEqual(self.thread._diff_flows(flows, []), (flows, [], []))
+        self.assertEqual(self.thread._diff_flows([], flows), ([], [], flows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Unit tests of placement_index: the free resources of the compute node numas used by vim_db.get_numas.
+Usage: nosetests test/test_placement_index.py
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import placement_index
+
+
+def build_rows(hosts):
+    '''Return database rows, as vim_db.get_placement_rows, of hosts given as a list of
+    (host_id, [(numa_id, hugepages, free_cores, [(port_id, switch_port, Mbps, sriovs)])])'''
+    rows = {"hosts": [], "used": [], "numas": [], "mem": [], "cores": [], "ports": []}
+    for host_id, numas in hosts:
+        rows["hosts"].append({"uuid": host_id, "RAM": 1024, "cpus": 32, "admin_state_up": "true"})
+        for numa_id, hugepages, free_cores, ports in numas:
+            rows["numas"].append({"id": numa_id, "host_id": host_id, "status": "ok", "admin_state_up": "true",
+                                  "hugepages": hugepages})
+            for core_id in range(0, free_cores):
+                for _ in range(0, 2):
+                    rows["cores"].append({"numa_id": numa_id, "core_id": core_id, "instance_id": None,
+                                          "status": "ok"})
+            for port_id, switch_port, mbps, sriovs in ports:
+                port = {"numa_id": numa_id, "id": port_id, "root_id": port_id, "status": "ok", "Mbps_used": 0,
+                        "instance_id": None, "switch_port": switch_port, "pci": "0000:00:{:02x}.0".format(port_id),
+                        "Mbps": mbps, "mac": "52:54:00:00:00:{:02x}".format(port_id)}
+                rows["ports"].append(port)
+                for sriov in range(0, sriovs):
+                    sriov_port = dict(port)
+                    sriov_port["id"] = port_id * 100 + sriov
+                    rows["ports"].append(sriov_port)
+    return rows
+
+
+def build_requirements(memory, cores, port_list=(), sriov_list=()):
+    return {"ram": 0, "vcpus": 0,
+            "numa": {"memory": memory, "proc_req_nb": cores, "proc_req_type": "cores",
+                     "port_list": [{"bandwidth": bandwidth} for bandwidth in port_list],
+                     "sriov_list": [{"bandwidth": bandwidth} for bandwidth in sriov_list]}}
+
+
+class TestPlacementIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = placement_index.placement_index(logger_name="openvim.test.placement_index")
+
+    def test_build(self):
+        rows = build_rows([("h1", [(1, 10, 2, [(1, "Te0/1", 10000, 2)])])])
+        rows["used"].append({"host_id": "h1", "used_ram": 100, "used_cpus": 4})
+        rows["mem"].append({"numa_id": 1, "consumed": 4})
+        rows["cores"][0]["instance_id"] = "vm1"   # one thread of core 0 used
+        self.index.load(rows)
+        self.assertTrue(self.index.loaded)
+        self.assertEqual(self.index.hosts["h1"]["ram_free"], 924)
+        self.assertEqual(self.index.hosts["h1"]["cpus_free"], 28)
+        numa = self.index.numas[1]
+        self.assertEqual((numa["freemem"], numa["freethreads"], numa["freecores"]), (6, 3, 1))
+        self.assertEqual(self.index.mem_buckets, {6: set([1])})
+
+    def test_smallest_numa_for_memory(self):
+        self.index.load(build_rows([("h1", [(1, 20, 2, []), (2, 8, 2, [])]), ("h2", [(3, 12, 2, [])])]))
+        self.assertEqual(self.index.get_numas(build_requirements(4, 1)), (0, {"numa_id": 2, "host_id": "h1"}))
+        self.assertEqual(self.index.get_numas(build_requirements(10, 1)), (0, {"numa_id": 3, "host_id": "h2"}))
+        # prefered host first, even with more memory
+        self.assertEqual(self.index.get_numas(build_requirements(10, 1), prefered_host_id="h1"),
+                         (0, {"numa_id": 1, "host_id": "h1"}))
+
+    def test_no_room(self):
+        self.index.load(build_rows([("h1", [(1, 8, 2, [])])]))
+        result, content = self.index.get_numas(build_requirements(16, 1))
+        self.assertEqual(result, -1)
+        self.assertIn("Hugepages memory", content)
+        result, content = self.index.get_numas(build_requirements(4, 3))
+        self.assertEqual(result, -1)
+        self.assertIn("cpu-cores", content)
+
+    def test_interfaces(self):
+        self.index.load(build_rows([("h1", [(1, 8, 2, [(1, "Te0/1", 1000, 0)]),
+                                            (2, 16, 2, [(2, "Te0/2", 10000, 2)])])]))
+        requirements = build_requirements(4, 1, port_list=[10000])
+        self.assertEqual(self.index.get_numas(requirements), (0, {"numa_id": 2, "host_id": "h1"}))
+        self.assertEqual(requirements["numa"]["port_list"][0]["port_id"], 2)
+        self.assertEqual(requirements["numa"]["port_list"][0]["switch_port"], "Te0/2")
+        # SR-IOV of a port, so the port cannot be used as physical interface too
+        requirements = build_requirements(4, 1, port_list=[10000], sriov_list=[1000])
+        self.assertEqual(self.index.get_numas(requirements)[0], -1)
+        requirements = build_requirements(4, 1, sriov_list=[1000, 1000])
+        self.assertEqual(self.index.get_numas(requirements), (0, {"numa_id": 2, "host_id": "h1"}))
+        self.assertEqual(self.index.get_numas(build_requirements(4, 1, sriov_list=[1000] * 3))[0], -1)
+
+    def test_only_of_ports(self):
+        self.index.load(build_rows([("h1", [(1, 8, 2, [(1, None, 10000, 0)])])]))
+        requirements = build_requirements(4, 1, port_list=[10000])
+        self.assertEqual(self.index.get_numas(requirements)[0], -1)
+        self.assertEqual(self.index.get_numas(requirements, only_of_ports=False), (0, {"numa_id": 1, "host_id": "h1"}))
+
+    def test_update_and_remove_host(self):
+        self.index.load(build_rows([("h1", [(1, 8, 2, [])]), ("h2", [(2, 12, 2, [])])]))
+        self.index.update_host("h1", build_rows([("h1", [(1, 16, 2, [])])]))
+        self.assertEqual(self.index.mem_buckets, {12: set([2]), 16: set([1])})
+        self.index.update_host("h2", build_rows([]))
+        self.assertNotIn("h2", self.index.hosts)
+        self.assertNotIn(2, self.index.numas)
+        self.index.remove_host("h1")
+        self.assertEqual((self.index.hosts, self.index.numas, self.index.mem_buckets), ({}, {}, {}))
+
+    def test_numa_not_ok_is_not_eligible(self):
+        rows = build_rows([("h1", [(1, 8, 2, [])])])
+        rows["numas"][0]["status"] = "error"
+        self.index.load(rows)
+        self.assertEqual(self.index.mem_buckets, {})
+        self.assertEqual(self.index.summary("freemem"), {})
+        self.assertEqual(self.index.get_numas(build_requirements(4, 1))[0], -1)
+
+    def test_compare(self):
+        rows = build_rows([("h1", [(1, 8, 2, [(1, "Te0/1", 10000, 0)])])])
+        self.index.load(rows)
+        self.assertEqual(self.index.compare(rows), [])
+        rows = build_rows([("h1", [(1, 8, 2, [(1, "Te0/1", 10000, 0)])])])
+        rows["mem"].append({"numa_id": 1, "consumed": 2})
+        rows["ports"][0]["instance_id"] = "vm1"
+        self.assertEqual(sorted(self.index.compare(rows)), ["numa 1 freemem index=8 database=6",
+                                                             "numa 1 ports differ"])
+        self.assertEqual(self.index.compare(build_rows([])), ["host h1 not present at database"])
+
+    def test_reconcile_due(self):
+        self.assertFalse(self.index.reconcile_due())
+        index = placement_index.placement_index(reconcile_period=-1, logger_name="openvim.test.placement_index")
+        index.load(build_rows([]))
+        self.assertTrue(index.reconcile_due())
+
+
+if __name__ == '__main__':
+    unittest.main()
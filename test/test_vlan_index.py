@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##
+# Copyright 2015 Telefónica Investigación y Desarrollo, S.A.U.
+# This file is part of openvim
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# For those usages not covered by the Apache License, Version 2.0 please
+# contact with: nfvlabs@tid.es
+##
+
+'''
+Unit tests of vlan_index: the vlans used by the nets of each region, as used by ovim for new nets.
+Usage: nosetests test/test_vlan_index.py
+'''
+
+__author__ = "Alfonso Tierno"
+__date__ = "$10-Oct-2017 10:00:00$"
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm_openvim"))
+import vlan_index
+
+
+class TestVlanIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = vlan_index.vlan_index((100, 105), logger_name="openvim.test.vlan_index")
+
+    def test_allocate_sequential(self):
+        self.assertEqual([self.index.allocate("r1") for _ in range(0, 5)], [100, 101, 102, 103, 104])
+        self.assertIsNone(self.index.allocate("r1"))
+        # regions are independent
+        self.assertEqual(self.index.allocate("r2"), 100)
+
+    def test_allocate_after_last_used(self):
+        self.assertEqual(self.index.allocate("r1"), 100)
+        self.assertEqual(self.index.allocate("r1"), 101)
+        self.index.release("r1", 100)
+        # the vlan of a deleted net is not reused at once
+        self.assertEqual(self.index.allocate("r1"), 102)
+
+    def test_allocate_wraps_around(self):
+        self.index.load([{"vlan": 103, "region": "r1"}, {"vlan": 104, "region": "r1"}])
+        self.assertEqual(self.index.allocate("r1"), 100)
+        for vlan in (101, 102):
+            self.index.mark("r1", vlan)
+        self.index.release("r1", 100)
+        # nothing free after 100 up to the end of the range, so it starts again from the beginning
+        self.assertEqual(self.index.allocate("r1"), 100)
+        self.assertIsNone(self.index.allocate("r1"))
+
+    def test_load_ignores_invalid_vlans(self):
+        self.index.load([{"vlan": None, "region": "r1"}, {"vlan": "abc", "region": "r1"},
+                         {"vlan": 0, "region": "r1"}, {"vlan": 4096, "region": "r1"},
+                         {"vlan": "101", "region": "r1"}])
+        self.assertTrue(self.index.loaded)
+        self.assertEqual(self.index.allocate("r1"), 100)
+        self.assertEqual(self.index.allocate("r1"), 102)
+
+    def test_vlan_shared_by_several_nets(self):
+        rows = [{"vlan": 100, "region": "r1"}, {"vlan": 100, "region": "r1"}]
+        self.index.load(rows)
+        self.assertEqual(self.index.regions["r1"][100], 2)
+        self.index.release("r1", 100)
+        # still used by the other net
+        self.assertEqual(self.index.allocate("r1"), 101)
+        self.assertEqual(self.index.compare(rows[:1] + [{"vlan": 101, "region": "r1"}]), [])
+        self.index.release("r1", 100)
+        self.index.release("r1", 100)   # never below zero
+        self.assertEqual(self.index.regions["r1"][100], 0)
+        self.index.mark("r1", 101)
+        self.assertEqual(self.index.regions["r1"][101], 2)
+
+    def test_compare(self):
+        rows = [{"vlan": 100, "region": "r1"}, {"vlan": 200, "region": "r2"}]
+        self.index.load(rows)
+        self.assertEqual(self.index.compare(rows), [])
+        self.index.mark("r1", 100)
+        self.index.release("r2", 200)
+        self.assertEqual(sorted(self.index.compare(rows)),
+                         ["region r1 vlan 100 nets index=2 database=1", "region r2 vlan 200 nets index=0 database=1"])
+
+
+if __name__ == '__main__':
+    unittest.main()